@@ -4,13 +4,32 @@
 between various models and sqlite to facilitate storage.
 author: supratim.ghosh1@gmail.com
 """
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SQLAlchemy as BaseSQLAlchemy
 from flask_migrate import Migrate
 from flask import Flask
+from sqlalchemy import event as sqlEvent
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
 
 import datetime
+import tempfile
+import sqlite3
+import atexit
+import time
 import os
 
+
+class SQLAlchemy(BaseSQLAlchemy):
+    """Lets SQLALCHEMY_ENGINE_OPTIONS (e.g. the pool class) reach create_engine, the
+    stock extension only knows about the pool size which sqlite file databases
+    cannot use on their own
+    """
+    def apply_pool_defaults(self, app, options):
+        result = super(SQLAlchemy, self).apply_pool_defaults(app, options)
+        options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+        return result
+
+
 # Initiate the orm
 myApp = Flask(__name__)
 db = SQLAlchemy(myApp)
@@ -22,6 +41,123 @@ class DevConfig:
     DEBUG = True
     SQLALCHEMY_ECHO = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:///%s/dev.db' % os.getcwd()
+    # Upper bound on the number of messages accepted in a single batch POST
+    BATCH_MAX_MESSAGES = 10000
+    # Micro batch bounds (messages, seconds) of the streaming ingestion api
+    STREAM_BATCH_SIZE = 500
+    STREAM_BATCH_INTERVAL = 0.5
+    # Longest line (bytes, newline included) of a stream, longer ones are skipped
+    STREAM_MAX_LINE_SIZE = 1048576
+    # Write behind mode for UpdateOdds: flush interval in seconds and the maximum
+    # number of distinct selections waiting before the api answers 429
+    WRITE_BEHIND = False
+    WRITE_BEHIND_INTERVAL = 0.2
+    WRITE_BEHIND_MAX_PENDING = 100000
+    # Number of match documents and listings kept serialized in memory, 0 disables,
+    # and of the variants (pages, projections) kept per match or listing
+    DOCUMENT_CACHE_SIZE = 10000
+    DOCUMENT_CACHE_VARIANTS = 16
+    # Odds change log: page sizes of the delta feed and the pruning limits, the log
+    # is pruned once every CHANGE_LOG_PRUNE_EVERY commits that changed odds
+    CHANGES_PAGE_SIZE = 500
+    CHANGES_MAX_PAGE_SIZE = 5000
+    CHANGE_LOG_MAX_AGE = 24 * 60 * 60
+    CHANGE_LOG_MAX_ROWS = 1000000
+    CHANGE_LOG_PRUNE_EVERY = 1000
+    # Server sent events: pending events per subscriber before it is dropped and
+    # seconds between two keep alive comments on an idle stream
+    PUSH_BUFFER_SIZE = 100
+    PUSH_HEARTBEAT = 15
+    # Default and maximum number of events per page of the match listings
+    LISTING_PAGE_SIZE = 100
+    LISTING_MAX_PAGE_SIZE = 1000
+    # Pragmas run on every new sqlite connection and whether all the writes go
+    # through the single writer thread (see app.writer)
+    SQLITE_PRAGMAS = ()
+    SERIALIZED_WRITER = False
+    # Odds history: default window (seconds) and maximum buckets of a series
+    HISTORY_WINDOW = 24 * 60 * 60
+    HISTORY_MAX_POINTS = 1000
+    # Default and maximum number of events returned by a search
+    SEARCH_PAGE_SIZE = 20
+    SEARCH_MAX_PAGE_SIZE = 100
+    # Upcoming boards: default and maximum window (hours) of a request. A board
+    # covers the maximum window plus BOARD_SLACK_MINUTES, the time before the
+    # windows starting from now fall outside of it and it is loaded again
+    BOARD_DEFAULT_HOURS = 6
+    BOARD_MAX_HOURS = 48
+    BOARD_SLACK_MINUTES = 60
+    # Follow the writes of the other processes sharing the database (several
+    # workers, the bulk loader) to keep the in process state current, polling
+    # every FOLLOW_CHANGES_INTERVAL seconds
+    FOLLOW_CHANGES = False
+    FOLLOW_CHANGES_INTERVAL = 0.1
+    # Request metrics served on /metrics, and the profiling of a sample of the
+    # requests: the fraction profiled (0 disables), the duration in seconds from
+    # which a profiled request is dumped and the directory of the dumps
+    METRICS = True
+    PROFILE_SAMPLE_RATE = 0
+    PROFILE_THRESHOLD = 0.5
+    PROFILE_DIR = os.path.join(tempfile.gettempdir(), 'betting-profiles')
+
+
+class ProdConfig(DevConfig):
+    """Defines the production environment: no sql echo, sqlite in WAL mode so readers
+    do not block behind the writer, a pool of reader connections and a single
+    serialized writer
+    """
+    DEBUG = False
+    SQLALCHEMY_ECHO = False
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        'BETTING_DATABASE_URI', 'sqlite:///%s/betting.db' % os.getcwd()
+    )
+    # Pooled connections move between request threads, one thread at a time
+    SQLALCHEMY_ENGINE_OPTIONS = dict(
+        poolclass=QueuePool,
+        pool_size=16,
+        max_overflow=16,
+        connect_args={'check_same_thread': False},
+    )
+    SQLITE_PRAGMAS = (
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('busy_timeout', 5000),
+        ('temp_store', 'MEMORY'),
+        # 256MB of memory mapped io and a 64MB page cache (negative is in KiB)
+        ('mmap_size', 268435456),
+        ('cache_size', -65536),
+    )
+    SERIALIZED_WRITER = True
+    FOLLOW_CHANGES = True
+
+
+CONFIGS = {'dev': DevConfig, 'prod': ProdConfig}
+
+
+# Switching the journal mode needs the database to itself and fails right away,
+# without waiting on the busy timeout, while another process switches it too
+PRAGMA_RETRIES = 20
+PRAGMA_RETRY_DELAY = 0.05
+
+
+@sqlEvent.listens_for(Engine, 'connect')
+def applySqlitePragmas(dbapiConnection, connectionRecord):
+    """Runs the configured SQLITE_PRAGMAS on every new sqlite connection"""
+    pragmas = myApp.config.get('SQLITE_PRAGMAS')
+    if not pragmas or not isinstance(dbapiConnection, sqlite3.Connection):
+        return
+    cursor = dbapiConnection.cursor()
+    for name, value in pragmas:
+        for attempt in range(PRAGMA_RETRIES):
+            try:
+                cursor.execute('PRAGMA %s = %s' % (name, value))
+                break
+            except sqlite3.OperationalError as error:
+                if 'locked' not in str(error) or attempt == PRAGMA_RETRIES - 1:
+                    raise
+                time.sleep(PRAGMA_RETRY_DELAY)
+    cursor.close()
 
 
 def getOrCreate(session, model, **kwargs):
@@ -43,39 +179,92 @@ def getOrCreate(session, model, **kwargs):
         return instance
 
 
-def createApplication(addFixtures=False):
+def createApplication(addFixtures=False, configName=None):
     """This method initializes the flask application and set the configuration
-    (hard coded to use dev only for now).
+    (dev unless the BETTING_CONFIG environment variable says otherwise).
 
     @param bool addFixtures: This is a one time setup used for demo purposes
     to populated some data in sqlite so that the GETs work right away
+    @param str configName: name of the configuration, dev or prod (optional)
     @return flask.Application: returns the configured flask application instance
     """
-    myApp.config.from_object(DevConfig())
+    configName = configName or os.environ.get('BETTING_CONFIG', 'dev')
+    myApp.config.from_object(CONFIGS[configName]())
     db.init_app(myApp)
-    migrate = Migrate(myApp, db)
+    # Batch mode lets the migrations alter tables on sqlite
+    migrate = Migrate(myApp, db, render_as_batch=True)
     from app import models
+    # Registers the full text index of the events with the event table
+    from app import search
+
+    if myApp.config['DOCUMENT_CACHE_SIZE']:
+        from app.cache import DocumentCache
+        myApp.extensions['documentCache'] = DocumentCache(
+            myApp.config['DOCUMENT_CACHE_SIZE'], myApp.config['DOCUMENT_CACHE_VARIANTS']
+        )
+
+    from app.bulkload import loadEventsCommand
+    myApp.cli.add_command(loadEventsCommand)
+
+    from app.board import BoardSnapshots
+    myApp.extensions['boards'] = BoardSnapshots(
+        datetime.timedelta(hours=myApp.config['BOARD_MAX_HOURS']),
+        datetime.timedelta(minutes=myApp.config['BOARD_SLACK_MINUTES']),
+    )
+
+    if myApp.config['METRICS']:
+        from app.metrics import Metrics
+        myApp.extensions['metrics'] = Metrics().install(myApp)
+
+    from app.push import Broker
+    myApp.extensions['pushBroker'] = Broker(myApp.config['PUSH_BUFFER_SIZE'])
+
+    if myApp.config['SERIALIZED_WRITER']:
+        from app.writer import SerialWriter
+        writer = myApp.extensions['serialWriter'] = SerialWriter(myApp).start()
+        # Registered first so that it stops after the write behind drained
+        atexit.register(writer.stop)
+
+    if myApp.config['FOLLOW_CHANGES']:
+        from app.follower import ChangeFollower
+        follower = myApp.extensions['changeFollower'] = ChangeFollower(
+            myApp,
+            myApp.config['FOLLOW_CHANGES_INTERVAL'],
+            myApp.config['CHANGES_MAX_PAGE_SIZE'],
+        ).start()
+        atexit.register(follower.stop)
+
+    if myApp.config['WRITE_BEHIND']:
+        from app.writebehind import OddsWriteBehind
+        writeBehind = myApp.extensions['writeBehind'] = OddsWriteBehind(
+            myApp,
+            myApp.config['WRITE_BEHIND_MAX_PENDING'],
+            myApp.config['WRITE_BEHIND_INTERVAL'],
+        ).start()
+        # Drain the pending odds when the process exits
+        atexit.register(writeBehind.stop)
 
     # For demo puposes only, if you are happy to call a bunch of POSTs before checking the GETs
     # out then this can be deleted.
     if addFixtures:
 
+        from app.bulkload import loadEvents
+        events = []
+        for eName, eTime in [
+            ('Real Madrid vs Barcelona', datetime.datetime(2018, 6, 20, 10, 30, 0)),
+            ('Cavaliers vs Lakers', datetime.datetime(2018, 1, 15, 22, 0, 0)),
+        ]:
+            sel1Name, _, sel2Name = eName.partition(' vs ')
+            events.append(
+                ('Football', eName, eTime, [('Winner', [(sel1Name, 1.01), (sel2Name, 1.01)])])
+            )
+
         with myApp.app_context():
             db.metadata.create_all(db.engine)
-            for eName, eTime in [
-                ('Real Madrid vs Barcelona', datetime.datetime(2018, 6, 20, 10, 30, 0)),
-                ('Cavaliers vs Lakers', datetime.datetime(2018, 1, 15, 22, 0, 0)),
-            ]:
-                sport = getOrCreate(db.session, models.Sport, name='Football')
-                event = models.Event(name=eName, startTime=eTime, sport=sport)
-                market = models.Market(name='Winner', event=event)
-
-                sel1Name, _, sel2Name = eName.partition(' vs ')
-                selection1 = models.Selection(name=sel1Name, odds=1.01, market=market)
-                selection2 = models.Selection(name=sel2Name, odds=1.01, market=market)
-                
-                db.session.add(selection1)
-                db.session.add(selection2)
-            db.session.commit()
+            connection = db.engine.connect()
+            try:
+                loadEvents(connection, events)
+            finally:
+                connection.close()
     
     return myApp
@@ -0,0 +1,198 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module keeps the upcoming events board of each sport materialized in
+memory: the events of a time window with their markets and current odds, each
+event held as its serialized json. A board is loaded with one range scan of the
+(sport, start time) index and then kept current by the message handlers, which
+re-serialize only the events whose odds changed and slot in the new events.
+author: supratim.ghosh1@gmail.com
+"""
+from datetime import datetime
+import bisect
+import threading
+
+from app import db
+from app.models import Event, Market, Selection
+from app.messages import TIME_FORMAT
+from app.serialize import dumps
+
+
+class Board(object):
+	"""Events of one sport starting within [start, end), ordered by start time.
+
+	:param int sportId: sport of the board
+	:param datetime start: start of the window covered
+	:param datetime end: end of the window covered
+	"""
+
+	def __init__(self, sportId, start, end):
+		self.sportId = sportId
+		self.start = start
+		self.end = end
+		# Sorted (start time, event id) keys and the serialized event per id
+		self._keys = []
+		self._events = {}
+		self._fragments = {}
+		# Selection id to (event id, selection dict) to update the odds in place
+		self._selections = {}
+
+	def __len__(self):
+		return len(self._keys)
+
+	def covers(self, start, end):
+		return self.start <= start and end <= self.end
+
+	def add(self, startTime, event):
+		"""Adds an event dict (with its markets and selections) if it starts
+		within the window of the board
+		"""
+		if not self.start <= startTime < self.end or event['id'] in self._events:
+			return
+		bisect.insort(self._keys, (startTime, event['id']))
+		self._events[event['id']] = event
+		for market in event['markets']:
+			for selection in market['selections']:
+				self._selections[selection['id']] = (event['id'], selection)
+		self._render(event['id'])
+
+	def setOdds(self, newOdds):
+		"""Updates the odds of the selections on the board and re-serializes their
+		events, once each
+
+		:param dict newOdds: selection id to its new odds
+		"""
+		changed = set()
+		for selId, odds in newOdds.items():
+			entry = self._selections.get(selId)
+			if entry is None:
+				continue
+			entry[1]['odds'] = odds
+			changed.add(entry[0])
+		for eventId in changed:
+			self._render(eventId)
+
+	def window(self, start, end):
+		"""Returns the serialized events starting within [start, end)"""
+		first = bisect.bisect_left(self._keys, (start,))
+		last = bisect.bisect_left(self._keys, (end,))
+		return [self._fragments[eventId] for _, eventId in self._keys[first:last]]
+
+	def _render(self, eventId):
+		self._fragments[eventId] = dumps(self._events[eventId])
+
+
+def loadBoard(sportId, start, end):
+	"""Loads the board of a sport over [start, end) in a single statement, a range
+	scan of the (sport, start time) index joined to the markets and selections
+
+	@param int sportId: sport of the board
+	@param datetime start: start of the window
+	@param datetime end: end of the window
+	@return Board: the loaded board
+	"""
+	query = db.session.query(
+		Event.id, Event.name, Event.startTime,
+		Market.id, Market.name,
+		Selection.id, Selection.name, Selection.odds,
+	).outerjoin(Market, Market.eventId == Event.id).outerjoin(
+		Selection, Selection.marketId == Market.id
+	).filter(
+		Event.sportId == sportId, Event.startTime >= start, Event.startTime < end
+	).order_by(Event.startTime, Event.id, Market.id, Selection.id)
+
+	board = Board(sportId, start, end)
+	event = market = None
+	rows = []
+	for eventId, name, startTime, marketId, marketName, selId, selName, odds in query:
+		if event is None or event['id'] != eventId:
+			event = dict(id=eventId, name=name, startTime=str(startTime), markets=[])
+			rows.append((startTime, event))
+			market = None
+		if marketId is not None and (market is None or market['id'] != marketId):
+			market = dict(id=marketId, name=marketName, selections=[])
+			event['markets'].append(market)
+		if selId is not None:
+			market['selections'].append(dict(id=selId, name=selName, odds=odds))
+	for startTime, event in rows:
+		board.add(startTime, event)
+	return board
+
+
+class BoardSnapshots(object):
+	"""Materialized boards of the sports, loaded on first read. Each board covers
+	span and slack from the start of the window it was loaded for and is loaded
+	again once a read asks for a window outside of it. The slack keeps the longest
+	window starting from now covered that long after the board was loaded.
+
+	:param timedelta span: longest window a read can ask for
+	:param timedelta slack: extra length of the window covered by a board
+	"""
+
+	def __init__(self, span, slack):
+		self.span = span
+		self.slack = slack
+		self._boards = {}
+		# Bumped per sport by every update so that a board loaded concurrently
+		# with an update is not kept
+		self._generations = {}
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._boards)
+
+	def clear(self):
+		with self._lock:
+			self._boards.clear()
+			self._generations.clear()
+
+	def window(self, sportId, start, end):
+		"""Returns the serialized events of a sport starting within [start, end),
+		the window cannot be longer than the span of the boards
+
+		@param int sportId: sport of the board
+		@param datetime start: start of the window
+		@param datetime end: end of the window
+		@return list: json strings of the events ordered by start time
+		"""
+		with self._lock:
+			board = self._boards.get(sportId)
+			if board is not None and board.covers(start, end):
+				return board.window(start, end)
+			generation = self._generations.get(sportId, 0)
+
+		board = loadBoard(sportId, start, start + self.span + self.slack)
+		with self._lock:
+			if self._generations.get(sportId, 0) == generation:
+				self._boards[sportId] = board
+			return board.window(start, end)
+
+	def apply(self, newOdds, oddsEvents, eventSports, createdEvents):
+		"""Applies a committed batch to the loaded boards
+
+		@param dict newOdds: selection id to its new odds
+		@param dict oddsEvents: selection id to its event id
+		@param dict eventSports: event id to its sport id
+		@param list createdEvents: dicts describing the created events, with their
+		markets and selections
+		"""
+		bySport = {}
+		for selId, odds in newOdds.items():
+			sportId = eventSports[oddsEvents[selId]]
+			bySport.setdefault(sportId, {})[selId] = odds
+		with self._lock:
+			for sportId in set(bySport) | set(c['sportId'] for c in createdEvents):
+				self._generations[sportId] = self._generations.get(sportId, 0) + 1
+			for sportId, odds in bySport.items():
+				board = self._boards.get(sportId)
+				if board is not None:
+					board.setOdds(odds)
+			for created in createdEvents:
+				board = self._boards.get(created['sportId'])
+				if board is None:
+					continue
+				board.add(datetime.strptime(created['startTime'], TIME_FORMAT), dict(
+					id=created['id'],
+					name=created['name'],
+					startTime=created['startTime'],
+					markets=created['markets'],
+				))
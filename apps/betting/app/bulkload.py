@@ -0,0 +1,269 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module bulk loads events, markets and selections from csv or ndjson files.
+Sports are resolved through an in memory lookup table and rows are written with
+executemany inserts in large batches, one transaction per batch, instead of an
+ORM round trip (and commit) per row.
+Usage: FLASK_APP=server.py flask load-events schedule.csv
+author: supratim.ghosh1@gmail.com
+"""
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError, OperationalError
+from flask.cli import with_appcontext
+from datetime import datetime
+import click
+import json
+import time
+import sys
+import csv
+
+from app import db
+from app.models import Sport, Event, Market, Selection
+from app.messages import TIME_FORMAT, applyCommitted, bumpVersions
+from app.history import recordHistory
+from app.search import indexEvents
+
+# Number of selections buffered before a batch is written
+BATCH_SIZE = 20000
+
+# Attempts at writing a batch whose ids were taken by a concurrent writer, the
+# wait before the next attempt doubles from RETRY_DELAY seconds
+RETRIES = 3
+RETRY_DELAY = 0.05
+
+CSV_COLUMNS = ('sport', 'event', 'startTime', 'market', 'selection', 'odds')
+
+
+class BulkLoader(object):
+	"""Buffers events and writes them in batches. Ids are assigned by the loader from
+	the current maximum ids at the start of each batch transaction, so that the
+	markets and selections can reference their parents without reading them back.
+
+	:param Connection connection: connection the batches are written with
+	:param int batchSize: number of selections buffered before a batch is written
+	"""
+
+	def __init__(self, connection, batchSize=BATCH_SIZE):
+		self.connection = connection
+		self.batchSize = batchSize
+		self.counts = dict(sports=0, events=0, markets=0, selections=0)
+		self._sports = {}
+		self._sportNames = {}
+		for sportId, name, key in connection.execute(
+			db.select([Sport.id, Sport.name, Sport.nameKey])
+		):
+			self._sports[key] = sportId
+			self._sportNames[sportId] = name
+		self._sportIds = set(self._sports.values())
+		self._pending = []
+		self._pendingSelections = 0
+
+	def sportId(self, sport):
+		"""Resolves a sport given by name (created when missing) or by id
+
+		:raises ValueError: for an unknown sport id
+		"""
+		if isinstance(sport, dict):
+			sport = sport.get('id', sport.get('name'))
+		if isinstance(sport, int):
+			if sport not in self._sportIds:
+				raise ValueError('Unknown sport id %s' % sport)
+			return sport
+		key = Sport.normalizeName(sport)
+		if key not in self._sports:
+			result = self.connection.execute(
+				Sport.__table__.insert(), dict(name=sport, nameKey=key, version=0)
+			)
+			self._sports[key] = result.inserted_primary_key[0]
+			self._sportNames[self._sports[key]] = sport
+			self._sportIds.add(self._sports[key])
+			self.counts['sports'] += 1
+		return self._sports[key]
+
+	def add(self, sport, name, startTime, markets):
+		"""Buffers an event, writing a batch when enough selections are buffered
+
+		:param sport: sport name, sport id or sport dict (id or name)
+		:param str name: event name
+		:param datetime startTime: event start time
+		:param list markets: (market name, [(selection name, odds)]) pairs
+		"""
+		self._pending.append((self.sportId(sport), name, startTime, markets))
+		self._pendingSelections += sum(len(selections) for _, selections in markets)
+		if self._pendingSelections >= self.batchSize:
+			self.flush()
+
+	def flush(self):
+		"""Writes the buffered events in one transaction, then brings the in process
+		state up to date with them like a batch of NewEvent messages would
+		"""
+		if not self._pending:
+			return
+		for attempt in range(RETRIES):
+			try:
+				with self.connection.begin():
+					createdEvents = self._write()
+				break
+			except (IntegrityError, OperationalError):
+				if attempt == RETRIES - 1:
+					raise
+				time.sleep(RETRY_DELAY * 2 ** attempt)
+		# Counted once committed, the rolled back attempts wrote nothing
+		self.counts['events'] += len(createdEvents)
+		for created in createdEvents:
+			self.counts['markets'] += len(created['markets'])
+			self.counts['selections'] += sum(len(m['selections']) for m in created['markets'])
+		self._pending = []
+		self._pendingSelections = 0
+		applyCommitted({}, {}, {}, createdEvents)
+
+	def _maxId(self, model):
+		return self.connection.execute(db.select([func.max(model.id)])).scalar() or 0
+
+	def _write(self):
+		"""Inserts the buffered events, returns the dicts describing them as
+		applyCommitted takes them
+		"""
+		eventId, marketId, selectionId = [
+			self._maxId(model) for model in (Event, Market, Selection)
+		]
+		events, markets, selections, searchRows, createdEvents = [], [], [], [], []
+		for sportId, name, startTime, eventMarkets in self._pending:
+			eventId += 1
+			events.append(dict(id=eventId, name=name, startTime=startTime, sportId=sportId))
+			searchRows.append((eventId, name, [
+				selName for _, marketSelections in eventMarkets for selName, _ in marketSelections
+			]))
+			created = dict(
+				id=eventId, name=name, startTime=str(startTime), sportId=sportId,
+				sportName=self._sportNames[sportId], markets=[],
+			)
+			createdEvents.append(created)
+			for marketName, marketSelections in eventMarkets:
+				marketId += 1
+				markets.append(dict(id=marketId, name=marketName, eventId=eventId))
+				created['markets'].append(dict(id=marketId, name=marketName, selections=[]))
+				for selName, odds in marketSelections:
+					selectionId += 1
+					selections.append(dict(
+						id=selectionId, name=selName, odds=odds, marketId=marketId
+					))
+					created['markets'][-1]['selections'].append(
+						dict(id=selectionId, name=selName, odds=odds)
+					)
+
+		self.connection.execute(Event.__table__.insert(), events)
+		if markets:
+			self.connection.execute(Market.__table__.insert(), markets)
+		if selections:
+			self.connection.execute(Selection.__table__.insert(), selections)
+			recordHistory([
+				(s['id'], s['odds']) for s in selections if s['odds'] is not None
+			], connection=self.connection)
+		indexEvents(searchRows, self.connection)
+		# Listings of the sports that got events are no longer current
+		bumpVersions({}, set(e['sportId'] for e in events), self.connection)
+		return createdEvents
+
+
+def readCsv(lines):
+	"""Yields the events of a csv file with CSV_COLUMNS columns (and a header row),
+	one row per selection with the rows of an event next to each other
+
+	@param iterable lines: lines of the csv file
+	@return generator: (sport, name, startTime, markets) tuples
+	"""
+	current = None
+	markets = []
+	for row in csv.DictReader(lines):
+		key = (row['sport'], row['event'], row['startTime'])
+		if key != current:
+			if current is not None:
+				yield current[0], current[1], _parseTime(current[2]), markets
+			current, markets = key, []
+		if not markets or markets[-1][0] != row['market']:
+			markets.append((row['market'], []))
+		markets[-1][1].append((row['selection'], float(row['odds'])))
+	if current is not None:
+		yield current[0], current[1], _parseTime(current[2]), markets
+
+
+def readNdjson(lines):
+	"""Yields the events of a ndjson file, one event per line shaped like the event
+	of a NewEvent message (the sport can be given by id or by name)
+
+	@param iterable lines: lines of the ndjson file
+	@return generator: (sport, name, startTime, markets) tuples
+	"""
+	for line in lines:
+		line = line.strip()
+		if not line:
+			continue
+		event = json.loads(line)
+		yield event['sport'], event['name'], _parseTime(event['startTime']), [
+			(market['name'], [(s['name'], s['odds']) for s in market['selections']])
+			for market in event['markets']
+		]
+
+
+def _parseTime(value):
+	return datetime.strptime(value, TIME_FORMAT)
+
+
+def _open(path):
+	if sys.version_info[0] < 3:
+		return open(path, 'rb')
+	return open(path, newline='', encoding='utf-8')
+
+
+def loadEvents(connection, events, batchSize=BATCH_SIZE, progress=None):
+	"""Loads events through a BulkLoader
+
+	@param Connection connection: connection to write with
+	@param iterable events: (sport, name, startTime, markets) tuples
+	@param int batchSize: number of selections per batch
+	@param callable progress: called with the counts after every batch (optional)
+	@return dict: number of rows inserted per table
+	"""
+	loader = BulkLoader(connection, batchSize)
+	written = 0
+	for sport, name, startTime, markets in events:
+		loader.add(sport, name, startTime, markets)
+		if progress is not None and loader.counts['events'] != written:
+			written = loader.counts['events']
+			progress(loader.counts)
+	loader.flush()
+	return loader.counts
+
+
+@click.command('load-events')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fileFormat', type=click.Choice(['csv', 'ndjson']),
+	help='Defaults to the file extension')
+@click.option('--batch-size', 'batchSize', default=BATCH_SIZE, help='Selections per transaction')
+@with_appcontext
+def loadEventsCommand(path, fileFormat, batchSize):
+	"""Bulk loads the events, markets and selections of a csv or ndjson file"""
+	fileFormat = fileFormat or ('csv' if path.endswith('.csv') else 'ndjson')
+	reader = readCsv if fileFormat == 'csv' else readNdjson
+	started = time.time()
+
+	def progress(counts):
+		elapsed = time.time() - started
+		click.echo('%(events)d events, %(selections)d selections' % counts + (
+			' (%d rows/s)' % (sum(counts.values()) / max(elapsed, 1e-6))
+		))
+
+	connection = db.engine.connect()
+	try:
+		with _open(path) as lines:
+			counts = loadEvents(connection, reader(lines), batchSize, progress)
+	finally:
+		connection.close()
+
+	elapsed = time.time() - started
+	click.echo(
+		'Loaded %(sports)d sports, %(events)d events, %(markets)d markets and '
+		'%(selections)d selections' % counts +
+		' in %.1fs (%d rows/s)' % (elapsed, sum(counts.values()) / max(elapsed, 1e-6))
+	)
@@ -0,0 +1,105 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains the in process cache of serialized match documents. Reads
+are served straight from the cached bytes and the message handlers invalidate the
+entries affected by what they write.
+author: supratim.ghosh1@gmail.com
+"""
+from collections import OrderedDict
+import threading
+
+# Number of generation counters the invalidations are spread over
+GENERATION_SLOTS = 256
+
+
+class DocumentCache(object):
+	"""Bounded least recently used cache of serialized documents. Documents are
+	grouped by (kind, ident), e.g. ('match', 1) or ('sport', 'football'), and each
+	group holds one body per variant (page, projection) so that a group can be
+	invalidated as a whole. The bound applies to the number of bodies, each group
+	keeping at most maxVariants of them.
+
+	:param int maxSize: maximum number of bodies kept
+	:param int maxVariants: maximum number of bodies kept per group
+	"""
+
+	def __init__(self, maxSize, maxVariants):
+		self.maxSize = maxSize
+		self.maxVariants = maxVariants
+		self.hits = 0
+		self.misses = 0
+		self._entries = OrderedDict()
+		self._size = 0
+		self._generations = [0] * GENERATION_SLOTS
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return self._size
+
+	def _slot(self, kind, ident):
+		return hash((kind, ident)) % GENERATION_SLOTS
+
+	def token(self, kind, ident):
+		"""Returns the current generation of a group, it has to be taken before the
+		document is built so that set() can detect an invalidation in between
+
+		:return int: generation token to pass to set()
+		"""
+		return self._generations[self._slot(kind, ident)]
+
+	def get(self, kind, ident, variant):
+		"""Returns the cached body or None, marks the group and the variant as
+		recently used
+		"""
+		key = (kind, ident)
+		with self._lock:
+			variants = self._entries.pop(key, None)
+			body = variants.pop(variant, None) if variants is not None else None
+			if variants is not None:
+				if body is not None:
+					variants[variant] = body
+				self._entries[key] = variants
+			if body is None:
+				self.misses += 1
+			else:
+				self.hits += 1
+			return body
+
+	def set(self, kind, ident, variant, body, token):
+		"""Caches a body unless the group was invalidated since token was taken,
+		evicting the least recently used variant beyond maxVariants and the least
+		recently used groups beyond maxSize bodies
+		"""
+		key = (kind, ident)
+		with self._lock:
+			if token != self._generations[self._slot(kind, ident)]:
+				return
+			variants = self._entries.pop(key, None) or OrderedDict()
+			self._size -= len(variants)
+			variants.pop(variant, None)
+			variants[variant] = body
+			while len(variants) > self.maxVariants:
+				variants.popitem(last=False)
+			self._entries[key] = variants
+			self._size += len(variants)
+			while self._size > self.maxSize:
+				self._size -= len(self._entries.popitem(last=False)[1])
+
+	def invalidate(self, kind, ident):
+		"""Drops every variant of a group"""
+		with self._lock:
+			self._generations[self._slot(kind, ident)] += 1
+			self._size -= len(self._entries.pop((kind, ident), ()))
+
+	def clear(self):
+		"""Drops every document and resets the counters"""
+		with self._lock:
+			self._generations = [g + 1 for g in self._generations]
+			self._entries.clear()
+			self._size = 0
+			self.hits = self.misses = 0
+
+	def stats(self):
+		"""Returns the hit and miss counters along with the number of bodies"""
+		with self._lock:
+			return dict(hits=self.hits, misses=self.misses, size=self._size)
@@ -0,0 +1,122 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module maintains the append only log of odds changes. Every change written
+by the message handlers is recorded with a global sequence number so downstream
+services can sync incrementally, and the log is pruned by age and size.
+author: supratim.ghosh1@gmail.com
+"""
+from datetime import datetime, timedelta
+import itertools
+import threading
+
+from app import db, myApp
+from app.models import OddsChange
+
+# Counts the commits recorded to know when to prune next
+_commits = itertools.count(1)
+_pruneLock = threading.Lock()
+
+
+def recordChanges(changes):
+	"""Appends the changes to the log within the current transaction
+
+	@param list changes: (selection id, event id, sport id, odds) tuples
+	"""
+	if not changes:
+		return
+	now = datetime.utcnow()
+	db.session.execute(
+		OddsChange.__table__.insert(),
+		[
+			dict(selectionId=selId, eventId=eventId, sportId=sportId, odds=odds, createdAt=now)
+			for selId, eventId, sportId, odds in changes
+		]
+	)
+
+
+def lastRecordedSeq():
+	"""Returns the sequence number of the last change recorded by recordChanges
+	in the current transaction, the changes of a call are numbered contiguously
+	as sqlite serializes the writers
+	"""
+	return db.session.execute('SELECT last_insert_rowid()').scalar()
+
+
+def changesSince(since, limit, sportId=None):
+	"""Returns the page of changes that follow a sequence number
+
+	@param int since: last sequence number the client has seen
+	@param int limit: maximum number of changes returned
+	@param int sportId: only return changes of this sport (optional)
+	@return list: OddsChange instances ordered by sequence number
+	"""
+	query = OddsChange.query.filter(OddsChange.seq > since)
+	if sportId is not None:
+		query = query.filter(OddsChange.sportId == sportId)
+	return query.order_by(OddsChange.seq).limit(limit).all()
+
+
+def oldestSeq():
+	"""Returns the lowest sequence number still in the log (None when empty)"""
+	return db.session.query(db.func.min(OddsChange.seq)).scalar()
+
+
+def lastSeq():
+	"""Returns the sequence number of the last change ever recorded, pruned ones
+	included, 0 when none was
+	"""
+	return db.session.execute(
+		"SELECT seq FROM sqlite_sequence WHERE name = 'odds_change'"
+	).scalar() or 0
+
+
+def mustResync(since):
+	"""Tells if changes that followed since were pruned from the log"""
+	oldest = oldestSeq()
+	if oldest is None:
+		# Pruned empty, every change after since is gone
+		return since < lastSeq()
+	return since < oldest - 1
+
+
+def prune(maxAge=None, maxRows=None):
+	"""Deletes the changes older than maxAge seconds and all but the latest maxRows
+	ones. Both deletes are range scans on an index so only the pruned rows are read.
+
+	@param int maxAge: maximum age in seconds of the changes kept (optional)
+	@param int maxRows: maximum number of changes kept (optional)
+	@return int: number of changes deleted
+	"""
+	deleted = 0
+	if maxAge is not None:
+		cutoff = datetime.utcnow() - timedelta(seconds=maxAge)
+		deleted += OddsChange.query.filter(OddsChange.createdAt < cutoff).delete(
+			synchronize_session=False
+		)
+	if maxRows is not None:
+		upTo = db.session.query(db.func.max(OddsChange.seq)).scalar()
+		if upTo is not None:
+			deleted += OddsChange.query.filter(OddsChange.seq <= upTo - maxRows).delete(
+				synchronize_session=False
+			)
+	db.session.commit()
+	return deleted
+
+
+def maybePrune(config):
+	"""Prunes the log once every CHANGE_LOG_PRUNE_EVERY recorded commits. Runs
+	after the changes were committed, a failure is logged and left for the next
+	prune rather than failing the write
+
+	@param dict config: application configuration holding the log limits
+	@return int: number of changes deleted
+	"""
+	if next(_commits) % config['CHANGE_LOG_PRUNE_EVERY']:
+		return 0
+	with _pruneLock:
+		try:
+			return prune(config['CHANGE_LOG_MAX_AGE'], config['CHANGE_LOG_MAX_ROWS'])
+		except Exception:
+			db.session.rollback()
+			myApp.logger.exception('Pruning the change log failed')
+			return 0
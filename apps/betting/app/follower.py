@@ -0,0 +1,200 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module keeps the in process state of a worker (cached documents, boards
+and push subscribers) current with the writes of the other processes sharing the
+database. A background thread polls PRAGMA data_version on its own connection,
+which changes whenever another connection commits, and then reads what was
+written since its last pass: the odds change log and the events created.
+author: supratim.ghosh1@gmail.com
+"""
+import threading
+
+from app import db
+from app.models import Sport, Event, Market, Selection, OddsChange
+
+
+class ChangeFollower(object):
+	"""Applies the odds changes and new events written by other processes.
+
+	:param flask.Flask app: application whose state is kept current
+	:param float interval: seconds between two polls, bounds the staleness
+	:param int pageSize: number of changes read per statement
+	"""
+
+	def __init__(self, app, interval, pageSize):
+		self.app = app
+		self.interval = interval
+		self.pageSize = pageSize
+		self.lastSeq = None
+		self.lastEventId = None
+		# Sequence ranges and event ids written by this process, already applied
+		self._localSeqs = []
+		self._localEvents = set()
+		self._lock = threading.Lock()
+		self._stopped = threading.Event()
+		self._thread = None
+
+	def markLocal(self, lastSeq, count, eventIds):
+		"""Records the changes (the count of them up to lastSeq) and the events
+		written by this process, called before they are committed
+		"""
+		with self._lock:
+			if count:
+				self._localSeqs.append((lastSeq - count + 1, lastSeq))
+			self._localEvents.update(eventIds)
+
+	def unmarkLocal(self, lastSeq, count, eventIds):
+		"""Forgets the changes and events recorded by markLocal for writes that were
+		rolled back, their sequence numbers and ids are then used again
+		"""
+		with self._lock:
+			if count and (lastSeq - count + 1, lastSeq) in self._localSeqs:
+				self._localSeqs.remove((lastSeq - count + 1, lastSeq))
+			self._localEvents.difference_update(eventIds)
+
+	def start(self):
+		self._thread = threading.Thread(target=self._run, name='change-follower')
+		self._thread.daemon = True
+		self._thread.start()
+		return self
+
+	def stop(self):
+		if self._thread is None:
+			return
+		self._stopped.set()
+		self._thread.join()
+		self._thread = None
+
+	def _position(self, connection):
+		"""Starts following from what is in the database now"""
+		self.lastSeq = connection.execute(db.select([db.func.max(OddsChange.seq)])).scalar() or 0
+		self.lastEventId = connection.execute(db.select([db.func.max(Event.id)])).scalar() or 0
+
+	def _run(self):
+		with self.app.app_context():
+			connection = None
+			version = None
+			try:
+				while True:
+					try:
+						# Connecting here rather than in start, the application module
+						# may still be importing and the engine creation imports the
+						# dbapi. A failed connect is tried again on the next pass.
+						if connection is None:
+							connection = db.engine.connect()
+						if self.lastSeq is None:
+							self._position(connection)
+						else:
+							current = connection.execute('PRAGMA data_version').scalar()
+							if current != version:
+								self.poll(connection)
+								# Only once applied, a failed pass is tried again
+								version = current
+					except Exception:
+						self.app.logger.exception('Following the changes failed')
+					if self._stopped.wait(self.interval):
+						return
+			finally:
+				if connection is not None:
+					connection.close()
+
+	def poll(self, connection):
+		"""Reads and applies everything written since the last poll, the position
+		only moves past the changes once they are applied
+
+		@param Connection connection: connection to read with
+		"""
+		from app.messages import applyCommitted
+
+		oldest = connection.execute(db.select([db.func.min(OddsChange.seq)])).scalar()
+		if oldest is not None and self.lastSeq < oldest - 1:
+			# Changes were pruned before this process saw them, start over
+			self._resync(connection)
+			return
+
+		newOdds, oddsEvents, eventSports = {}, {}, {}
+		lastSeq = self.lastSeq
+		while True:
+			rows = connection.execute(
+				db.select([
+					OddsChange.seq, OddsChange.selectionId, OddsChange.eventId,
+					OddsChange.sportId, OddsChange.odds,
+				]).where(OddsChange.seq > lastSeq).order_by(OddsChange.seq).limit(self.pageSize)
+			).fetchall()
+			for seq, selId, eventId, sportId, odds in rows:
+				if not self._isLocalSeq(seq):
+					newOdds[selId] = odds
+					oddsEvents[selId] = eventId
+					eventSports[eventId] = sportId
+				lastSeq = seq
+			if len(rows) < self.pageSize:
+				break
+
+		createdEvents, lastEventId = self._createdEvents(connection)
+		if newOdds or createdEvents:
+			applyCommitted(newOdds, oddsEvents, eventSports, createdEvents)
+		self.lastSeq, self.lastEventId = lastSeq, lastEventId
+		with self._lock:
+			self._localSeqs = [r for r in self._localSeqs if r[1] > lastSeq]
+			self._localEvents = set(i for i in self._localEvents if i > lastEventId)
+
+	def _isLocalSeq(self, seq):
+		with self._lock:
+			return any(first <= seq <= last for first, last in self._localSeqs)
+
+	def _createdEvents(self, connection):
+		"""Returns the dicts describing the events created by other processes since
+		the last poll, with their markets and selections, and the id of the last
+		event created
+		"""
+		rows = connection.execute(
+			db.select([Event.id, Event.name, Event.startTime, Sport.id, Sport.name]).select_from(
+				Event.__table__.join(Sport.__table__, Sport.id == Event.sportId)
+			).where(Event.id > self.lastEventId).order_by(Event.id)
+		).fetchall()
+		if not rows:
+			return [], self.lastEventId
+		lastEventId = rows[-1][0]
+		with self._lock:
+			local = set(self._localEvents)
+		createdEvents = [
+			dict(
+				id=eventId, name=name, startTime=str(startTime), sportId=sportId,
+				sportName=sportName, markets=[],
+			)
+			for eventId, name, startTime, sportId, sportName in rows
+			if eventId not in local
+		]
+		if not createdEvents:
+			return [], lastEventId
+
+		byId = dict((created['id'], created) for created in createdEvents)
+		markets = {}
+		for marketId, eventId, marketName, selId, selName, odds in connection.execute(
+			db.select([
+				Market.id, Market.eventId, Market.name, Selection.id, Selection.name, Selection.odds,
+			]).select_from(
+				Market.__table__.outerjoin(Selection.__table__, Selection.marketId == Market.id)
+			).where(Market.eventId.between(min(byId), max(byId))).order_by(Market.id, Selection.id)
+		):
+			if eventId not in byId:
+				continue
+			if marketId not in markets:
+				markets[marketId] = dict(id=marketId, name=marketName, selections=[])
+				byId[eventId]['markets'].append(markets[marketId])
+			if selId is not None:
+				markets[marketId]['selections'].append(dict(id=selId, name=selName, odds=odds))
+		return createdEvents, lastEventId
+
+	def _resync(self, connection):
+		"""Drops the whole in process state and follows on from the current position"""
+		cache = self.app.extensions.get('documentCache')
+		if cache is not None:
+			cache.clear()
+		boards = self.app.extensions.get('boards')
+		if boards is not None:
+			boards.clear()
+		self._position(connection)
+		with self._lock:
+			self._localSeqs = []
+			self._localEvents = set()
@@ -0,0 +1,160 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module maintains the odds history of the selections and serves it as
+downsampled series. Every tick is kept along with a per minute rollup, buckets of
+a minute or more are aggregated from the rollup (last, min and max odds) so a
+chart over days of ticks reads a few thousand rows whatever the tick rate.
+author: supratim.ghosh1@gmail.com
+"""
+from sqlalchemy import func, and_, text
+from collections import OrderedDict
+import time
+
+from app import db
+from app.models import OddsHistory, OddsRollup, Selection
+
+MINUTE = 60 * 1000
+
+# Folds a tick into the rollup row of its minute (sqlite upsert)
+ROLLUP_UPSERT = text(
+	'INSERT INTO odds_rollup ("selectionId", minute, last, low, high, ticks) '
+	'VALUES (:selectionId, :minute, :odds, :odds, :odds, 1) '
+	'ON CONFLICT ("selectionId", minute) DO UPDATE SET last = excluded.last, '
+	'low = min(low, excluded.low), high = max(high, excluded.high), ticks = ticks + 1'
+)
+
+# Rebuilds the rollup row of a minute from its ticks, for the minutes where a tick
+# replaced one of the same millisecond whose price cannot be folded out
+ROLLUP_REBUILD = text(
+	'REPLACE INTO odds_rollup ("selectionId", minute, last, low, high, ticks) '
+	'SELECT "selectionId", :minute, (SELECT odds FROM odds_history AS closing '
+	'WHERE closing."selectionId" = :selectionId AND closing.ts >= :start AND closing.ts < :end '
+	'ORDER BY closing.ts DESC LIMIT 1), min(odds), max(odds), count(*) FROM odds_history '
+	'WHERE "selectionId" = :selectionId AND ts >= :start AND ts < :end GROUP BY "selectionId"'
+)
+
+# Keeps the IN (...) lists below the sqlite host parameter limit
+CHUNK_SIZE = 500
+
+
+def nowMs():
+	"""Returns the current time as milliseconds since the epoch"""
+	return int(time.time() * 1000)
+
+
+def recordHistory(odds, ts=None, connection=None):
+	"""Appends the prices to the history and its rollup within the current
+	transaction, a later price of a selection within the same millisecond
+	replaces the earlier one
+
+	@param list odds: (selection id, odds) pairs
+	@param int ts: milliseconds since the epoch (optional, defaults to now)
+	@param Connection connection: connection to write with (optional, defaults
+	to the session)
+	"""
+	if not odds:
+		return
+	ts = nowMs() if ts is None else ts
+	executor = db.session if connection is None else connection
+	latest = OrderedDict(odds)
+	selectionIds = list(latest)
+	replaced = set()
+	for index in range(0, len(selectionIds), CHUNK_SIZE):
+		replaced.update(selId for selId, in executor.execute(
+			db.select([OddsHistory.selectionId]).where(and_(
+				OddsHistory.selectionId.in_(selectionIds[index:index + CHUNK_SIZE]),
+				OddsHistory.ts == ts,
+			))
+		))
+	ticks = [dict(selectionId=selId, ts=ts, odds=value) for selId, value in latest.items()]
+	executor.execute(
+		OddsHistory.__table__.insert().prefix_with('OR REPLACE', dialect='sqlite'), ticks
+	)
+
+	minute = ts // MINUTE
+	added = [dict(tick, minute=minute) for tick in ticks if tick['selectionId'] not in replaced]
+	if added:
+		executor.execute(ROLLUP_UPSERT, added)
+	if replaced:
+		executor.execute(ROLLUP_REBUILD, [
+			dict(selectionId=selId, minute=minute, start=minute * MINUTE, end=(minute + 1) * MINUTE)
+			for selId in replaced
+		])
+
+
+def bucketWindow(start, end, bucket, maxPoints):
+	"""Returns the window and bucket width a series is computed over: the bucket is
+	at least the requested one but wide enough for the window to fit in about
+	maxPoints buckets, buckets of a minute or more are whole minutes and their
+	window is widened to whole minutes so they can be read from the rollup
+
+	@param int start: window start in milliseconds
+	@param int end: window end in milliseconds
+	@param int bucket: requested bucket width in milliseconds (0 for automatic)
+	@param int maxPoints: maximum number of buckets of a series
+	@return tuple: (start, end, bucket) in milliseconds
+	"""
+	bucket = max(bucket, -(-(end - start) // maxPoints), 1)
+	if bucket >= MINUTE:
+		bucket = -(-bucket // MINUTE) * MINUTE
+		start -= start % MINUTE
+		end = -(-end // MINUTE) * MINUTE
+	return start, end, bucket
+
+
+def series(selectionIds, start, end, bucket):
+	"""Returns the downsampled price series of the selections over [start, end)
+
+	@param list selectionIds: ids of the selections
+	@param int start: window start in milliseconds
+	@param int end: window end in milliseconds
+	@param int bucket: bucket width in milliseconds (as returned by bucketWindow)
+	@return dict: selection id to a list of buckets ordered by time, each a dict
+	with the bucket start time (t), the last, min and max odds and the tick count
+	"""
+	if bucket % MINUTE == 0 and start % MINUTE == 0 and end % MINUTE == 0:
+		table = OddsRollup.__table__
+		column, unit, closing = table.c.minute, MINUTE, table.c.last
+		low, high, ticks = func.min(table.c.low), func.max(table.c.high), func.sum(table.c.ticks)
+	else:
+		table = OddsHistory.__table__
+		column, unit, closing = table.c.ts, 1, table.c.odds
+		low, high, ticks = func.min(table.c.odds), func.max(table.c.odds), func.count()
+
+	slot = (column - start // unit) / (bucket // unit)
+	buckets = db.select([
+		table.c.selectionId,
+		slot.label('slot'),
+		low.label('low'),
+		high.label('high'),
+		func.max(column).label('lastTime'),
+		ticks.label('ticks'),
+	]).where(and_(
+		table.c.selectionId.in_(selectionIds),
+		column >= start // unit,
+		column < end // unit,
+	)).group_by(table.c.selectionId, slot).alias('buckets')
+
+	# The closing price of each bucket is a primary key lookup of its last row
+	last = table.alias('last')
+	query = db.select([
+		buckets.c.selectionId, buckets.c.slot, last.c[closing.name],
+		buckets.c.low, buckets.c.high, buckets.c.ticks,
+	]).select_from(buckets.join(last, and_(
+		last.c.selectionId == buckets.c.selectionId,
+		last.c[column.name] == buckets.c.lastTime,
+	))).order_by(buckets.c.selectionId, buckets.c.slot)
+
+	result = dict((selId, []) for selId in selectionIds)
+	for selId, slot, closing, low, high, ticks in db.session.execute(query):
+		result[selId].append(dict(
+			t=start + slot * bucket, last=closing, min=low, max=high, ticks=ticks
+		))
+	return result
+
+
+def marketSelections(marketId):
+	"""Returns the (id, name) of the selections of a market ordered by id"""
+	return db.session.query(Selection.id, Selection.name).filter(
+		Selection.marketId == marketId
+	).order_by(Selection.id).all()
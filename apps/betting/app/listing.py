@@ -0,0 +1,137 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module builds the paged event listings. Pages are fetched with keyset
+(cursor) pagination on the listing ordering so that each page is an index range
+scan whatever its depth, and only the requested columns are selected.
+author: supratim.ghosh1@gmail.com
+"""
+from sqlalchemy import and_, or_, desc
+from datetime import datetime
+import base64
+import json
+
+from app import db
+from app.models import Event
+
+# Columns a listing can be projected on
+FIELDS = {'id': Event.id, 'name': Event.name, 'startTime': Event.startTime}
+
+# Supported orderings as (column, descending), the id breaks the ties
+ORDERINGS = {'name': (Event.name, False), 'startTime': (Event.startTime, True)}
+
+CURSOR_TIME_FORMATS = ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S')
+
+TEXT_TYPES = (str, type(u''))
+
+
+def encodeCursor(value, eventId):
+	"""Returns the opaque cursor pointing after the (value, id) of a row"""
+	raw = json.dumps([str(value) if isinstance(value, datetime) else value, eventId])
+	return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decodeCursor(cursor, ordering):
+	"""Reads back a cursor, raises ValueError when it is not a valid one
+
+	@param str cursor: cursor as returned by encodeCursor
+	@param str ordering: listing ordering the cursor was issued for
+	@return tuple: (sort value, event id)
+	"""
+	try:
+		value, eventId = json.loads(base64.urlsafe_b64decode(str(cursor)).decode('utf-8'))
+	except (TypeError, ValueError):
+		raise ValueError('Invalid cursor %s' % cursor)
+	if not isinstance(eventId, int):
+		raise ValueError('Invalid cursor %s' % cursor)
+	# Both sort columns are nullable, a null sort value is a valid position
+	if value is not None and not isinstance(value, TEXT_TYPES):
+		raise ValueError('Invalid cursor %s' % cursor)
+	if ordering == 'startTime' and value is not None:
+		for timeFormat in CURSOR_TIME_FORMATS:
+			try:
+				return datetime.strptime(value, timeFormat), eventId
+			except ValueError:
+				pass
+		raise ValueError('Invalid cursor %s' % cursor)
+	return value, eventId
+
+
+def afterCriterion(sortColumn, descending, value, lastId):
+	"""Returns the clause selecting the rows after (value, lastId) in the listing
+	ordering among the rows sharing the nullness of value, see pageRows for how
+	the listing moves on to the others.
+
+	@param Column sortColumn: column of the ordering
+	@param bool descending: whether the ordering is descending
+	@param value: sort value of the last row returned, may be None
+	@param int lastId: event id of the last row returned
+	@return clause: filter clause
+	"""
+	if value is None:
+		return and_(sortColumn.is_(None), Event.id < lastId if descending else Event.id > lastId)
+	# Written as a range on the sort column first so the index seeks to it
+	if descending:
+		return and_(sortColumn <= value, or_(sortColumn < value, Event.id < lastId))
+	return and_(sortColumn >= value, or_(sortColumn > value, Event.id > lastId))
+
+
+def ordered(query, sortColumn, descending):
+	"""Returns the query sorted in the listing ordering, the id breaks the ties"""
+	if descending:
+		return query.order_by(desc(sortColumn), desc(Event.id))
+	return query.order_by(sortColumn, Event.id)
+
+
+def pageRows(criteria, ordering, fields, limit, after=None):
+	"""Returns one page of events matching the criteria as rows. Sqlite sorts the
+	nulls first ascending and last descending: a page after a cursor reads the
+	rows on the same side of them and, when those run out, tops up with a query
+	of the other side, so that each query stays an index range scan.
+
+	@param list criteria: filter clauses on the event table
+	@param str ordering: one of ORDERINGS
+	@param list fields: names of the FIELDS to return
+	@param int limit: maximum number of events returned
+	@param str after: cursor of the previous page (optional)
+	@return tuple: (list of (event id, sort value, *requested fields) rows, cursor
+	of the next page or None on the last page)
+	"""
+	sortColumn, descending = ORDERINGS[ordering]
+	query = db.session.query(Event.id, sortColumn, *[FIELDS[f] for f in fields])
+	query = query.filter(*criteria)
+
+	# One extra row tells if another page follows
+	if after is None:
+		rows = ordered(query, sortColumn, descending).limit(limit + 1).all()
+	else:
+		value, lastId = decodeCursor(after, ordering)
+		rows = ordered(
+			query.filter(afterCriterion(sortColumn, descending, value, lastId)),
+			sortColumn, descending
+		).limit(limit + 1).all()
+		# The nulls follow the other rows descending and precede them ascending
+		if len(rows) <= limit and (value is None) != descending:
+			rest = query.filter(sortColumn.is_(None) if descending else sortColumn.isnot(None))
+			rows += ordered(rest, sortColumn, descending).limit(limit + 1 - len(rows)).all()
+
+	nextCursor = None
+	if len(rows) > limit:
+		rows = rows[:limit]
+		nextCursor = encodeCursor(rows[-1][1], rows[-1][0])
+	return rows, nextCursor
+
+
+def listEvents(criteria, ordering, fields, limit, after=None):
+	"""Returns one page of events matching the criteria, see pageRows
+
+	@return tuple: (list of (event id, dict of the requested fields), cursor of the
+	next page or None on the last page)
+	"""
+	rows, nextCursor = pageRows(criteria, ordering, fields, limit, after)
+	events = []
+	for row in rows:
+		event = {}
+		for name, value in zip(fields, row[2:]):
+			event[name] = str(value) if name == 'startTime' else value
+		events.append((row[0], event))
+	return events, nextCursor
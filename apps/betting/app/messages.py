@@ -0,0 +1,470 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module applies the feed messages (NewEvent and UpdateOdds) received by the
+match api. Messages are validated with set based queries and written in a single
+transaction, so a batch of messages costs a handful of statements instead of a
+lookup and a commit per message.
+author: supratim.ghosh1@gmail.com
+"""
+from sqlalchemy import func, bindparam
+from datetime import datetime
+import threading
+import json
+import time
+
+try:
+	from Queue import Queue, Empty, Full
+except ImportError:
+	from queue import Queue, Empty, Full
+
+from app import db, myApp
+from app.models import Sport, Event, Market, Selection
+from app.changelog import recordChanges, lastRecordedSeq, maybePrune
+from app.history import recordHistory
+from app.push import formatEvent
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Keeps the IN (...) lists below the sqlite host parameter limit
+CHUNK_SIZE = 500
+
+# Names used to report the per status counts of a stream
+STATUS_NAMES = {201: 'created', 204: 'updated', 400: 'invalid', 404: 'notFound'}
+# Read by readLines in place of a line over its size limit
+OVERSIZED = object()
+# Ends the lines handed over by the reader thread of applyStream
+_END = object()
+
+
+def _chunks(values, size=CHUNK_SIZE):
+	values = list(values)
+	for index in range(0, len(values), size):
+		yield values[index:index + size]
+
+
+def _result(status, message=''):
+	return dict(status=status, message=message)
+
+
+def _parse(message):
+	"""Extracts what is needed from a raw message, raises for malformed ones
+
+	@param dict message: message as posted to the match api
+	@return tuple: (message type, event dict, first market dict)
+	"""
+	messageType = message['message_type']
+	event = message['event']
+	# We assume there is only one market i.e. Winning, hence the [0]
+	return messageType, event, event['markets'][0]
+
+
+def _firstMarkets(eventIds):
+	"""Maps each event id to the id of its (first) market and its sport id in one
+	query per chunk, events without any market are left out so they fail validation
+	"""
+	markets = {}
+	for chunk in _chunks(eventIds):
+		rows = db.session.query(Market.eventId, func.min(Market.id), Event.sportId).join(
+			Event, Event.id == Market.eventId
+		).filter(Market.eventId.in_(chunk)).group_by(Market.eventId, Event.sportId)
+		markets.update((eventId, (marketId, sportId)) for eventId, marketId, sportId in rows)
+	return markets
+
+
+def _selections(selectionIds):
+	"""Maps each selection id to its (market id, odds) in one query per chunk"""
+	selections = {}
+	for chunk in _chunks(selectionIds):
+		rows = db.session.query(Selection.id, Selection.marketId, Selection.odds).filter(
+			Selection.id.in_(chunk)
+		)
+		selections.update((selId, (marketId, odds)) for selId, marketId, odds in rows)
+	return selections
+
+
+def _writeOdds(newOdds):
+	"""Applies all the odds changes as one executemany UPDATE
+
+	@param dict newOdds: selection id to new odds
+	"""
+	if not newOdds:
+		return
+	table = Selection.__table__
+	statement = table.update().where(table.c.id == bindparam('_id')).values(
+		odds=bindparam('_odds')
+	)
+	db.session.execute(
+		statement,
+		[dict(_id=selId, _odds=odds) for selId, odds in newOdds.items()]
+	)
+
+
+def bumpVersions(eventSports, createdSports, connection=None):
+	"""Bumps the version of the events whose odds changed and the aggregate version
+	of the sports that got new events. The sport listings carry no odds, an odds
+	change leaves them and so the version of their sport as they are.
+
+	@param dict eventSports: ids of the events whose odds changed to their sport id
+	@param set createdSports: ids of the sports new events were added to
+	@param Connection connection: connection to write with (optional, defaults
+	to the session)
+	"""
+	executor = db.session if connection is None else connection
+	for chunk in _chunks(eventSports):
+		executor.execute(
+			Event.__table__.update().where(Event.id.in_(chunk))
+			.values(version=Event.version + 1)
+		)
+	for chunk in _chunks(createdSports):
+		executor.execute(
+			Sport.__table__.update().where(Sport.id.in_(chunk))
+			.values(version=Sport.version + 1)
+		)
+
+
+def _invalidate(changedEvents, createdEvents):
+	"""Drops the cached documents affected by a committed batch
+
+	@param iterable changedEvents: ids of the events whose odds changed
+	@param list createdEvents: dicts describing the created events
+	"""
+	cache = myApp.extensions.get('documentCache')
+	if cache is None:
+		return
+	for eventId in changedEvents:
+		cache.invalidate('match', eventId)
+	for created in createdEvents:
+		cache.invalidate('sport', Sport.normalizeName(created['sportName']))
+		cache.invalidate('name', created['name'])
+
+
+def _publish(newOdds, oddsEvents, eventSports, createdEvents):
+	"""Pushes a committed batch to the server sent events subscribers, one event
+	per match whose odds changed and one per created match
+
+	@param dict newOdds: selection id to its new odds
+	@param dict oddsEvents: selection id to its event id
+	@param dict eventSports: event id to its sport id
+	@param list createdEvents: dicts describing the created events
+	"""
+	broker = myApp.extensions.get('pushBroker')
+	if broker is None or not broker.hasSubscribers():
+		return
+	byEvent = {}
+	for selId, odds in newOdds.items():
+		byEvent.setdefault(oddsEvents[selId], []).append(dict(id=selId, odds=odds))
+	for eventId, selections in byEvent.items():
+		broker.publish(
+			[('event', eventId), ('sport', eventSports[eventId])],
+			formatEvent('UpdateOdds', dict(eventId=eventId, selections=selections))
+		)
+	for created in createdEvents:
+		broker.publish(
+			[('sport', created['sportId'])],
+			formatEvent('NewEvent', dict(
+				(k, created[k]) for k in ('id', 'name', 'startTime', 'sportId')
+			))
+		)
+
+
+def applyCommitted(newOdds, oddsEvents, eventSports, createdEvents):
+	"""Brings the in process state (cached documents, boards and push subscribers)
+	up to date with a committed batch, written by this process or another one
+
+	@param dict newOdds: selection id to its new odds
+	@param dict oddsEvents: selection id to its event id
+	@param dict eventSports: event id to its sport id
+	@param list createdEvents: dicts describing the created events
+	"""
+	_invalidate(eventSports, createdEvents)
+	boards = myApp.extensions.get('boards')
+	if boards is not None:
+		boards.apply(newOdds, oddsEvents, eventSports, createdEvents)
+	_publish(newOdds, oddsEvents, eventSports, createdEvents)
+
+
+def applyMessages(messages):
+	"""Validates and applies a list of messages in a single transaction, on the
+	serialized writer thread when the application has one (see _applyMessages).
+
+	@param list messages: list of message dicts as posted to the match api
+	@return list: one result dict per message
+	"""
+	writer = myApp.extensions.get('serialWriter')
+	if writer is None:
+		return _applyMessages(messages)
+	return writer.submit(_applyMessages, messages)
+
+
+def _applyMessages(messages):
+	"""Validates and applies a list of messages in a single transaction.
+	Message types handled are as below:
+	 - NewEvent: A complete new sporting event is being created.
+	 - UpdateOdds: There is an update for the odds field (all the other fields
+	remain unchanged), later messages for a selection win over earlier ones.
+
+	@param list messages: list of message dicts as posted to the match api
+	@return list: one result dict per message (in the same order) with the http
+	status code and message describing its outcome
+	"""
+	results = [None] * len(messages)
+	parsed = []
+	for index, message in enumerate(messages):
+		try:
+			parsed.append((index,) + _parse(message))
+		except (KeyError, IndexError, TypeError):
+			results[index] = _result(400, 'Bad request')
+
+	newEvents = [p for p in parsed if p[1] == 'NewEvent']
+	oddsUpdates = [p for p in parsed if p[1] == 'UpdateOdds']
+	for index, messageType, _, _ in parsed:
+		if messageType not in ('NewEvent', 'UpdateOdds'):
+			myApp.logger.error('Message type %s is not valid', messageType)
+			results[index] = _result(400, 'Bad request')
+
+	createdEvents = []
+	createdSelections = []
+	follower = myApp.extensions.get('changeFollower')
+	marked = None
+	try:
+		sports = {}
+		sportIds = set()
+		for index, _, event, _ in newEvents:
+			try:
+				sportIds.add(event['sport']['id'])
+			except (KeyError, TypeError):
+				results[index] = _result(400, 'Bad request')
+		for chunk in _chunks(sportIds):
+			sports.update((s.id, s) for s in Sport.query.filter(Sport.id.in_(chunk)))
+
+		# Block that handles creation of new match records (asumes a valid sport
+		# is available and supplied in the event data)
+		for index, _, event, market in newEvents:
+			if results[index] is not None:
+				continue
+			sport = sports.get(event['sport']['id'])
+			if sport is None:
+				results[index] = _result(404, 'Sport not found')
+				continue
+			# Read every field before building the models, a half built event would
+			# otherwise be cascaded into the session through its sport
+			try:
+				startTime = datetime.strptime(event['startTime'], TIME_FORMAT)
+				fields = (event['name'], market['name'])
+				selFields = [(sel['name'], sel['odds']) for sel in market['selections']]
+			except (KeyError, TypeError, ValueError):
+				results[index] = _result(400, 'Bad request')
+				continue
+			newEvent = Event(name=fields[0], startTime=startTime, sport=sport)
+			# Create the market, assuming an instance of market is unique to an event
+			newMarket = Market(name=fields[1], event=newEvent)
+			# Create the initial set of selections w/o restricting collection length
+			for selName, odds in selFields:
+				selection = Selection(name=selName, odds=odds, market=newMarket)
+				db.session.add(selection)
+				createdSelections.append(selection)
+			createdEvents.append((newEvent, dict(
+				name=fields[0],
+				startTime=str(startTime),
+				sportId=sport.id,
+				sportName=sport.name,
+			)))
+			results[index] = _result(201, 'Event created')
+			myApp.logger.info('New event %s created', newEvent.name)
+
+		# Block that handles update odds (only) requests, ensures no other fields
+		# are updated. The event, its market and the selections are all resolved
+		# upfront so that every message is validated without further queries.
+		requested = []
+		for index, _, event, market in oddsUpdates:
+			try:
+				requested.append((
+					index,
+					event['id'],
+					[(sel['id'], sel['odds']) for sel in market['selections']]
+				))
+			except (KeyError, TypeError):
+				results[index] = _result(400, 'Bad request')
+
+		markets = _firstMarkets(set(eventId for _, eventId, _ in requested))
+		selections = _selections(set(
+			selId for _, _, pairs in requested for selId, _ in pairs
+		))
+
+		newOdds = {}
+		oddsEvents = {}
+		eventSports = {}
+		for index, eventId, pairs in requested:
+			if eventId not in markets:
+				results[index] = _result(404, 'Event not found')
+				continue
+			marketId, sportId = markets[eventId]
+			for selId, odds in pairs:
+				marketAndOdds = selections.get(selId)
+				# Check if None to get 0.0 pass in as valid
+				if marketAndOdds is None or marketAndOdds[0] != marketId or odds is None:
+					continue
+				if odds != newOdds.get(selId, marketAndOdds[1]):
+					newOdds[selId] = odds
+					oddsEvents[selId] = eventId
+					eventSports[eventId] = sportId
+			results[index] = _result(204)
+
+		# Flush to get the ids of the new events before the commit expires them
+		db.session.flush()
+		for newEvent, created in createdEvents:
+			created['id'] = newEvent.id
+			created['markets'] = [m.asDict() for m in newEvent.markets]
+		createdEvents = [created for _, created in createdEvents]
+
+		_writeOdds(newOdds)
+		bumpVersions(eventSports, set(c['sportId'] for c in createdEvents))
+		recordChanges([
+			(selId, oddsEvents[selId], eventSports[oddsEvents[selId]], odds)
+			for selId, odds in newOdds.items()
+		])
+		if follower is not None:
+			# Marked before the commit so the follower never takes them for the
+			# writes of another process, they are applied below
+			marked = (
+				lastRecordedSeq() if newOdds else None,
+				len(newOdds),
+				[created['id'] for created in createdEvents]
+			)
+			follower.markLocal(*marked)
+		# The opening prices of the new selections start their history
+		recordHistory(list(newOdds.items()) + [
+			(s.id, s.odds) for s in createdSelections if s.odds is not None
+		])
+		db.session.commit()
+	except Exception:
+		db.session.rollback()
+		if marked is not None:
+			# The sequence numbers and ids go to the next writer, maybe another process
+			follower.unmarkLocal(*marked)
+		raise
+
+	applyCommitted(newOdds, oddsEvents, eventSports, createdEvents)
+	if newOdds:
+		maybePrune(myApp.config)
+	myApp.logger.debug('%d selections updated', len(newOdds))
+	return results
+
+
+def readLines(readline, maxLineSize):
+	"""Yields the lines read with readline, at most maxLineSize bytes (newline
+	included) are read at once: a longer line is read up to its end, dropped, and
+	yields OVERSIZED instead
+
+	@param callable readline: reads a line of at most the bytes given
+	@param int maxLineSize: maximum size of a line in bytes
+	"""
+	while True:
+		line = readline(maxLineSize)
+		if not line:
+			return
+		if len(line) < maxLineSize or line.endswith(b'\n'):
+			yield line
+			continue
+		rest = readline(maxLineSize)
+		if not rest:
+			# The last line, without a newline, of exactly maxLineSize bytes
+			yield line
+			return
+		while rest and not rest.endswith(b'\n'):
+			rest = readline(maxLineSize)
+		yield OVERSIZED
+
+
+def _feed(lines, queue, stopped):
+	"""Hands over the lines to applyStream through queue, on the reader thread"""
+	def handOver(item):
+		while not stopped.is_set():
+			try:
+				queue.put(item, timeout=0.1)
+				return True
+			except Full:
+				# applyStream is busy committing
+				continue
+		return False
+
+	try:
+		for line in lines:
+			if not handOver(line):
+				return
+		handOver(_END)
+	except Exception as error:
+		handOver(error)
+
+
+def applyStream(lines, batchSize, batchInterval):
+	"""Parses and applies newline delimited json messages as they are read. Messages
+	are committed in micro batches of at most batchSize messages, or sooner once
+	batchInterval seconds went by since the first one of the batch arrived, and
+	only counters are kept so memory stays flat however long the stream is.
+	The lines are read on a separate thread so a partial batch is committed on
+	time even while the client is idle.
+
+	@param iterable lines: raw lines (bytes) of the stream, one message per line,
+	OVERSIZED for a line over the size limit (see readLines)
+	@param int batchSize: maximum number of messages committed together
+	@param float batchInterval: maximum seconds a message waits to be committed
+	@return dict: number of messages received, batches committed and a count of
+	messages per outcome
+	"""
+	summary = dict(received=0, batches=0)
+	summary.update((name, 0) for name in STATUS_NAMES.values())
+	started = time.time()
+	batch = []
+	deadline = None
+
+	def commit(batch):
+		for result in applyMessages(batch):
+			summary[STATUS_NAMES[result['status']]] += 1
+		summary['batches'] += 1
+
+	queue = Queue(batchSize)
+	stopped = threading.Event()
+	reader = threading.Thread(target=_feed, args=(lines, queue, stopped), name='stream-reader')
+	reader.daemon = True
+	reader.start()
+	try:
+		while True:
+			try:
+				line = queue.get(timeout=max(0, deadline - time.time()) if batch else None)
+			except Empty:
+				commit(batch)
+				batch = []
+				continue
+			if line is _END:
+				break
+			if isinstance(line, Exception):
+				raise line
+
+			if line is OVERSIZED:
+				summary['received'] += 1
+				summary['invalid'] += 1
+				continue
+			line = line.strip()
+			if not line:
+				continue
+			summary['received'] += 1
+			try:
+				batch.append(json.loads(line.decode('utf-8')))
+			except ValueError:
+				summary['invalid'] += 1
+				continue
+
+			if len(batch) == 1:
+				deadline = time.time() + batchInterval
+			if len(batch) >= batchSize:
+				commit(batch)
+				batch = []
+	finally:
+		# Lets the reader go when a commit failed
+		stopped.set()
+
+	if batch:
+		commit(batch)
+	summary['seconds'] = round(time.time() - started, 3)
+	return summary
@@ -0,0 +1,244 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module instruments the requests served: per route latency, sql statements
+and time, and payload size histograms, plus the document cache counters, all
+rendered in the prometheus text format. A sample of the requests can also be
+profiled, the profiles of the ones slower than a threshold are dumped to files
+readable with pstats.
+author: supratim.ghosh1@gmail.com
+"""
+from sqlalchemy import event as sqlEvent
+from sqlalchemy.engine import Engine
+from flask import request
+import threading
+import cProfile
+import bisect
+import random
+import time
+import os
+
+# Upper bounds of the histogram buckets (prometheus le labels)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# The request being served by the current thread (greenlet under gevent)
+_current = threading.local()
+
+
+class Histogram(object):
+	"""Counts of observations per bucket along with their sum, not thread safe on
+	its own, Metrics serializes the updates.
+
+	:param tuple buckets: sorted upper bounds of the buckets
+	"""
+
+	def __init__(self, buckets):
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1)
+		self.sum = 0
+		self.count = 0
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+
+	def render(self, name, labels):
+		"""Returns the lines of the histogram, buckets are cumulative"""
+		lines = []
+		cumulative = 0
+		for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+			cumulative += count
+			lines.append('%s_bucket{%sle="%s"} %d' % (name, labels, bound, cumulative))
+		lines.append('%s_sum{%s} %r' % (name, labels.rstrip(','), float(self.sum)))
+		lines.append('%s_count{%s} %d' % (name, labels.rstrip(','), self.count))
+		return lines
+
+
+class RequestStats(object):
+	"""What is measured while one request is served"""
+
+	def __init__(self):
+		self.started = time.time()
+		self.statements = 0
+		self.sqlTime = 0.0
+		self.profiler = None
+		self.recorded = False
+
+
+def requestStats():
+	"""Returns the RequestStats of the request served by the current thread"""
+	return getattr(_current, 'stats', None)
+
+
+def setRequestStats(stats):
+	"""Attributes the statements of the current thread to a request, e.g. for a
+	thread running writes on behalf of the request threads
+	"""
+	_current.stats = stats
+
+
+@sqlEvent.listens_for(Engine, 'before_cursor_execute')
+def _startStatement(conn, cursor, statement, parameters, context, executemany):
+	conn.info['metricsStarted'] = time.time()
+
+
+@sqlEvent.listens_for(Engine, 'after_cursor_execute')
+def _endStatement(conn, cursor, statement, parameters, context, executemany):
+	_countStatement(conn)
+
+
+@sqlEvent.listens_for(Engine, 'handle_error')
+def _failStatement(context):
+	# A failed statement skips after_cursor_execute, it is counted all the same.
+	# The failures before the execution or while fetching find no start time.
+	conn = context.connection
+	if conn is not None and not conn.closed and not conn.invalidated:
+		_countStatement(conn)
+
+
+def _countStatement(conn):
+	started = conn.info.pop('metricsStarted', None)
+	if started is None:
+		return
+	stats = getattr(_current, 'stats', None)
+	if stats is not None:
+		stats.statements += 1
+		stats.sqlTime += time.time() - started
+
+
+class Metrics(object):
+	"""Registry of the request metrics of an application, see install"""
+
+	def __init__(self):
+		self._routes = {}
+		self._requests = {}
+		self._lock = threading.Lock()
+
+	def install(self, app):
+		"""Hooks the measurements into the request handling of app"""
+		self.app = app
+		app.before_request(self._before)
+		app.after_request(self._after)
+		app.teardown_request(self._teardown)
+		return self
+
+	def clear(self):
+		with self._lock:
+			self._routes.clear()
+			self._requests.clear()
+
+	def observe(self, route, method, status, seconds, statements, sqlTime, size=None):
+		"""Records a request served
+
+		@param str route: url rule of the request
+		@param str method: http method
+		@param int status: http status of the response
+		@param float seconds: time spent serving the request
+		@param int statements: number of sql statements executed
+		@param float sqlTime: seconds spent executing them
+		@param int size: size of the body in bytes, None when streamed
+		"""
+		with self._lock:
+			histograms = self._routes.get(route)
+			if histograms is None:
+				histograms = self._routes[route] = dict(
+					latency=Histogram(LATENCY_BUCKETS),
+					statements=Histogram(STATEMENT_BUCKETS),
+					sqlTime=Histogram(LATENCY_BUCKETS),
+					size=Histogram(SIZE_BUCKETS),
+				)
+			histograms['latency'].observe(seconds)
+			histograms['statements'].observe(statements)
+			histograms['sqlTime'].observe(sqlTime)
+			if size is not None:
+				histograms['size'].observe(size)
+			key = (route, method, status)
+			self._requests[key] = self._requests.get(key, 0) + 1
+
+	def render(self):
+		"""Returns the metrics in the prometheus text exposition format"""
+		lines = [
+			'# HELP betting_http_requests_total Requests served.',
+			'# TYPE betting_http_requests_total counter',
+		]
+		with self._lock:
+			for (route, method, status), count in sorted(self._requests.items()):
+				lines.append('betting_http_requests_total{route="%s",method="%s",status="%d"} %d' % (
+					escapeLabel(route), method, status, count
+				))
+			for name, key, description in (
+				('betting_http_request_duration_seconds', 'latency', 'Time spent serving a request.'),
+				('betting_sql_statements_per_request', 'statements', 'Sql statements run by a request.'),
+				('betting_sql_duration_seconds', 'sqlTime', 'Time a request spent running sql.'),
+				('betting_http_response_size_bytes', 'size', 'Size of the response bodies.'),
+			):
+				lines.append('# HELP %s %s' % (name, description))
+				lines.append('# TYPE %s histogram' % name)
+				for route, histograms in sorted(self._routes.items()):
+					lines.extend(histograms[key].render(name, 'route="%s",' % escapeLabel(route)))
+
+		cache = self.app.extensions.get('documentCache')
+		if cache is not None:
+			stats = cache.stats()
+			lookups = stats['hits'] + stats['misses']
+			for name, kind, value in (
+				('betting_document_cache_hits_total', 'counter', stats['hits']),
+				('betting_document_cache_misses_total', 'counter', stats['misses']),
+				('betting_document_cache_entries', 'gauge', stats['size']),
+				('betting_document_cache_hit_ratio', 'gauge',
+					float(stats['hits']) / lookups if lookups else 0.0),
+			):
+				lines.append('# TYPE %s %s' % (name, kind))
+				lines.append('%s %r' % (name, value))
+		return '\n'.join(lines) + '\n'
+
+	def _before(self):
+		stats = _current.stats = RequestStats()
+		rate = self.app.config['PROFILE_SAMPLE_RATE']
+		if rate and random.random() < rate:
+			stats.profiler = cProfile.Profile()
+			stats.profiler.enable()
+
+	def _after(self, response):
+		stats = getattr(_current, 'stats', None)
+		if stats is not None:
+			# None for the streamed responses, the size is not known upfront
+			self._record(stats, response.status_code, response.content_length)
+		return response
+
+	def _teardown(self, exception):
+		stats = getattr(_current, 'stats', None)
+		_current.stats = None
+		if stats is not None and not stats.recorded:
+			# Failed with an unhandled exception, after_request was skipped
+			self._record(stats, 500, None)
+
+	def _record(self, stats, status, size):
+		elapsed = time.time() - stats.started
+		stats.recorded = True
+		rule = request.url_rule
+		route = rule.rule if rule is not None else 'unmatched'
+		self.observe(route, request.method, status, elapsed, stats.statements, stats.sqlTime, size)
+		if stats.profiler is not None:
+			stats.profiler.disable()
+			if elapsed >= self.app.config['PROFILE_THRESHOLD']:
+				self._dump(stats.profiler, request.endpoint or 'unmatched')
+
+	def _dump(self, profiler, endpoint):
+		directory = self.app.config['PROFILE_DIR']
+		try:
+			os.makedirs(directory)
+		except OSError:
+			if not os.path.isdir(directory):
+				raise
+		path = os.path.join(directory, '%s-%d-%d.prof' % (
+			endpoint, int(time.time() * 1000), threading.current_thread().ident
+		))
+		profiler.dump_stats(path)
+		self.app.logger.info('Profile of a slow %s request written to %s', endpoint, path)
+
+
+def escapeLabel(value):
+	return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -4,6 +4,8 @@
 between various models and sqlite to facilitate storage.
 author: supratim.ghosh1@gmail.com
 """
+from sqlalchemy.orm import joinedload, validates
+
 from app import db
 
 
@@ -16,6 +18,25 @@ class Sport(db.Model):
 
 	id = db.Column(db.Integer, primary_key=True)
 	name = db.Column(db.String(60), index=True, unique=True)
+	# Lower cased name kept in sync with name, looked up by the apis instead of
+	# lower(name) which cannot use an index
+	nameKey = db.Column(db.String(60), index=True, unique=True)
+	# Bumped when events are added to the sport, its listings carry no odds
+	version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+	@staticmethod
+	def normalizeName(name):
+		return name.lower()
+
+	@classmethod
+	def byName(cls, name):
+		"""Returns a query for the sport with the given name, whatever its case"""
+		return cls.query.filter_by(nameKey=cls.normalizeName(name))
+
+	@validates('name')
+	def _setNameKey(self, key, name):
+		self.nameKey = self.normalizeName(name) if name is not None else None
+		return name
 
 	def asDict(self):
 		return dict(id=self.id, name=self.name)
@@ -29,13 +50,33 @@ class Event(db.Model):
 	with the sport table.
 	"""
 	__tablename__ = 'event'
+	# Back the sport listings, filtered on the sport and ordered by time or name
+	__table_args__ = (
+		db.Index('ix_event_sport_start', 'sportId', 'startTime'),
+		db.Index('ix_event_sport_name', 'sportId', 'name'),
+	)
 
 	id = db.Column(db.Integer, primary_key=True)
 	name = db.Column(db.String(250), index=True)
 	startTime = db.Column(db.DateTime)
 	sportId = db.Column(db.Integer, db.ForeignKey('sport.id'))
+	# Bumped every time the odds of one of its selections change
+	version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 	sport = db.relationship(Sport, backref=db.backref('events', uselist=True))
 
+	@classmethod
+	def queryTree(cls):
+		"""Returns an event query that loads the sport, markets and selections along
+		with the event in a single round trip, so that asDict(skipRelations=False)
+		is served from the identity map and never triggers a lazy load.
+
+		:return Query: event query with the eager loading options applied
+		"""
+		return cls.query.options(
+			joinedload(cls.sport),
+			joinedload(cls.markets).joinedload(Market.selections),
+		)
+
 	def asDict(self, skipRelations=True):
 		"""Returns a dictionary with event data
 
@@ -48,7 +89,7 @@ class Event(db.Model):
 			eventDict.update(
 				dict(
 					sport=self.sport.asDict(),
-					markets=map(lambda m:m.asDict(), self.markets),
+					markets=[m.asDict() for m in self.markets],
 				)
 			)
 		return eventDict
@@ -69,14 +110,14 @@ class Market(db.Model):
 
 	id = db.Column(db.Integer, primary_key=True)
 	name = db.Column(db.String(60), index=True)
-	eventId = db.Column(db.Integer, db.ForeignKey('event.id'))
+	eventId = db.Column(db.Integer, db.ForeignKey('event.id'), index=True)
 	event = db.relationship(Event, backref=db.backref('markets', uselist=True))
 
 	def asDict(self):
 		return dict(
 			id=self.id,
 			name=self.name,
-			selections=map(lambda s:s.asDict(), self.selections)
+			selections=[s.asDict() for s in self.selections]
 		)
 
 	def __repr__(self):
@@ -96,7 +137,7 @@ class Selection(db.Model):
 	id = db.Column(db.Integer, primary_key=True)
 	name = db.Column(db.String(100), index=True)
 	odds = db.Column(db.Float)
-	marketId = db.Column(db.Integer, db.ForeignKey('market.id'))
+	marketId = db.Column(db.Integer, db.ForeignKey('market.id'), index=True)
 	market = db.relationship(Market, backref=db.backref('selections', uselist=True))
 	
 	def asDict(self):
@@ -110,3 +151,68 @@ class Selection(db.Model):
 			self.market.name,
 			self.name
 		)
+
+
+class OddsChange(db.Model):
+	"""Representation of the append only log of odds changes.
+	Every odds change applied gets the next global sequence number, which clients
+	use to fetch what moved since the last change they saw. Sequence numbers are
+	never reused (sqlite autoincrement) even once old changes are pruned.
+	"""
+	__tablename__ = 'odds_change'
+	__table_args__ = (
+		db.Index('ix_odds_change_sport_seq', 'sportId', 'seq'),
+		{'sqlite_autoincrement': True},
+	)
+
+	seq = db.Column(db.Integer, primary_key=True)
+	selectionId = db.Column(db.Integer, nullable=False)
+	eventId = db.Column(db.Integer, nullable=False)
+	sportId = db.Column(db.Integer, nullable=False)
+	odds = db.Column(db.Float)
+	createdAt = db.Column(db.DateTime, index=True, nullable=False)
+
+	def asDict(self):
+		return dict(
+			seq=self.seq,
+			selectionId=self.selectionId,
+			eventId=self.eventId,
+			odds=self.odds,
+			createdAt=str(self.createdAt),
+		)
+
+	def __repr__(self):
+		return '<%s>%s>%s' % (self.__class__.__name__, self.seq, self.selectionId)
+
+
+class OddsHistory(db.Model):
+	"""Representation of the append only price history of the selections, one
+	row per odds change keyed by (selection, millisecond timestamp) so that the
+	series of a selection is a single range scan of the primary key.
+	"""
+	__tablename__ = 'odds_history'
+
+	selectionId = db.Column(db.Integer, primary_key=True, autoincrement=False)
+	ts = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+	odds = db.Column(db.Float, nullable=False)
+
+	def __repr__(self):
+		return '<%s>%s>%s' % (self.__class__.__name__, self.selectionId, self.ts)
+
+
+class OddsRollup(db.Model):
+	"""Representation of the odds history rolled up per selection and minute (since
+	the epoch), maintained as the ticks are written so that series over long
+	windows read one row per minute instead of every tick.
+	"""
+	__tablename__ = 'odds_rollup'
+
+	selectionId = db.Column(db.Integer, primary_key=True, autoincrement=False)
+	minute = db.Column(db.Integer, primary_key=True, autoincrement=False)
+	last = db.Column(db.Float, nullable=False)
+	low = db.Column(db.Float, nullable=False)
+	high = db.Column(db.Float, nullable=False)
+	ticks = db.Column(db.Integer, nullable=False)
+
+	def __repr__(self):
+		return '<%s>%s>%s' % (self.__class__.__name__, self.selectionId, self.minute)
@@ -0,0 +1,114 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module fans out the committed odds changes and new events to the clients
+subscribed to the server sent events api. Each subscriber gets a bounded buffer,
+a subscriber that falls that far behind is dropped and told so, it can then catch
+up from the delta feed and subscribe again.
+author: supratim.ghosh1@gmail.com
+"""
+import threading
+import json
+
+try:
+	from Queue import Queue, Full, Empty
+except ImportError:
+	from queue import Queue, Full, Empty
+
+# Sentinel queued for the subscribers dropped for being too slow
+DROPPED = 'event: dropped\ndata: {}\n\n'
+
+
+def formatEvent(eventType, data):
+	"""Formats a server sent event, the payload is encoded once for all subscribers"""
+	return 'event: %s\ndata: %s\n\n' % (eventType, json.dumps(data))
+
+
+class Subscriber(object):
+	"""Subscription of one client to a set of topics, e.g. ('event', 1) or
+	('sport', 2), with a buffer of at most maxBuffer pending events
+	"""
+
+	def __init__(self, topics, maxBuffer):
+		self.topics = topics
+		self.dropped = False
+		# One extra slot so that the dropped sentinel always fits
+		self._queue = Queue(maxBuffer + 1)
+		self._maxBuffer = maxBuffer
+
+	def offer(self, payload):
+		"""Buffers a payload, returns False once the subscriber is too far behind"""
+		if self._queue.qsize() >= self._maxBuffer:
+			return False
+		try:
+			self._queue.put_nowait(payload)
+		except Full:
+			return False
+		return True
+
+	def drop(self):
+		self.dropped = True
+		try:
+			self._queue.put_nowait(DROPPED)
+		except Full:
+			pass
+
+	def get(self, timeout=None):
+		"""Returns the next payload or None when nothing arrived within timeout"""
+		try:
+			return self._queue.get(timeout=timeout)
+		except Empty:
+			return None
+
+
+class Broker(object):
+	"""Keeps the subscribers per topic and publishes payloads to them.
+
+	:param int maxBuffer: pending events a subscriber may have before being dropped
+	"""
+
+	def __init__(self, maxBuffer):
+		self.maxBuffer = maxBuffer
+		self._topics = {}
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		with self._lock:
+			return len(set(s for subs in self._topics.values() for s in subs))
+
+	def subscribe(self, topics):
+		subscriber = Subscriber(list(topics), self.maxBuffer)
+		with self._lock:
+			for topic in subscriber.topics:
+				self._topics.setdefault(topic, set()).add(subscriber)
+		return subscriber
+
+	def unsubscribe(self, subscriber):
+		with self._lock:
+			for topic in subscriber.topics:
+				subscribers = self._topics.get(topic)
+				if subscribers is None:
+					continue
+				subscribers.discard(subscriber)
+				if not subscribers:
+					del self._topics[topic]
+
+	def publish(self, topics, payload):
+		"""Hands a payload to every subscriber of any of the topics (once each),
+		the subscribers whose buffer is full are dropped
+
+		:param list topics: topics the payload relates to
+		:param str payload: formatted server sent event
+		:return int: number of subscribers the payload was handed to
+		"""
+		with self._lock:
+			subscribers = set()
+			for topic in topics:
+				subscribers.update(self._topics.get(topic, ()))
+		slow = [s for s in subscribers if not s.offer(payload)]
+		for subscriber in slow:
+			self.unsubscribe(subscriber)
+			subscriber.drop()
+		return len(subscribers) - len(slow)
+
+	def hasSubscribers(self):
+		return bool(self._topics)
@@ -0,0 +1,123 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module maintains the full text index of the events (sqlite FTS5), one row
+per event holding its name and the names of its selections. New events are
+indexed as they are flushed, whatever code path created them, and searches match
+every token (the last one as a prefix) ranked by bm25.
+author: supratim.ghosh1@gmail.com
+"""
+from sqlalchemy import event as sqlEvent
+from sqlalchemy import DDL, func, literal_column
+from sqlalchemy.orm import Session
+import re
+
+from app import db
+from app.models import Event, Market, Selection
+
+# Kept out of the application metadata, create_all could not create it
+SEARCH = db.Table(
+	'event_search', db.MetaData(),
+	db.Column('rowid', db.Integer, primary_key=True),
+	db.Column('name', db.Text),
+	db.Column('selections', db.Text),
+)
+
+# Prefix indexes of 2 and 3 characters keep short prefix queries cheap
+CREATE_SEARCH = (
+	"CREATE VIRTUAL TABLE IF NOT EXISTS event_search USING fts5(name, selections, "
+	"tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+)
+
+# bm25 weights of the event name and selection names columns
+NAME_WEIGHT = 10.0
+SELECTIONS_WEIGHT = 1.0
+
+TOKEN = re.compile(r'\w+', re.UNICODE)
+
+# The index lives and dies with the event table
+sqlEvent.listen(Event.__table__, 'after_create', DDL(CREATE_SEARCH).execute_if(dialect='sqlite'))
+sqlEvent.listen(
+	Event.__table__, 'after_drop', DDL('DROP TABLE IF EXISTS event_search').execute_if(dialect='sqlite')
+)
+
+
+def indexEvents(events, connection=None):
+	"""Adds (or replaces) the index rows of events
+
+	@param list events: (event id, event name, list of selection names) tuples
+	@param Connection connection: connection to write with (optional, defaults
+	to the session)
+	"""
+	if not events:
+		return
+	executor = db.session if connection is None else connection
+	executor.execute(SEARCH.insert().prefix_with('OR REPLACE'), [
+		dict(rowid=eventId, name=name, selections=' '.join(selections))
+		for eventId, name, selections in events
+	])
+
+
+@sqlEvent.listens_for(Session, 'after_flush')
+def indexFlushedEvents(session, flushContext):
+	"""Indexes the events created by a flush, along with the events that got new
+	markets or selections, from the objects already in the session
+	"""
+	events = set()
+	for instance in session.new:
+		if isinstance(instance, Selection):
+			instance = instance.market
+		if isinstance(instance, Market):
+			instance = instance.event
+		if isinstance(instance, Event):
+			events.add(instance)
+	indexEvents([
+		(event.id, event.name, [s.name for m in event.markets for s in m.selections])
+		for event in events
+	], session)
+
+
+def rebuildIndex(connection):
+	"""Creates the index when missing and refills it from the event tables"""
+	connection.execute(CREATE_SEARCH)
+	connection.execute(SEARCH.delete())
+	connection.execute(
+		'INSERT INTO event_search (rowid, name, selections) '
+		'SELECT event.id, event.name, group_concat(selection.name, \' \') FROM event '
+		'LEFT OUTER JOIN market ON market."eventId" = event.id '
+		'LEFT OUTER JOIN selection ON selection."marketId" = market.id '
+		'GROUP BY event.id'
+	)
+
+
+def matchExpression(phrase):
+	"""Turns user input into a FTS5 query matching all of its tokens, the last
+	one as a prefix, or returns None when the input holds no token
+
+	@param str phrase: text typed by the user
+	@return str: FTS5 query
+	"""
+	tokens = TOKEN.findall(phrase)
+	if not tokens:
+		return None
+	# Quoted so that words like AND, OR or NOT are not read as operators
+	return ' '.join('"%s"' % token for token in tokens) + '*'
+
+
+def searchEvents(phrase, limit, sportId=None):
+	"""Returns the best ranked events matching a phrase
+
+	@param str phrase: text typed by the user
+	@param int limit: maximum number of events returned
+	@param int sportId: only return the events of this sport (optional)
+	@return list: (id, name, startTime) tuples, best match first
+	"""
+	expression = matchExpression(phrase)
+	if expression is None:
+		return []
+	search = literal_column(SEARCH.name)
+	query = db.session.query(Event.id, Event.name, Event.startTime).join(
+		SEARCH, SEARCH.c.rowid == Event.id
+	).filter(search.op('MATCH')(expression))
+	if sportId is not None:
+		query = query.filter(Event.sportId == sportId)
+	return query.order_by(func.bm25(search, NAME_WEIGHT, SELECTIONS_WEIGHT)).limit(limit).all()
@@ -0,0 +1,202 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module serializes the api documents straight from the rows of Core
+queries, without loading ORM instances or building intermediate dicts. Every
+document shape is compiled once into an encoder (a format template with one value
+encoder per field) and the strings are escaped by the fastest json backend
+available: ujson, then simplejson, then the standard library.
+author: supratim.ghosh1@gmail.com
+"""
+from sqlalchemy import and_
+import operator
+import math
+
+from app import db
+from app.models import Sport, Event, Market, Selection
+
+try:
+	import ujson
+
+	BACKEND = 'ujson'
+	dumps = ujson.dumps
+	encodeString = ujson.dumps
+except ImportError:
+	try:
+		import simplejson as json
+		from simplejson.encoder import encode_basestring_ascii as encodeString
+
+		BACKEND = 'simplejson'
+	except ImportError:
+		import json
+		from json.encoder import encode_basestring_ascii as encodeString
+
+		BACKEND = 'json'
+
+	def dumps(value):
+		return json.dumps(value, separators=(',', ':'))
+
+
+def encodeInt(value):
+	return 'null' if value is None else str(value)
+
+
+def encodeFloat(value):
+	if value is None:
+		return 'null'
+	value = float(value)
+	# nan and the infinities have no json literal
+	if math.isnan(value) or math.isinf(value):
+		return 'null'
+	return repr(value)
+
+
+def encodeText(value):
+	return 'null' if value is None else encodeString(value)
+
+
+def encodeTime(value):
+	# Same rendering as the asDict methods, str of the datetime
+	return encodeString(str(value))
+
+
+def encodeRaw(value):
+	"""Value already encoded, a nested object or array"""
+	return value
+
+
+class Shape(object):
+	"""Encoder of the json objects of one shape, compiled once. The keys are
+	written in sorted order, as jsonify does.
+
+	:param list fields: (name, value encoder, index of the value in the row) tuples
+	"""
+
+	def __init__(self, fields):
+		fields = sorted(fields)
+		self.names = [name for name, _, _ in fields]
+		self.template = '{%s}' % ','.join(
+			'%s:%%s' % encodeString(name).replace('%', '%%') for name in self.names
+		)
+		self.encoders = tuple(encoder for _, encoder, _ in fields)
+		indexes = [index for _, _, index in fields]
+		# itemgetter returns the value itself, not a tuple, for a single index
+		if len(indexes) == 1:
+			self.values = lambda row, index=indexes[0]: (row[index],)
+		else:
+			self.values = operator.itemgetter(*indexes)
+
+	def encode(self, row):
+		return self.template % tuple([
+			encoder(value) for encoder, value in zip(self.encoders, self.values(row))
+		])
+
+
+def encodeArray(items):
+	return '[%s]' % ','.join(items)
+
+
+SPORT = Shape([('id', encodeInt, 0), ('name', encodeText, 1)])
+SELECTION = Shape([('id', encodeInt, 0), ('name', encodeText, 1), ('odds', encodeFloat, 2)])
+MARKET = Shape([('id', encodeInt, 0), ('name', encodeText, 1), ('selections', encodeRaw, 2)])
+MATCH = Shape([
+	('id', encodeInt, 0),
+	('name', encodeText, 1),
+	('startTime', encodeTime, 2),
+	('sport', encodeRaw, 3),
+	('markets', encodeRaw, 4),
+	('url', encodeText, 5),
+])
+
+# Encoders of the listing fields, see app.listing.FIELDS
+LISTING_ENCODERS = {'id': encodeInt, 'name': encodeText, 'startTime': encodeTime}
+_listingShapes = {}
+
+
+def listingShape(fields):
+	"""Returns the shape of the listed events projected on fields, for the rows
+	of app.listing.pageRows with the url appended
+
+	@param tuple fields: names of the listing fields
+	@return Shape: compiled shape, cached per projection
+	"""
+	shape = _listingShapes.get(fields)
+	if shape is None:
+		shape = Shape(
+			[(name, LISTING_ENCODERS[name], index + 2) for index, name in enumerate(fields)] +
+			[('url', encodeText, len(fields) + 2)]
+		)
+		_listingShapes[fields] = shape
+	return shape
+
+
+def encodeListing(fields, rows, urlFor, nextCursor=None):
+	"""Returns the json document of a listing page
+
+	@param list fields: names of the listing fields
+	@param list rows: rows of app.listing.pageRows
+	@param callable urlFor: returns the url of an event given its id
+	@param str nextCursor: cursor of the next page (optional)
+	@return str: the {"matches": [...], "next": ...} document
+	"""
+	encode = listingShape(tuple(fields)).encode
+	matches = encodeArray([encode(tuple(row) + (urlFor(row[0]),)) for row in rows])
+	if nextCursor is None:
+		return '{"matches":%s}' % matches
+	return '{"matches":%s,"next":%s}' % (matches, encodeString(nextCursor))
+
+
+def matchRows(criteria):
+	"""Returns the Core statement reading the whole tree (sport, markets and
+	selections) of the events matching the criteria, ordered by event
+
+	@param list criteria: filter clauses on the event table
+	@return Select: statement whose rows encodeMatches reads
+	"""
+	return db.select([
+		Event.id, Event.name, Event.startTime, Sport.id, Sport.name,
+		Market.id, Market.name, Selection.id, Selection.name, Selection.odds,
+	]).select_from(
+		Event.__table__.join(Sport.__table__, Sport.id == Event.sportId).outerjoin(
+			Market.__table__, Market.eventId == Event.id
+		).outerjoin(Selection.__table__, Selection.marketId == Market.id)
+	).where(and_(*criteria)).order_by(Event.id, Market.id, Selection.id)
+
+
+def encodeMatches(rows, urlFor):
+	"""Encodes the rows of matchRows into one json document per event, shaped as
+	Event.asDict(skipRelations=False) plus the url of the event
+
+	@param iterable rows: rows of matchRows
+	@param callable urlFor: returns the url of an event given its id
+	@return list: json documents of the events, in the order of the rows
+	"""
+	documents = []
+	event = markets = selections = None
+	market = None
+
+	def closeMarket():
+		markets.append(MARKET.encode((market[0], market[1], encodeArray(selections))))
+
+	def closeEvent():
+		if market is not None:
+			closeMarket()
+		documents.append(MATCH.encode(
+			event + (encodeArray(markets), urlFor(event[0]))
+		))
+
+	for row in rows:
+		eventId, marketId, selId = row[0], row[5], row[7]
+		if event is None or event[0] != eventId:
+			if event is not None:
+				closeEvent()
+			event = (eventId, row[1], row[2], SPORT.encode((row[3], row[4])))
+			markets, market = [], None
+		if marketId is not None and (market is None or market[0] != marketId):
+			if market is not None:
+				closeMarket()
+			market, selections = (marketId, row[6]), []
+		if selId is not None:
+			selections.append(SELECTION.encode((selId, row[8], row[9])))
+	if event is not None:
+		closeEvent()
+	return documents
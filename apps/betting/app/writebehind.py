@@ -0,0 +1,120 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module implements the optional write behind mode for UpdateOdds messages.
+Odds are acknowledged right away and parked in memory keyed by selection id, so a
+selection that moves many times between two flushes is only written once with its
+latest odds, and a background worker applies them in batched transactions.
+author: supratim.ghosh1@gmail.com
+"""
+import threading
+
+from app.messages import applyMessages
+
+
+class QueueFull(Exception):
+	"""Raised when accepting more selections would exceed the pending limit"""
+
+
+class OddsWriteBehind(object):
+	"""Coalescing queue of pending odds flushed by a background thread.
+
+	:param flask.Flask app: application whose context the worker runs in
+	:param int maxPending: maximum number of distinct selections waiting
+	:param float interval: seconds between two flushes of the worker
+	"""
+
+	def __init__(self, app, maxPending, interval):
+		self.app = app
+		self.maxPending = maxPending
+		self.interval = interval
+		self._pending = {}
+		self._condition = threading.Condition()
+		self._stopping = False
+		self._thread = None
+
+	def __len__(self):
+		return len(self._pending)
+
+	def put(self, eventId, selections):
+		"""Parks the new odds of some selections, overwriting odds not flushed yet
+
+		:param int eventId: id of the event the selections belong to
+		:param list selections: (selection id, odds) pairs
+		:raises QueueFull: when the new selections do not fit, nothing is parked
+		"""
+		with self._condition:
+			newKeys = set(selId for selId, _ in selections) - set(self._pending)
+			if len(self._pending) + len(newKeys) > self.maxPending:
+				raise QueueFull()
+			for selId, odds in selections:
+				self._pending[selId] = (eventId, odds)
+
+	def flush(self):
+		"""Applies every pending odds change in a single transaction, on failure
+		the changes are parked again unless newer odds arrived in the meantime
+
+		:return int: number of selections flushed
+		"""
+		with self._condition:
+			pending, self._pending = self._pending, {}
+		if not pending:
+			return 0
+
+		byEvent = {}
+		for selId, (eventId, odds) in pending.items():
+			byEvent.setdefault(eventId, []).append(dict(id=selId, odds=odds))
+		messages = [
+			dict(
+				message_type='UpdateOdds',
+				event=dict(id=eventId, markets=[dict(selections=selections)])
+			)
+			for eventId, selections in byEvent.items()
+		]
+		try:
+			with self.app.app_context():
+				results = applyMessages(messages)
+		except Exception:
+			with self._condition:
+				for selId, value in pending.items():
+					self._pending.setdefault(selId, value)
+			raise
+		# The rejected ones are not parked again, they would be rejected again
+		for message, result in zip(messages, results):
+			if result['status'] >= 400:
+				self.app.logger.warning(
+					'Write behind dropped the odds of event %s: %s %s %s',
+					message['event']['id'], result['status'], result['message'],
+					message['event']['markets'][0]['selections']
+				)
+		return len(pending)
+
+	def start(self):
+		"""Starts the background worker flushing every interval seconds"""
+		self._stopping = False
+		self._thread = threading.Thread(target=self._run, name='odds-write-behind')
+		self._thread.daemon = True
+		self._thread.start()
+		return self
+
+	def stop(self):
+		"""Stops the worker and drains whatever is still pending"""
+		with self._condition:
+			self._stopping = True
+			self._condition.notify()
+		if self._thread is not None:
+			self._thread.join()
+			self._thread = None
+		self.flush()
+
+	def _run(self):
+		while True:
+			with self._condition:
+				if not self._stopping:
+					self._condition.wait(self.interval)
+				stopping = self._stopping
+			try:
+				self.flush()
+			except Exception:
+				self.app.logger.exception('Write behind flush failed')
+			if stopping:
+				return
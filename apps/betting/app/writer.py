@@ -0,0 +1,136 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module serializes the writes of the application on a single thread that
+owns a dedicated database connection. With sqlite in WAL mode readers then never
+wait on each other's writes and writers never fight over the database lock.
+author: supratim.ghosh1@gmail.com
+"""
+import threading
+
+try:
+	from Queue import Queue, Empty
+except ImportError:
+	from queue import Queue, Empty
+
+from app import db
+from app.metrics import requestStats, setRequestStats
+
+
+class _Task(object):
+
+	def __init__(self, func, args, kwargs):
+		self.func = func
+		self.args = args
+		self.kwargs = kwargs
+		self.result = None
+		self.error = None
+		self.done = threading.Event()
+		# The statements run for the task count towards the submitting request
+		self.stats = requestStats()
+
+
+class SerialWriter(object):
+	"""Runs the submitted write functions one at a time on the writer thread.
+
+	:param flask.Flask app: application whose context the writer runs in
+	"""
+
+	def __init__(self, app):
+		self.app = app
+		self._queue = Queue()
+		self._thread = None
+		self._connection = None
+		# Guards the running flag so that no task is queued behind the stop marker
+		self._lock = threading.Lock()
+		self._running = False
+
+	def isWriterThread(self):
+		return threading.current_thread() is self._thread
+
+	def submit(self, func, *args, **kwargs):
+		"""Runs func on the writer thread and waits for it, the exceptions it
+		raises are raised again in the calling thread
+
+		:return: whatever func returns
+		:raise RuntimeError: when the writer is not running
+		"""
+		if self.isWriterThread():
+			return func(*args, **kwargs)
+		task = _Task(func, args, kwargs)
+		with self._lock:
+			if not self._running:
+				raise RuntimeError('The serial writer is not running')
+			self._queue.put(task)
+		task.done.wait()
+		if task.error is not None:
+			raise task.error
+		return task.result
+
+	def start(self):
+		self._thread = threading.Thread(target=self._run, name='serial-writer')
+		self._thread.daemon = True
+		self._running = True
+		self._thread.start()
+		return self
+
+	def stop(self):
+		"""Stops the writer once the writes already submitted are done, the ones
+		submitted afterwards fail right away
+		"""
+		if self._thread is None:
+			return
+		with self._lock:
+			if self._running:
+				self._running = False
+				self._queue.put(None)
+		self._thread.join()
+		self._thread = None
+
+	def _run(self):
+		with self.app.app_context():
+			try:
+				self._serve()
+			finally:
+				self._halt()
+
+	def _serve(self):
+		connection = self._connection = db.engine.connect()
+		# The session of this thread runs every statement on the dedicated
+		# connection, the default one maps each table to the engine (pool)
+		db.session.registry.set(db.create_session(dict(bind=connection, binds={}))())
+		try:
+			while True:
+				task = self._queue.get()
+				if task is None:
+					return
+				setRequestStats(task.stats)
+				try:
+					task.result = task.func(*task.args, **task.kwargs)
+				except Exception as error:
+					task.error = error
+				except BaseException as error:
+					# Raised in the submitter too, then the writer stops
+					task.error = error
+					raise
+				finally:
+					setRequestStats(None)
+					task.done.set()
+		finally:
+			db.session.remove()
+			connection.close()
+			self._connection = None
+
+	def _halt(self):
+		"""Marks the writer stopped, however its thread ended, and fails the tasks
+		still queued instead of leaving their submitters waiting
+		"""
+		with self._lock:
+			self._running = False
+		while True:
+			try:
+				task = self._queue.get_nowait()
+			except Empty:
+				return
+			if task is not None:
+				task.error = RuntimeError('The serial writer is not running')
+				task.done.set()
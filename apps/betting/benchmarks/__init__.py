@@ -0,0 +1,6 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmarks of the betting application, run them from apps/betting as modules,
+e.g. python -m benchmarks.queryplans
+author: supratim.ghosh1@gmail.com
+"""
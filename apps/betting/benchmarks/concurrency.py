@@ -0,0 +1,193 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Side by side benchmark of the serving modes of serve.py at high concurrency.
+Each mode is started as a server process on the same generated database, then a
+number of server sent events streams are opened and kept open (the slow clients)
+while pollers fetch matches as fast as they can. Reported per mode: the streams
+held, the request rate and latencies of the pollers, and the threads and memory
+of the server process.
+Usage: python -m benchmarks.concurrency --streams 1000 --pollers 32 --duration 10
+author: supratim.ghosh1@gmail.com
+"""
+from sqlalchemy import create_engine
+import subprocess
+import threading
+import argparse
+import tempfile
+import random
+import select
+import socket
+import time
+import sys
+import os
+
+try:
+	from httplib import HTTPConnection
+except ImportError:
+	from http.client import HTTPConnection
+
+# Registers the full text index with the schema generated
+from app import search
+from benchmarks.queryplans import generate
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def startServer(mode, port, databaseUri):
+	"""Starts serve.py in a mode and waits for it to answer"""
+	env = dict(os.environ, BETTING_CONFIG='prod', BETTING_DATABASE_URI=databaseUri)
+	# A file rather than a pipe nobody reads, the request logs would fill it up
+	log = tempfile.TemporaryFile()
+	process = subprocess.Popen(
+		[sys.executable, 'serve.py', '--mode', mode, '--port', str(port)],
+		cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT,
+	)
+	deadline = time.time() + 30
+	while time.time() < deadline:
+		try:
+			connection = HTTPConnection('127.0.0.1', port, timeout=1)
+			connection.request('GET', '/api/match/1')
+			connection.getresponse().read()
+			return process
+		except (socket.error, IOError):
+			time.sleep(0.2)
+	process.kill()
+	process.wait()
+	log.seek(0)
+	raise RuntimeError('%s server did not start: %s' % (mode, log.read()))
+
+
+def openStreams(port, count, events, timeout=30):
+	"""Opens count server sent events streams and waits for them to be subscribed
+
+	@return list: the sockets of the streams subscribed
+	"""
+	pending = {}
+	for index in range(count):
+		sock = socket.create_connection(('127.0.0.1', port))
+		sock.sendall((
+			'GET /api/push/match/%d HTTP/1.1\r\nHost: localhost\r\n\r\n' % (index % events + 1)
+		).encode('ascii'))
+		pending[sock] = b''
+	subscribed = []
+	deadline = time.time() + timeout
+	while pending and time.time() < deadline:
+		readable = select.select(list(pending), [], [], 1)[0]
+		for sock in readable:
+			data = sock.recv(4096)
+			pending[sock] += data
+			if b': subscribed' in pending[sock] or not data:
+				del pending[sock]
+				if data:
+					subscribed.append(sock)
+				else:
+					sock.close()
+	for sock in pending:
+		sock.close()
+	return subscribed
+
+
+def poll(port, events, deadline, latencies, errors):
+	rand = random.Random()
+	while time.time() < deadline:
+		started = time.time()
+		try:
+			connection = HTTPConnection('127.0.0.1', port, timeout=30)
+			connection.request('GET', '/api/match/%d' % rand.randint(1, events))
+			response = connection.getresponse()
+			response.read()
+			connection.close()
+			if response.status != 200:
+				errors.append(response.status)
+				continue
+		except (socket.error, IOError) as error:
+			errors.append(str(error))
+			continue
+		latencies.append(time.time() - started)
+
+
+def processStats(pid):
+	"""Returns the (threads, resident memory in MiB) of a process (linux only)"""
+	stats = {}
+	try:
+		with open('/proc/%d/status' % pid) as status:
+			for line in status:
+				key, _, value = line.partition(':')
+				stats[key] = value.split()
+	except IOError:
+		return None, None
+	return int(stats['Threads'][0]), int(stats['VmRSS'][0]) / 1024.0
+
+
+def benchmark(mode, port, databaseUri, args):
+	process = startServer(mode, port, databaseUri)
+	try:
+		started = time.time()
+		streams = openStreams(port, args.streams, args.events)
+		openTime = time.time() - started
+
+		latencies, errors = [], []
+		deadline = time.time() + args.duration
+		pollers = [
+			threading.Thread(target=poll, args=(port, args.events, deadline, latencies, errors))
+			for _ in range(args.pollers)
+		]
+		for poller in pollers:
+			poller.start()
+		for poller in pollers:
+			poller.join()
+		threads, memory = processStats(process.pid)
+		for sock in streams:
+			sock.close()
+	finally:
+		process.kill()
+		process.wait()
+
+	latencies.sort()
+	percentile = lambda p: latencies[int(p * (len(latencies) - 1))] * 1000 if latencies else 0
+	return dict(
+		mode=mode,
+		streams=len(streams),
+		openTime=openTime,
+		requests=len(latencies),
+		errors=len(errors),
+		rate=len(latencies) / float(args.duration),
+		p50=percentile(0.5),
+		p99=percentile(0.99),
+		threads=threads,
+		memory=memory,
+	)
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+	parser.add_argument('--streams', type=int, default=1000)
+	parser.add_argument('--pollers', type=int, default=32)
+	parser.add_argument('--duration', type=int, default=10)
+	parser.add_argument('--events', type=int, default=10000)
+	parser.add_argument('--modes', default='threaded,gevent')
+	parser.add_argument('--port', type=int, default=5099)
+	parser.add_argument(
+		'--db',
+		default=os.path.join(tempfile.gettempdir(), 'betting-concurrency.db'),
+		help='database file, reused when it exists'
+	)
+	args = parser.parse_args()
+
+	databaseUri = 'sqlite:///%s' % os.path.abspath(args.db)
+	if not os.path.exists(args.db):
+		engine = create_engine(databaseUri)
+		generate(engine, args.events)
+		engine.dispose()
+
+	print('%-9s %8s %8s %9s %8s %9s %9s %8s %9s' % (
+		'mode', 'streams', 'open s', 'req/s', 'errors', 'p50 ms', 'p99 ms', 'threads', 'rss MiB'
+	))
+	for mode in args.modes.split(','):
+		result = benchmark(mode, args.port, databaseUri, args)
+		print('%(mode)-9s %(streams)8d %(openTime)8.2f %(rate)9.1f %(errors)8d %(p50)9.2f '
+			'%(p99)9.2f %(threads)8s %(memory)9.1f' % result)
+
+
+if __name__ == '__main__':
+	main()
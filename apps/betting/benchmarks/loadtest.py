@@ -0,0 +1,364 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Load test of the betting api on a synthetic database, to catch performance
+regressions. The database is generated once per size (sports x events x markets
+x selections) and copied for every scenario, then each scenario starts a fresh
+server (serve.py, prod configuration) and replays a seeded request mix from
+concurrent clients:
+ - polling: read heavy, match documents polled with their ETag and sport listings
+ - tick-storm: odds updates posted to the match api as fast as it takes them
+ - mixed: mostly polling along with odds updates and a few new events
+Reported per scenario: throughput, p50/p99 latencies (overall and per request
+kind) and sql statements per request (read from /metrics), written to a json
+results file that a later run can be compared with (--baseline).
+Usage: python -m benchmarks.loadtest --events 100000 --clients 16 --output results.json
+author: supratim.ghosh1@gmail.com
+"""
+from sqlalchemy import create_engine
+from datetime import datetime, timedelta
+import collections
+import threading
+import argparse
+import tempfile
+import platform
+import random
+import shutil
+import socket
+import json
+import time
+import sys
+import re
+import os
+
+try:
+	from httplib import HTTPConnection
+except ImportError:
+	from http.client import HTTPConnection
+
+# Registers the full text index with the schema generated, new events are indexed
+from app import search
+from benchmarks.queryplans import generate
+from benchmarks.concurrency import startServer
+
+# Statuses of the requests that did what they were meant to
+SUCCESS = (200, 201, 202, 204, 304)
+METRIC_LINE = re.compile(r'^betting_sql_statements_per_request_(sum|count)\{route="(.*)"\} (\S+)$')
+
+# Compared with the baseline: (metric, higher is better)
+COMPARED = (('throughput', True), ('p50', False), ('p99', False), ('queriesPerRequest', False))
+
+
+class Client(object):
+	"""State of one simulated client, seeded so that a run replays the same requests
+
+	:param int index: index of the client
+	:param int seed: seed of the run
+	:param argparse.Namespace dims: size of the generated database
+	"""
+
+	def __init__(self, index, seed, dims):
+		self.index = index
+		self.rand = random.Random(seed * 1000 + index)
+		self.dims = dims
+		self.etags = {}
+		self.created = 0
+
+
+def pollMatch(client):
+	url = '/api/match/%d' % client.rand.randint(1, client.dims.events)
+	return 'GET', url, None
+
+
+def pollSport(client):
+	url = '/api/match/Sport%%20%d?limit=100' % client.rand.randint(1, client.dims.sports)
+	return 'GET', url, None
+
+
+def tick(client):
+	dims = client.dims
+	eventId = client.rand.randint(1, dims.events)
+	# Selections of the first market of the event, see benchmarks.queryplans.generate
+	firstSelection = (eventId - 1) * dims.markets * dims.selections + 1
+	selections = [
+		{'id': selId, 'odds': round(client.rand.uniform(1.01, 20), 2)}
+		for selId in range(firstSelection, firstSelection + dims.selections)
+	]
+	message = {
+		'message_type': 'UpdateOdds',
+		'event': {'id': eventId, 'markets': [{'selections': selections}]},
+	}
+	return 'POST', '/api/match/', message
+
+
+def newEvent(client):
+	client.created += 1
+	startTime = datetime(2019, 1, 1) + timedelta(minutes=client.rand.randint(0, 365 * 24 * 60))
+	message = {
+		'message_type': 'NewEvent',
+		'event': {
+			'name': 'Load %d-%d vs Test' % (client.index, client.created),
+			'startTime': startTime.strftime('%Y-%m-%d %H:%M:%S'),
+			'sport': {'id': client.rand.randint(1, client.dims.sports)},
+			'markets': [{'name': 'Winner', 'selections': [
+				{'name': 'Side %d' % side, 'odds': 1.5} for side in range(client.dims.selections)
+			]}],
+		}
+	}
+	return 'POST', '/api/match/', message
+
+
+# Request mix of the scenarios as (weight, kind, request builder)
+SCENARIOS = collections.OrderedDict([
+	('polling', [(80, 'match', pollMatch), (20, 'sport', pollSport)]),
+	('tick-storm', [(1, 'tick', tick)]),
+	('mixed', [(70, 'match', pollMatch), (20, 'sport', pollSport), (9, 'tick', tick), (1, 'new', newEvent)]),
+])
+
+
+def send(port, client, method, url, message):
+	"""Sends one request, polled urls carry the ETag last returned for them
+
+	@return int: http status
+	"""
+	headers = {}
+	body = None
+	if message is not None:
+		body = json.dumps(message)
+		headers['Content-Type'] = 'application/json'
+	etag = client.etags.get(url)
+	if etag is not None:
+		headers['If-None-Match'] = etag
+	connection = HTTPConnection('127.0.0.1', port, timeout=60)
+	try:
+		connection.request(method, url, body, headers)
+		response = connection.getresponse()
+		response.read()
+		if method == 'GET' and response.getheader('ETag'):
+			client.etags[url] = response.getheader('ETag')
+		return response.status
+	finally:
+		connection.close()
+
+
+def runClient(port, client, mix, count, samples):
+	total = sum(weight for weight, _, _ in mix)
+	for _ in range(count):
+		pick = client.rand.uniform(0, total)
+		for weight, kind, build in mix:
+			pick -= weight
+			if pick <= 0:
+				break
+		method, url, message = build(client)
+		started = time.time()
+		try:
+			status = send(port, client, method, url, message)
+		except (socket.error, IOError):
+			status = None
+		samples.append((kind, time.time() - started, status))
+
+
+def statementCounts(port):
+	"""Returns the (statements, requests) served so far per route from /metrics"""
+	connection = HTTPConnection('127.0.0.1', port, timeout=60)
+	connection.request('GET', '/metrics')
+	text = connection.getresponse().read().decode('utf-8')
+	connection.close()
+	counts = collections.defaultdict(lambda: [0.0, 0])
+	for line in text.splitlines():
+		match = METRIC_LINE.match(line)
+		if match is not None:
+			kind, route, value = match.groups()
+			if kind == 'sum':
+				counts[route][0] = float(value)
+			else:
+				counts[route][1] = int(value)
+	return counts
+
+
+def percentile(latencies, p):
+	"""Returns the p percentile in milliseconds of sorted latencies"""
+	return latencies[int(p * (len(latencies) - 1))] * 1000 if latencies else 0.0
+
+
+def summarize(latencies):
+	latencies.sort()
+	return dict(
+		requests=len(latencies),
+		p50=percentile(latencies, 0.5),
+		p99=percentile(latencies, 0.99),
+	)
+
+
+def runScenario(name, args, databaseUri):
+	"""Runs a scenario against a fresh server and returns its results"""
+	mix = SCENARIOS[name]
+	process = startServer(args.mode, args.port, databaseUri)
+	try:
+		clients = [Client(index, args.seed, args) for index in range(args.clients)]
+
+		def phase(count):
+			samples = []
+			threads = [
+				threading.Thread(target=runClient, args=(args.port, client, mix, count, samples))
+				for client in clients
+			]
+			started = time.time()
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+			return samples, time.time() - started
+
+		phase(args.warmup)
+		before = statementCounts(args.port)
+		samples, seconds = phase(args.requests)
+		after = statementCounts(args.port)
+	finally:
+		process.kill()
+		process.wait()
+
+	statuses = collections.Counter(str(status) for _, _, status in samples)
+	ok = [(kind, latency) for kind, latency, status in samples if status in SUCCESS]
+	byKind = collections.defaultdict(list)
+	for kind, latency in ok:
+		byKind[kind].append(latency)
+
+	# The scrapes of /metrics are not part of the scenario
+	queries = {}
+	for route, (statements, requests) in after.items():
+		statements -= before[route][0]
+		requests -= before[route][1]
+		if requests and route != '/metrics':
+			queries[route] = statements / requests
+	routeRequests = sum(after[r][1] - before[r][1] for r in after if r != '/metrics')
+	routeStatements = sum(after[r][0] - before[r][0] for r in after if r != '/metrics')
+
+	result = summarize([latency for _, latency in ok])
+	result.update(
+		errors=len(samples) - len(ok),
+		statuses=dict(statuses),
+		seconds=seconds,
+		throughput=len(ok) / seconds if seconds else 0.0,
+		queriesPerRequest=routeStatements / routeRequests if routeRequests else 0.0,
+		queriesPerRoute=queries,
+		kinds=dict((kind, summarize(latencies)) for kind, latencies in byKind.items()),
+	)
+	return result
+
+
+def compare(results, baseline, tolerance):
+	"""Compares the results of a run with a baseline run
+
+	@param dict results: results of this run
+	@param dict baseline: results of the baseline run
+	@param float tolerance: relative change allowed before flagging a regression
+	@return list: (scenario, metric, baseline value, value, relative change,
+	regressed) tuples of the scenarios found in both runs
+	"""
+	rows = []
+	for name, current in results['scenarios'].items():
+		previous = baseline['scenarios'].get(name)
+		if previous is None:
+			continue
+		for metric, higherIsBetter in COMPARED:
+			old, new = previous[metric], current[metric]
+			if old:
+				change = (new - old) / old
+			else:
+				change = float('inf') if new else 0.0
+			regressed = -change > tolerance if higherIsBetter else change > tolerance
+			rows.append((name, metric, old, new, change, regressed))
+	return rows
+
+
+def databaseFor(args):
+	"""Returns the path of the generated database of the requested size, generated
+	on the first run of the size
+	"""
+	path = args.db or os.path.join(tempfile.gettempdir(), 'betting-load-%dx%dx%dx%d.db' % (
+		args.sports, args.events, args.markets, args.selections
+	))
+	if not os.path.exists(path):
+		started = time.time()
+		engine = create_engine('sqlite:///%s' % os.path.abspath(path))
+		generate(engine, args.events, args.sports, args.markets, args.selections)
+		engine.dispose()
+		print('Generated %d events in %.1f s' % (args.events, time.time() - started))
+	return path
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+	parser.add_argument('--sports', type=int, default=20)
+	parser.add_argument('--events', type=int, default=10000)
+	parser.add_argument('--markets', type=int, default=1, help='markets per event')
+	parser.add_argument('--selections', type=int, default=2, help='selections per market')
+	parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+	parser.add_argument('--clients', type=int, default=8, help='concurrent clients')
+	parser.add_argument('--requests', type=int, default=500, help='requests per client')
+	parser.add_argument('--warmup', type=int, default=20, help='unmeasured requests per client')
+	parser.add_argument('--seed', type=int, default=1)
+	parser.add_argument('--mode', choices=('threaded', 'gevent'), default='threaded')
+	parser.add_argument('--port', type=int, default=5098)
+	parser.add_argument('--db', help='generated database, reused when it exists')
+	parser.add_argument('--output', default='loadtest-results.json')
+	parser.add_argument('--baseline', help='results file to compare with')
+	parser.add_argument('--tolerance', type=float, default=0.1)
+	args = parser.parse_args(argv)
+
+	names = args.scenarios.split(',')
+	for name in names:
+		if name not in SCENARIOS:
+			parser.error('Unknown scenario %s' % name)
+
+	generated = databaseFor(args)
+	workDir = tempfile.mkdtemp()
+	results = dict(
+		config=dict(
+			(key, getattr(args, key)) for key in (
+				'sports', 'events', 'markets', 'selections', 'clients', 'requests',
+				'warmup', 'seed', 'mode',
+			)
+		),
+		python=platform.python_version(),
+		startedAt=datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+		scenarios=collections.OrderedDict(),
+	)
+	try:
+		print('%-11s %9s %7s %9s %9s %9s %9s' % (
+			'scenario', 'requests', 'errors', 'req/s', 'p50 ms', 'p99 ms', 'queries'
+		))
+		for name in names:
+			# Every scenario starts from the database as generated
+			database = os.path.join(workDir, '%s.db' % name)
+			shutil.copyfile(generated, database)
+			result = results['scenarios'][name] = runScenario(
+				name, args, 'sqlite:///%s' % database
+			)
+			print('%-11s %9d %7d %9.1f %9.2f %9.2f %9.2f' % (
+				name, result['requests'], result['errors'], result['throughput'],
+				result['p50'], result['p99'], result['queriesPerRequest'],
+			))
+	finally:
+		shutil.rmtree(workDir)
+
+	with open(args.output, 'w') as output:
+		json.dump(results, output, indent=2)
+	print('Results written to %s' % args.output)
+
+	if args.baseline:
+		with open(args.baseline) as baselineFile:
+			baseline = json.load(baselineFile)
+		regressions = 0
+		print('%-11s %-18s %10s %10s %8s' % ('scenario', 'metric', 'baseline', 'current', 'change'))
+		for name, metric, old, new, change, regressed in compare(results, baseline, args.tolerance):
+			regressions += regressed
+			print('%-11s %-18s %10.2f %10.2f %+7.1f%%%s' % (
+				name, metric, old, new, change * 100, '  REGRESSION' if regressed else ''
+			))
+		if regressions:
+			sys.exit('%d regressions beyond %d%%' % (regressions, args.tolerance * 100))
+
+
+if __name__ == '__main__':
+	main()
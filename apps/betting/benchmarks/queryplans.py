@@ -0,0 +1,208 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark of the hot query shapes of the apis on a large generated database.
+Each shape is run through the same code the apis use, its statements are captured
+and explained (sqlite EXPLAIN QUERY PLAN) and its median latency is reported, so
+a plan falling back to a full table SCAN shows up straight away.
+Usage: python -m benchmarks.queryplans --events 1000000
+author: supratim.ghosh1@gmail.com
+"""
+from sqlalchemy import event as sqlEvent
+from datetime import datetime, timedelta
+import argparse
+import tempfile
+import random
+import time
+import os
+
+from app import createApplication, db
+from app.models import Sport, Event, Market, Selection, OddsHistory, OddsRollup
+from app.listing import listEvents
+from app.history import MINUTE, series, bucketWindow
+from app.search import CREATE_SEARCH, searchEvents, rebuildIndex
+from app.board import loadBoard
+from app.serialize import matchRows
+from app import messages
+
+SPORTS = 20
+BATCH_SIZE = 50000
+
+# Odds history of the selections of the first market: a tick every second from
+# a whole minute
+HISTORY_START = 1542999960000
+HISTORY_SECONDS = 3 * 24 * 60 * 60
+
+
+def generate(engine, events, sports=SPORTS, markets=1, selections=2):
+	"""Fills an empty database with events spread over sports, each with markets
+	of selections, using executemany inserts in large batches. The markets of
+	event i are numbered from (i - 1) * markets + 1 and the selections of market m
+	from (m - 1) * selections + 1.
+	"""
+	db.metadata.create_all(engine)
+	rand = random.Random(42)
+	epoch = datetime(2015, 1, 1)
+	with engine.begin() as conn:
+		conn.execute(Sport.__table__.insert(), [
+			dict(id=i, name='Sport %d' % i, nameKey='sport %d' % i, version=0)
+			for i in range(1, sports + 1)
+		])
+	batch = max(1, BATCH_SIZE // (markets * selections))
+	for start in range(1, events + 1, batch):
+		ids = range(start, min(start + batch, events + 1))
+		marketIds = range((start - 1) * markets + 1, ids[-1] * markets + 1)
+		with engine.begin() as conn:
+			conn.execute(Event.__table__.insert(), [
+				dict(
+					id=i,
+					name='Team %d vs Team %d' % (rand.randint(1, 5000), rand.randint(1, 5000)),
+					startTime=epoch + timedelta(minutes=rand.randint(0, 5 * 365 * 24 * 60)),
+					sportId=rand.randint(1, sports),
+					version=0,
+				)
+				for i in ids
+			])
+			conn.execute(Market.__table__.insert(), [
+				dict(
+					id=m,
+					name='Winner' if (m - 1) % markets == 0 else 'Market %d' % ((m - 1) % markets),
+					eventId=(m - 1) // markets + 1,
+				)
+				for m in marketIds
+			])
+			conn.execute(Selection.__table__.insert(), [
+				dict(
+					id=(m - 1) * selections + side + 1,
+					name='Side %d' % side,
+					odds=1.5,
+					marketId=m,
+				)
+				for m in marketIds for side in range(selections)
+			])
+
+
+def generateHistory(engine):
+	"""Fills the odds history (and its rollup) of the two selections of the first
+	market, the batches hold whole minutes
+	"""
+	db.metadata.create_all(engine)
+	rand = random.Random(42)
+	batch = BATCH_SIZE // 60 * 60
+	for start in range(0, HISTORY_SECONDS, batch):
+		ticks, rollup = [], []
+		for selId in (1, 2):
+			for second in range(start, min(start + batch, HISTORY_SECONDS)):
+				ts = HISTORY_START + second * 1000
+				odds = rand.uniform(1, 5)
+				ticks.append(dict(selectionId=selId, ts=ts, odds=odds))
+				key = dict(selectionId=selId, minute=ts // MINUTE)
+				if not rollup or any(rollup[-1][k] != v for k, v in key.items()):
+					rollup.append(dict(key, last=odds, low=odds, high=odds, ticks=0))
+				row = rollup[-1]
+				row.update(last=odds, low=min(row['low'], odds), high=max(row['high'], odds))
+				row['ticks'] += 1
+		with engine.begin() as conn:
+			conn.execute(OddsHistory.__table__.insert(), ticks)
+			conn.execute(OddsRollup.__table__.insert(), rollup)
+
+
+def shapes(events):
+	"""Returns the (name, callable) query shapes to benchmark"""
+	rand = random.Random(7)
+	eventIds = [rand.randint(1, events) for _ in range(100)]
+	selectionIds = [2 * i for i in eventIds]
+	sport = [Event.sportId == 3]
+	cursor = listEvents([Event.sportId == 3], 'startTime', [], 1000)[1]
+	window = bucketWindow(HISTORY_START, HISTORY_START + HISTORY_SECONDS * 1000, 0, 1000)
+	boardStart = datetime(2017, 6, 1)
+	rawWindow = (HISTORY_START, HISTORY_START + 60 * 60 * 1000, 1000)
+	return [
+		('sport by name', lambda: Sport.byName('SPORT 3').first()),
+		('listing by name', lambda: listEvents(sport, 'name', ['name', 'startTime'], 100)),
+		('listing by startTime', lambda: listEvents(sport, 'startTime', ['name'], 100)),
+		('listing page after cursor', lambda: listEvents(sport, 'startTime', ['name'], 100, cursor)),
+		('match tree', lambda: db.session.execute(matchRows([Event.id == eventIds[0]])).fetchall()),
+		('update odds markets', lambda: messages._firstMarkets(eventIds)),
+		('update odds selections', lambda: messages._selections(selectionIds)),
+		('market history 3 days', lambda: series([1, 2], *window)),
+		('market history 1 hour raw', lambda: series([1, 2], *rawWindow)),
+		('upcoming board 48 hours', lambda: loadBoard(3, boardStart, boardStart + timedelta(hours=48))),
+		('search prefix', lambda: searchEvents('team 12', 20)),
+		('search tokens in sport', lambda: searchEvents('team 123 team 4', 20, 3)),
+	]
+
+
+def run(app, events, repeat):
+	statements = []
+
+	def capture(conn, cursor, statement, parameters, context, executemany):
+		statements.append((statement, parameters))
+
+	with app.app_context():
+		for name, shape in shapes(events):
+			timings = []
+			for _ in range(repeat):
+				db.session.expunge_all()
+				started = time.time()
+				shape()
+				timings.append(time.time() - started)
+			del statements[:]
+			sqlEvent.listen(db.engine, 'before_cursor_execute', capture)
+			shape()
+			sqlEvent.remove(db.engine, 'before_cursor_execute', capture)
+
+			timings.sort()
+			print('%-28s median %8.3f ms' % (name, timings[len(timings) // 2] * 1000))
+			for statement, parameters in statements:
+				subqueries = set()
+				for row in db.engine.execute('EXPLAIN QUERY PLAN ' + statement, parameters):
+					detail = row[-1]
+					if detail.startswith('MATERIALIZE'):
+						subqueries.add(detail.split()[-1])
+					# A SCAN without an index is a full table scan unless it reads
+					# the rows of a subquery (anon_N or a materialized one) or is a
+					# full text MATCH (a virtual table index with an M constraint)
+					indexed = 'USING' in detail or ':M' in detail
+					fullScan = detail.startswith('SCAN') and not indexed
+					subquery = 'anon_' in detail or detail.split()[-1] in subqueries
+					flag = '!!' if fullScan and not subquery else '  '
+					print('    %s %s' % (flag, detail))
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+	parser.add_argument('--events', type=int, default=1000000)
+	parser.add_argument('--repeat', type=int, default=20)
+	parser.add_argument(
+		'--db',
+		default=os.path.join(tempfile.gettempdir(), 'betting-bench.db'),
+		help='database file, reused when it exists'
+	)
+	args = parser.parse_args()
+
+	app = createApplication()
+	app.config.update(
+		SQLALCHEMY_ECHO=False,
+		SQLALCHEMY_DATABASE_URI='sqlite:///%s' % os.path.abspath(args.db),
+	)
+	with app.app_context():
+		if not os.path.exists(args.db):
+			started = time.time()
+			generate(db.engine, args.events)
+			print('Generated %d events in %.1f s' % (args.events, time.time() - started))
+		db.metadata.create_all(db.engine)
+		db.engine.execute(CREATE_SEARCH)
+		if not db.engine.execute('SELECT rowid FROM event_search LIMIT 1').first():
+			started = time.time()
+			with db.engine.begin() as conn:
+				rebuildIndex(conn)
+			print('Indexed the events in %.1f s' % (time.time() - started))
+		if not db.session.query(OddsHistory.ts).first():
+			started = time.time()
+			generateHistory(db.engine)
+			print('Generated %d ticks in %.1f s' % (2 * HISTORY_SECONDS, time.time() - started))
+	run(app, args.events, args.repeat)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,122 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark of the response serialization paths on a generated database. Each
+document shape is built both through the ORM (instances, asDict and the flask
+json encoder, as the apis used to) and from the Core rows with the compiled
+encoders of app.serialize, the query included, and the median times compared.
+Usage: python -m benchmarks.serialization --events 10000
+author: supratim.ghosh1@gmail.com
+"""
+from flask import json as flaskJson
+import argparse
+import tempfile
+import random
+import time
+import os
+
+from app import createApplication, db
+from app.models import Event
+from app.listing import pageRows
+from app.serialize import BACKEND, encodeArray, encodeListing, encodeMatches, matchRows
+from benchmarks.queryplans import generate
+
+URL = 'http://localhost:5000/api/match/%d'
+# Page size of the listings, all the events in one page
+MAX_EVENTS = 10 ** 9
+
+
+def urlFor(eventId):
+	return URL % eventId
+
+
+def listingOrm():
+	events = Event.query.order_by(Event.name, Event.id).all()
+	return flaskJson.dumps(dict(matches=[
+		dict(event.asDict(), url=urlFor(event.id)) for event in events
+	]))
+
+
+def listingCore():
+	fields = ['id', 'name', 'startTime']
+	rows, _ = pageRows([], 'name', fields, MAX_EVENTS)
+	return encodeListing(fields, rows, urlFor)
+
+
+def treesOrm():
+	events = Event.queryTree().order_by(Event.id).all()
+	return flaskJson.dumps([
+		dict(event.asDict(skipRelations=False), url=urlFor(event.id)) for event in events
+	])
+
+
+def treesCore():
+	return encodeArray(encodeMatches(db.session.execute(matchRows([])), urlFor))
+
+
+def matchesOrm(eventIds):
+	for eventId in eventIds:
+		event = Event.queryTree().filter_by(id=eventId).first()
+		flaskJson.dumps(dict(event.asDict(skipRelations=False), url=urlFor(eventId)))
+
+
+def matchesCore(eventIds):
+	for eventId in eventIds:
+		encodeMatches(db.session.execute(matchRows([Event.id == eventId])), urlFor)
+
+
+def shapes(events):
+	"""Returns the (name, orm callable, core callable) shapes to benchmark"""
+	rand = random.Random(7)
+	eventIds = [rand.randint(1, events) for _ in range(100)]
+	return [
+		('listing of %d events' % events, listingOrm, listingCore),
+		('trees of %d events' % events, treesOrm, treesCore),
+		('100 single matches', lambda: matchesOrm(eventIds), lambda: matchesCore(eventIds)),
+	]
+
+
+def median(shape, repeat):
+	timings = []
+	for _ in range(repeat):
+		db.session.remove()
+		started = time.time()
+		shape()
+		timings.append(time.time() - started)
+	timings.sort()
+	return timings[len(timings) // 2] * 1000
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+	parser.add_argument('--events', type=int, default=10000)
+	parser.add_argument('--repeat', type=int, default=10)
+	parser.add_argument(
+		'--db',
+		default=os.path.join(tempfile.gettempdir(), 'betting-serialization.db'),
+		help='database file, reused when it exists'
+	)
+	args = parser.parse_args()
+
+	app = createApplication()
+	app.config.update(
+		SQLALCHEMY_ECHO=False,
+		SQLALCHEMY_DATABASE_URI='sqlite:///%s' % os.path.abspath(args.db),
+	)
+	with app.app_context():
+		if not os.path.exists(args.db):
+			generate(db.engine, args.events)
+		events = db.session.query(db.func.count(Event.id)).scalar()
+
+		print('json backend: %s' % BACKEND)
+		print('%-28s %10s %10s %8s' % ('shape', 'orm ms', 'core ms', 'speedup'))
+		for name, orm, core in shapes(events):
+			# Both paths have to produce the same document
+			document = orm()
+			if document is not None:
+				assert flaskJson.loads(document) == flaskJson.loads(core())
+			ormTime, coreTime = median(orm, args.repeat), median(core, args.repeat)
+			print('%-28s %10.2f %10.2f %7.1fx' % (name, ormTime, coreTime, ormTime / coreTime))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,62 @@
+"""initial schema
+
+Revision ID: 2eb5f01ceaa7
+Revises: 
+Create Date: 2018-11-20 21:04:12.318233
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2eb5f01ceaa7'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('sport',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=60), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_sport_name'), 'sport', ['name'], unique=True)
+    op.create_table('event',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=250), nullable=True),
+    sa.Column('startTime', sa.DateTime(), nullable=True),
+    sa.Column('sportId', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['sportId'], ['sport.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_event_name'), 'event', ['name'], unique=False)
+    op.create_table('market',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=60), nullable=True),
+    sa.Column('eventId', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['eventId'], ['event.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_market_name'), 'market', ['name'], unique=False)
+    op.create_table('selection',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=100), nullable=True),
+    sa.Column('odds', sa.Float(), nullable=True),
+    sa.Column('marketId', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['marketId'], ['market.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_selection_name'), 'selection', ['name'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_selection_name'), table_name='selection')
+    op.drop_table('selection')
+    op.drop_index(op.f('ix_market_name'), table_name='market')
+    op.drop_table('market')
+    op.drop_index(op.f('ix_event_name'), table_name='event')
+    op.drop_table('event')
+    op.drop_index(op.f('ix_sport_name'), table_name='sport')
+    op.drop_table('sport')
@@ -0,0 +1,34 @@
+"""event search index
+
+Revision ID: 5c260cf79c4c
+Revises: bc7745b0af38
+Create Date: 2018-12-01 10:47:22.580931
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c260cf79c4c'
+down_revision = 'bc7745b0af38'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(
+        "CREATE VIRTUAL TABLE event_search USING fts5(name, selections, "
+        "tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+    )
+    op.execute(
+        'INSERT INTO event_search (rowid, name, selections) '
+        'SELECT event.id, event.name, group_concat(selection.name, \' \') FROM event '
+        'LEFT OUTER JOIN market ON market."eventId" = event.id '
+        'LEFT OUTER JOIN selection ON selection."marketId" = market.id '
+        'GROUP BY event.id'
+    )
+
+
+def downgrade():
+    op.execute('DROP TABLE event_search')
@@ -0,0 +1,37 @@
+"""odds change log
+
+Revision ID: 7f59a27ff415
+Revises: e7595b174289
+Create Date: 2018-11-25 11:05:13.660412
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7f59a27ff415'
+down_revision = 'e7595b174289'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('odds_change',
+    sa.Column('seq', sa.Integer(), nullable=False),
+    sa.Column('selectionId', sa.Integer(), nullable=False),
+    sa.Column('eventId', sa.Integer(), nullable=False),
+    sa.Column('sportId', sa.Integer(), nullable=False),
+    sa.Column('odds', sa.Float(), nullable=True),
+    sa.Column('createdAt', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('seq'),
+    sqlite_autoincrement=True
+    )
+    op.create_index(op.f('ix_odds_change_createdAt'), 'odds_change', ['createdAt'], unique=False)
+    op.create_index('ix_odds_change_sport_seq', 'odds_change', ['sportId', 'seq'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_odds_change_sport_seq', table_name='odds_change')
+    op.drop_index(op.f('ix_odds_change_createdAt'), table_name='odds_change')
+    op.drop_table('odds_change')
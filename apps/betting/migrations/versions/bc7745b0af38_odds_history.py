@@ -0,0 +1,39 @@
+"""odds history
+
+Revision ID: bc7745b0af38
+Revises: ddb480021d81
+Create Date: 2018-11-29 18:12:40.318207
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'bc7745b0af38'
+down_revision = 'ddb480021d81'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('odds_history',
+    sa.Column('selectionId', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('ts', sa.BigInteger(), autoincrement=False, nullable=False),
+    sa.Column('odds', sa.Float(), nullable=False),
+    sa.PrimaryKeyConstraint('selectionId', 'ts')
+    )
+    op.create_table('odds_rollup',
+    sa.Column('selectionId', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('minute', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('last', sa.Float(), nullable=False),
+    sa.Column('low', sa.Float(), nullable=False),
+    sa.Column('high', sa.Float(), nullable=False),
+    sa.Column('ticks', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('selectionId', 'minute')
+    )
+
+
+def downgrade():
+    op.drop_table('odds_rollup')
+    op.drop_table('odds_history')
@@ -0,0 +1,39 @@
+"""sport name key and listing indexes
+
+Revision ID: ddb480021d81
+Revises: 7f59a27ff415
+Create Date: 2018-11-27 20:41:57.902114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'ddb480021d81'
+down_revision = '7f59a27ff415'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('sport', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('nameKey', sa.String(length=60), nullable=True))
+    # Backfill the key of the existing sports before it gets its unique index
+    op.execute('UPDATE sport SET "nameKey" = lower(name)')
+    op.create_index(op.f('ix_sport_nameKey'), 'sport', ['nameKey'], unique=True)
+
+    op.create_index('ix_event_sport_start', 'event', ['sportId', 'startTime'], unique=False)
+    op.create_index('ix_event_sport_name', 'event', ['sportId', 'name'], unique=False)
+    op.create_index(op.f('ix_market_eventId'), 'market', ['eventId'], unique=False)
+    op.create_index(op.f('ix_selection_marketId'), 'selection', ['marketId'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_selection_marketId'), table_name='selection')
+    op.drop_index(op.f('ix_market_eventId'), table_name='market')
+    op.drop_index('ix_event_sport_name', table_name='event')
+    op.drop_index('ix_event_sport_start', table_name='event')
+    op.drop_index(op.f('ix_sport_nameKey'), table_name='sport')
+    with op.batch_alter_table('sport', schema=None) as batch_op:
+        batch_op.drop_column('nameKey')
@@ -0,0 +1,32 @@
+"""event and sport versions
+
+Revision ID: e7595b174289
+Revises: 2eb5f01ceaa7
+Create Date: 2018-11-24 18:32:40.107561
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7595b174289'
+down_revision = '2eb5f01ceaa7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('event', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('version', sa.Integer(), server_default='0', nullable=False))
+
+    with op.batch_alter_table('sport', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('version', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('sport', schema=None) as batch_op:
+        batch_op.drop_column('version')
+
+    with op.batch_alter_table('event', schema=None) as batch_op:
+        batch_op.drop_column('version')
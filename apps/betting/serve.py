@@ -0,0 +1,116 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module serves the betting api outside of the flask development server.
+Two modes expose the same application (routes and json contracts):
+ - threaded: the werkzeug server with a thread per request, as server.py does
+ - gevent: a cooperative server where every request runs on a greenlet, so the
+ slow clients (server sent events streams in particular) cost a greenlet each
+ instead of a thread. Requires gevent (pip install gevent).
+Either mode can run several worker processes (--workers) accepting on one shared
+listening socket, each worker follows the writes of the others to keep its own
+caches current (FOLLOW_CHANGES, on in the prod configuration).
+Usage: BETTING_CONFIG=prod python serve.py --mode gevent --port 5000 --workers 4
+author: supratim.ghosh1@gmail.com
+"""
+import argparse
+import signal
+import socket
+import sys
+import os
+
+MODES = ('threaded', 'gevent')
+
+
+def parseArgs(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+	parser.add_argument('--mode', choices=MODES, default='gevent')
+	parser.add_argument('--host', default='127.0.0.1')
+	parser.add_argument('--port', type=int, default=5000)
+	parser.add_argument('--workers', type=int, default=1, help='worker processes')
+	return parser.parse_args(argv)
+
+
+def serveGevent(host, port, listener=None):
+	"""Serves the application on a gevent server, the standard library is patched
+	first so that the sockets, locks, queues and sleeps of the application (the
+	push broker, the serial writer, the connection pool) yield to other greenlets
+	instead of blocking the process
+	"""
+	try:
+		from gevent import monkey
+	except ImportError:
+		sys.exit('The gevent mode requires gevent, pip install gevent')
+	monkey.patch_all()
+	from gevent.pywsgi import WSGIServer
+	from gevent import socket as gsocket
+	from server import myapp
+
+	if listener is not None:
+		# The shared socket was created before patching, accept on a cooperative one
+		listener = gsocket.fromfd(listener.fileno(), socket.AF_INET, socket.SOCK_STREAM)
+	server = WSGIServer(listener or (host, port), myapp, log=None)
+	myapp.logger.info('Serving on %s:%d (gevent)', host, port)
+	server.serve_forever()
+
+
+def serveThreaded(host, port, listener=None):
+	"""Serves the application on the werkzeug server, a thread per request"""
+	from werkzeug.serving import make_server
+	from server import myapp
+
+	fd = listener.fileno() if listener is not None else None
+	server = make_server(host, port, myapp, threaded=True, fd=fd)
+	myapp.logger.info('Serving on %s:%d (threaded)', host, port)
+	server.serve_forever()
+
+
+SERVERS = {'gevent': serveGevent, 'threaded': serveThreaded}
+
+
+def serveWorkers(mode, host, port, workers):
+	"""Binds the listening socket and forks the workers accepting on it. The
+	application is only imported in the workers so each one starts its own
+	threads (writer, change follower) and database connections.
+	"""
+	listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	listener.bind((host, port))
+	listener.listen(1024)
+
+	children = []
+	for _ in range(workers):
+		pid = os.fork()
+		if pid == 0:
+			# Exit normally on SIGTERM so the atexit hooks drain the pending writes
+			signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+			try:
+				SERVERS[mode](host, port, listener)
+			finally:
+				os._exit(0)
+		children.append(pid)
+
+	def stop(signum, frame):
+		for pid in children:
+			try:
+				os.kill(pid, signal.SIGTERM)
+			except OSError:
+				pass
+		sys.exit(0)
+
+	signal.signal(signal.SIGTERM, stop)
+	signal.signal(signal.SIGINT, stop)
+	while children:
+		pid, _ = os.wait()
+		children.remove(pid)
+
+
+def main(argv=None):
+	args = parseArgs(argv)
+	if args.workers > 1:
+		serveWorkers(args.mode, args.host, args.port, args.workers)
+	else:
+		SERVERS[args.mode](args.host, args.port)
+
+
+if __name__ == '__main__':
+	main()
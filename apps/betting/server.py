@@ -5,55 +5,224 @@ designed to manage data about sporting events to allowing user to place bets.
 author: supratim.ghosh1@gmail.com
 """
 from flask import Response, abort, request, jsonify
-from sqlalchemy import func, desc
-from datetime import datetime
+from datetime import datetime, timedelta
+import calendar
 import sys
 
 # Application specific modules
 from app.models import Sport, Event, Market, Selection
+from app.messages import TIME_FORMAT, applyMessages, applyStream, readLines
+from app.writebehind import QueueFull
+from app.changelog import changesSince, mustResync
+from app.push import DROPPED
+from app.listing import FIELDS, ORDERINGS, pageRows
+from app.serialize import encodeListing, encodeMatches, matchRows, dumps
+from app.history import nowMs, bucketWindow, series, marketSelections
+from app.search import searchEvents
 from app import createApplication, db
 
 # Create the flask app 
 myapp = createApplication()
 
 
+def notModified(etag):
+	"""Tells if the client already holds the document tagged with etag"""
+	return etag is not None and request.if_none_match.contains(etag)
+
+
+# Request parameters that change the cached documents, the others (cache busters
+# for one) would only multiply the variants of a document
+VARIANT_PARAMS = ('ordering', 'fields', 'limit', 'after')
+
+
+def variantKey():
+	"""Returns the cache variant of the requested document: its url without the
+	query string, embedded in the documents, and the VARIANT_PARAMS
+	"""
+	return (request.base_url,) + tuple(request.args.get(name) for name in VARIANT_PARAMS)
+
+
+def cachedJson(kind, ident, build, etag=None):
+	"""Serves a json document straight from the document cache when it is there,
+	otherwise builds it and caches its bytes for the next request. When an etag
+	callable is given the response is tagged with it and requests carrying the
+	same tag in If-None-Match get a 304 without the document being built.
+
+	@param str kind: kind of document, used by the writers to invalidate it
+	@param ident: identifies the document within its kind
+	@param callable build: returns the json response when the cache misses
+	@param callable etag: returns the current etag of the document (optional)
+	@return Response: json response
+	"""
+	cache = myapp.extensions.get('documentCache')
+	cached = cache.get(kind, ident, variantKey()) if cache is not None else None
+	if cached is not None:
+		body, tag = cached
+		if notModified(tag):
+			response = Response(status=304)
+		else:
+			response = Response(body, mimetype='application/json')
+		response.headers['X-Cache'] = 'HIT'
+	else:
+		# The token is taken before reading so a concurrent invalidation wins
+		token = cache.token(kind, ident) if cache is not None else None
+		tag = etag() if etag is not None else None
+		if notModified(tag):
+			response = Response(status=304)
+		else:
+			response = build()
+			if cache is not None:
+				cache.set(kind, ident, variantKey(), (response.get_data(), tag), token)
+		if cache is not None:
+			response.headers['X-Cache'] = 'MISS'
+
+	if tag is not None:
+		response.set_etag(tag)
+	return response
+
+
 @myapp.route('/api/match/<int:matchId>', methods=['GET'])
 def getMatchById(matchId):
 	"""	Given a valid match id, this api responds with the match data including
 	metadata like sport, market and selections. 
+	The response carries an ETag derived from the event version, polls sending
+	it back in If-None-Match get a 304 until the odds change.
 	Example url: localhost:5000/api/match/1
 
 	@param int matchId: Match id number.
 	@return json: json object containing match information.
 	"""
-	event = Event.query.filter_by(id=matchId).first_or_404()
-	# We want to populate all the relationship data, hence the =False
-	myapp.logger.info('Retrieving data for event %s', event.name)
-	response = event.asDict(skipRelations=False)
-	response.update({'url': request.url})
-	return jsonify(response)
+	def build():
+		# The whole event tree in one statement, encoded straight from its rows
+		documents = encodeMatches(
+			db.session.execute(matchRows([Event.id == matchId])),
+			lambda eventId: request.base_url
+		)
+		if not documents:
+			abort(404)
+		myapp.logger.debug('Retrieving data for event %s', matchId)
+		return Response(documents[0], mimetype='application/json')
+
+	def etag():
+		# Cheap lookup of the version alone, the event tree is not loaded
+		version = db.session.query(Event.version).filter_by(id=matchId).scalar()
+		if version is None:
+			abort(404)
+		return 'e%d-%d' % (matchId, version)
+
+	return cachedJson('match', matchId, build, etag)
+
+
+def listingPage(criteria, ordering, urlFor):
+	"""Builds a page of an event listing from the limit, after (cursor) and fields
+	(comma separated projection) request parameters. The next key of the response
+	holds the cursor of the following page and is only there if one follows.
+
+	@param list criteria: filter clauses on the event table
+	@param str ordering: ordering of the listing, name or startTime
+	@param callable urlFor: returns the url of an event given its id
+	@return Response: json response with the matches of the page
+	"""
+	fields = request.args.get('fields')
+	fields = fields.split(',') if fields else ['id', 'name', 'startTime']
+	if not set(fields) <= set(FIELDS) or len(set(fields)) != len(fields):
+		myapp.logger.error('Fields %s are not valid', fields)
+		abort(400)
+	limit = request.args.get('limit', myapp.config['LISTING_PAGE_SIZE'], type=int)
+	limit = max(1, min(limit, myapp.config['LISTING_MAX_PAGE_SIZE']))
+
+	try:
+		rows, nextCursor = pageRows(
+			criteria, ordering, fields, limit, request.args.get('after')
+		)
+	except ValueError:
+		abort(400)
+
+	return Response(
+		encodeListing(fields, rows, urlFor, nextCursor), mimetype='application/json'
+	)
 
 
 @myapp.route('/api/match/', methods=['GET'])
 def getMatchesByName():
 	"""Given a valid match name, this api responds with a list of match 
 	information matching the name (contain basic basic information only).
+	The list is paged, see listingPage for the limit, after and fields parameters.
 	Example url: http://localhost:5000/api/match/?name=Real Madrid vs Barcelona
 
 	@return json: List of dicts each contain match related information.
 	"""
-	response = []
 	name = request.args.get('name')
-	myapp.logger.info('Data requested for match %s', name)
-	events = Event.query.filter_by(name=name)
+	myapp.logger.debug('Data requested for match %s', name)
 
-	# For invalid name this api just returns an empty list does not raise and abort
-	for event in events.order_by(desc('startTime')):
-		res = event.asDict()
-		res.update({'url': request.base_url + str(event.id)})
-		response.append(res)
+	def build():
+		# For invalid name this api just returns an empty list does not raise and abort
+		return listingPage(
+			[Event.name == name],
+			'startTime',
+			lambda eventId: request.base_url + str(eventId)
+		)
+
+	return cachedJson('name', name, build)
+
+
+@myapp.route('/api/search/', methods=['GET'])
+def searchMatches():
+	"""Full text search of the matches by event and selection names. Every word
+	of the query has to match, the last one as a prefix so results follow the
+	user typing, and matches are ranked with event name hits first.
+	Example url: http://localhost:5000/api/search/?q=real mad&limit=10&sport=football
+
+	@return json: List of dicts each contain match related information.
+	"""
+	phrase = request.args.get('q', '')
+	limit = request.args.get('limit', myapp.config['SEARCH_PAGE_SIZE'], type=int)
+	limit = max(1, min(limit, myapp.config['SEARCH_MAX_PAGE_SIZE']))
+	sportId = None
+	sportName = request.args.get('sport')
+	if sportName:
+		sportId = Sport.byName(sportName).first_or_404().id
+
+	matches = []
+	for eventId, name, startTime in searchEvents(phrase, limit, sportId):
+		matches.append({
+			'id': eventId,
+			'name': name,
+			'startTime': str(startTime),
+			'url': request.url_root + 'api/match/%d' % eventId,
+		})
+	return jsonify(matches=matches)
+
+
+@myapp.route('/api/board/<string:sportName>', methods=['GET'])
+def getBoard(sportName):
+	"""Upcoming events board of a sport: the matches starting within the next
+	hours (BOARD_DEFAULT_HOURS by default, at most BOARD_MAX_HOURS) from the from
+	time (now by default, UTC) with their markets and current odds, ordered by
+	start time. Served from the materialized board of the sport.
+	Example url: http://localhost:5000/api/board/football?hours=12
+
+	@param str sportName: Name of the sport like Football.
+	@return json: the sport, the window and the matches of the board
+	"""
+	sport = Sport.byName(sportName).first_or_404()
+	hours = request.args.get('hours', myapp.config['BOARD_DEFAULT_HOURS'], type=int)
+	start = request.args.get('from')
+	try:
+		start = datetime.strptime(start, TIME_FORMAT) if start else datetime.utcnow()
+	except ValueError:
+		abort(400)
+	if not 0 < hours <= myapp.config['BOARD_MAX_HOURS']:
+		abort(400)
+	end = start + timedelta(hours=hours)
 
-	return jsonify(matches=response)
+	fragments = myapp.extensions['boards'].window(sport.id, start, end)
+	# The events are already serialized, only the envelope is encoded here
+	head = dumps(dict(sport=sport.asDict(), start=str(start), end=str(end)))
+	return Response(
+		'%s,"matches":[%s]}' % (head[:-1], ','.join(fragments)),
+		mimetype='application/json'
+	)
 
 
 @myapp.route('/api/match/<string:sportName>', methods=['GET'])
@@ -61,33 +230,39 @@ def getMatchesBySport(sportName):
 	"""Given a valid sport name, this api returns a list of events related to 
 	the sport, also takes an optional ordering parameter which by default 
 	orders by event name in asc, startTime (if selection) in descending order.
-	Example url: http://localhost:5000/api/match/football?ordering=startTime
+	The list is paged, see listingPage for the limit, after and fields parameters.
+	The response carries an ETag derived from the sport aggregate version.
+	Example url: http://localhost:5000/api/match/football?ordering=startTime&limit=50
 
 	@param str sportName: Name of the sport like Football.
 	@return list: Ordered list of matches for the selected sport.
 	"""
-	response = []
-	# Check if the sport name is valid
-	sport = Sport.query.filter(func.lower(Sport.name) == func.lower(sportName)).first_or_404()
-		
-	# Raise if requested ordering column is not valid
-	orderBy = request.args.get('ordering')
-	if orderBy and not getattr(Event, orderBy):
-		myapp.logger.error('Column %s is not valid', orderBy)
-		abort(404)
+	def build():
+		# Check if the sport name is valid
+		sport = Sport.byName(sportName).first_or_404()
 
-	# Only set desc order for startTime and set default ordering colum as name
-	orderBy = orderBy or 'name'
-	orderBy = desc(orderBy) if orderBy == 'startTime' else orderBy
+		# Raise if requested ordering column is not valid, set default ordering
+		# colum as name (startTime is in descending order)
+		orderBy = request.args.get('ordering') or 'name'
+		if orderBy not in ORDERINGS:
+			myapp.logger.error('Column %s is not valid', orderBy)
+			abort(404)
 
-	events = Event.query.filter_by(sportId=sport.id)
-	for event in events.order_by(orderBy):
-		myapp.logger.info('Event found: %s', event.name)
-		res = event.asDict()
-		res.update({'url': request.base_url.replace(sportName, str(event.id))})
-		response.append(res)
+		return listingPage(
+			[Event.sportId == sport.id],
+			orderBy,
+			lambda eventId: request.base_url.replace(sportName, str(eventId))
+		)
+
+	def etag():
+		sport = db.session.query(Sport.id, Sport.version).filter_by(
+			nameKey=Sport.normalizeName(sportName)
+		).first()
+		if sport is None:
+			abort(404)
+		return 's%d-%d' % sport
 
-	return jsonify(matches=response)
+	return cachedJson('sport', Sport.normalizeName(sportName), build, etag)
 
 
 @myapp.route('/api/match/', methods=['POST'])
@@ -97,73 +272,247 @@ def messageHandler():
 	 - NewEvent: A complete new sporting event is being created.
 	 - UpdateOdds: There is an update for the odds field (all the other fields 
 	remain unchanged)
+	The body can also be a list of messages, in which case they are all validated
+	and applied in a single transaction and a list of per message results is
+	returned in the same order.
+	When write behind is enabled a single UpdateOdds is only queued and the api
+	answers 202 right away (429 when the queue is full).
 	Url for POST: http://localhost:5000/api/match/
 
 	@return Response: Appropriate response object with data as appropriate
 	"""
 	content = request.json
-	messageType = content['message_type']
-	event = content['event']
-	# We assume there is only one market i.e. Winning, hence the [0]
-	market = event['markets'][0]
-
-	# Block that handles creation of a new match record (asumes a valid sport
-	# is available and supplied in this event data)
-	if messageType == 'NewEvent':
-		# Check if sport id is valid
-		sport = Sport.query.filter_by(id=event['sport']['id']).first_or_404()
-		newEvent = Event(
-			name=event['name'],
-			startTime=datetime.strptime(
-				event['startTime'], 
-				'%Y-%m-%d %H:%M:%S'
-			),
-			sport=sport
-		)
-		
-		# Create the market, assuming an instance of market is unique to an event
-		newMarket = Market(name=market['name'], event=newEvent)
-		
-		# Create the initial set of selections w/o restricting collection length
-		for selection in market['selections']:
-			newSelection = Selection(
-				name=selection['name'], 
-				odds=selection['odds'], 
-				market=newMarket
-			)
-			db.session.add(newSelection)
-		
-		db.session.commit()
-		myapp.logger.info('New event %s created', newEvent.name)
-		return Response('Event created', 201)
-	
-	
-	# Block that handles update odds (only) request, ensures no other fields are updated 
-	elif messageType == 'UpdateOdds':
-		# Check if event id is valid
-		selEvent = Event.query.filter_by(id=event['id']).first_or_404()
-		myapp.logger.info('Selected event is %s', selEvent.name)
-
-		# Now that we know event is valid, we find the  market and retrieve its selections
-		selMarket = Market.query.filter_by(eventId=selEvent.id).first_or_404()
-		newOddsMap = dict((sel['id'], sel['odds']) for sel in market['selections'])
-
-		for selection in selMarket.selections:
-			newOdds = newOddsMap.get(selection.id)
-			# Check if None to get 0.0 pass in as valid
-			if newOdds is not None and newOdds != selection.odds:
-				selection.odds = newOdds
-				myapp.logger.info(
-					'Selection %s updated with odds %f', 
-					selection.name, 
-					selection.odds
-				)
-
-		db.session.commit()
-		return Response('', 204)
-		
-	myapp.logger.error('Message type %s is not valid', messageType)
-	return Response('Bad request', 400)
+	if isinstance(content, list):
+		if len(content) > myapp.config['BATCH_MAX_MESSAGES']:
+			abort(413)
+		return jsonify(results=applyMessages(content))
+
+	writeBehind = myapp.extensions.get('writeBehind')
+	# Any other body is answered by applyMessages, a 400 for what is not a message
+	if (writeBehind is not None and isinstance(content, dict)
+			and content.get('message_type') == 'UpdateOdds'):
+		try:
+			event = content['event']
+			selections = [
+				(sel['id'], sel['odds'])
+				for sel in event['markets'][0]['selections']
+				if sel.get('odds') is not None
+			]
+			writeBehind.put(event['id'], selections)
+		except (KeyError, IndexError, TypeError, AttributeError):
+			return Response('Bad request', 400)
+		except QueueFull:
+			return Response('Too many pending updates', 429)
+		return Response('', 202)
+
+	result = applyMessages([content])[0]
+	if result['status'] == 404:
+		abort(404)
+	return Response(result['message'], result['status'])
+
+
+@myapp.route('/api/match/stream', methods=['POST'])
+def streamHandler():
+	"""Long lived ingestion api for the odds feed, the body is a (possibly chunked)
+	stream of newline delimited json messages, each one shaped like the body of
+	the match POST. Messages are applied as they arrive and committed in micro
+	batches, the response reports what was done once the stream ends. Lines over
+	STREAM_MAX_LINE_SIZE bytes are skipped and counted as invalid.
+	Url for POST: http://localhost:5000/api/match/stream
+
+	@return json: counters of received messages, committed batches and outcomes
+	"""
+	stream = request.stream
+	summary = applyStream(
+		readLines(stream.readline, myapp.config['STREAM_MAX_LINE_SIZE']),
+		myapp.config['STREAM_BATCH_SIZE'],
+		myapp.config['STREAM_BATCH_INTERVAL'],
+	)
+	myapp.logger.info('Stream of %d messages applied', summary['received'])
+	return jsonify(summary)
+
+
+@myapp.route('/api/changes/', methods=['GET'])
+def getOddsChanges():
+	"""Delta feed of the odds, returns the changes recorded after the since sequence
+	number oldest first, at most limit of them and optionally only for one sport.
+	Clients pass back the returned last sequence number to fetch the next page, a
+	410 means changes after since were already pruned and a full resync is needed.
+	Example url: http://localhost:5000/api/changes/?since=120&limit=500&sport=football
+
+	@return json: changes, the last sequence number and whether more changes follow
+	"""
+	since = request.args.get('since', 0, type=int)
+	limit = request.args.get('limit', myapp.config['CHANGES_PAGE_SIZE'], type=int)
+	limit = max(1, min(limit, myapp.config['CHANGES_MAX_PAGE_SIZE']))
+
+	sportId = None
+	sportName = request.args.get('sport')
+	if sportName:
+		sportId = Sport.byName(sportName).first_or_404().id
+
+	if mustResync(since):
+		abort(410)
+
+	# One extra row tells if another page follows
+	changes = changesSince(since, limit + 1, sportId)
+	more = len(changes) > limit
+	changes = changes[:limit]
+	return jsonify(
+		changes=[change.asDict() for change in changes],
+		last=changes[-1].seq if changes else since,
+		more=more,
+	)
+
+
+def historyTime(name, default):
+	"""Reads a time query parameter given either in milliseconds since the epoch
+	or in the TIME_FORMAT of the feed (UTC), aborts with a 400 when invalid
+
+	@param str name: name of the query parameter
+	@param int default: value in milliseconds when the parameter is missing
+	@return int: milliseconds since the epoch
+	"""
+	value = request.args.get(name)
+	if value is None:
+		return default
+	if value.isdigit():
+		return int(value)
+	try:
+		parsed = datetime.strptime(value, TIME_FORMAT)
+	except ValueError:
+		abort(400)
+	return int(calendar.timegm(parsed.timetuple()) * 1000)
+
+
+def historyWindow():
+	"""Returns the (start, end, bucket) in milliseconds of a history request"""
+	end = historyTime('to', nowMs())
+	start = historyTime('from', end - myapp.config['HISTORY_WINDOW'] * 1000)
+	bucket = request.args.get('bucket', 0, type=int)
+	if start >= end or bucket < 0:
+		abort(400)
+	return bucketWindow(start, end, bucket * 1000, myapp.config['HISTORY_MAX_POINTS'])
+
+
+@myapp.route('/api/history/selection/<int:selectionId>', methods=['GET'])
+def getSelectionHistory(selectionId):
+	"""Price series of a selection over a time window, downsampled into buckets
+	holding the last, min and max odds. The window defaults to the last
+	HISTORY_WINDOW seconds and the bucket (seconds) is widened as needed so a
+	series has about HISTORY_MAX_POINTS buckets at most, buckets of a minute or
+	more are whole minutes over a window widened to whole minutes.
+	Example url: http://localhost:5000/api/history/selection/1?from=2018-11-20 00:00:00&bucket=60
+
+	@param int selectionId: Selection identifier
+	@return json: the window, the bucket width and the series (times in milliseconds)
+	"""
+	selection = Selection.query.get_or_404(selectionId)
+	start, end, bucket = historyWindow()
+	return jsonify(
+		id=selection.id,
+		name=selection.name,
+		start=start,
+		end=end,
+		bucket=bucket,
+		series=series([selection.id], start, end, bucket)[selection.id],
+	)
+
+
+@myapp.route('/api/history/market/<int:marketId>', methods=['GET'])
+def getMarketHistory(marketId):
+	"""Price series of every selection of a market, same parameters as the
+	selection history.
+	Example url: http://localhost:5000/api/history/market/1?bucket=300
+
+	@param int marketId: Market identifier
+	@return json: the window, the bucket width and one series per selection
+	"""
+	market = Market.query.get_or_404(marketId)
+	start, end, bucket = historyWindow()
+	selections = marketSelections(market.id)
+	allSeries = series([selId for selId, _ in selections], start, end, bucket)
+	return jsonify(
+		id=market.id,
+		name=market.name,
+		start=start,
+		end=end,
+		bucket=bucket,
+		selections=[
+			dict(id=selId, name=name, series=allSeries[selId]) for selId, name in selections
+		],
+	)
+
+
+@myapp.route('/metrics', methods=['GET'])
+def getMetrics():
+	"""Request latencies, sql statements and time, payload sizes (per route) and
+	document cache counters in the prometheus text format, see app.metrics.
+	Example url: http://localhost:5000/metrics
+
+	@return Response: text/plain metrics exposition
+	"""
+	metrics = myapp.extensions.get('metrics')
+	if metrics is None:
+		abort(404)
+	return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def pushStream(topics):
+	"""Subscribes to the topics and streams what gets published to them as server
+	sent events, with keep alive comments while idle. The stream ends with a
+	dropped event when the client falls too far behind.
+
+	@param list topics: topics to subscribe to
+	@return Response: never ending text/event-stream response
+	"""
+	broker = myapp.extensions['pushBroker']
+	subscriber = broker.subscribe(topics)
+	heartbeat = myapp.config['PUSH_HEARTBEAT']
+
+	def stream():
+		try:
+			yield ': subscribed\n\n'
+			while True:
+				payload = subscriber.get(timeout=heartbeat)
+				if payload is None:
+					yield ': keepalive\n\n'
+					continue
+				yield payload
+				if payload is DROPPED:
+					return
+		finally:
+			broker.unsubscribe(subscriber)
+
+	return Response(
+		stream(),
+		mimetype='text/event-stream',
+		headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+	)
+
+
+@myapp.route('/api/push/match/<int:matchId>', methods=['GET'])
+def pushMatch(matchId):
+	"""Server sent events stream of the odds changes of a match.
+	Example url: http://localhost:5000/api/push/match/1
+
+	@param int matchId: Match id number.
+	@return Response: text/event-stream of UpdateOdds events
+	"""
+	Event.query.filter_by(id=matchId).first_or_404()
+	return pushStream([('event', matchId)])
+
+
+@myapp.route('/api/push/sport/<string:sportName>', methods=['GET'])
+def pushSport(sportName):
+	"""Server sent events stream of the odds changes and new matches of a sport.
+	Example url: http://localhost:5000/api/push/sport/football
+
+	@param str sportName: Name of the sport like Football.
+	@return Response: text/event-stream of UpdateOdds and NewEvent events
+	"""
+	sport = Sport.byName(sportName).first_or_404()
+	return pushStream([('sport', sport.id)])
 
 
 if __name__ == '__main__':
@@ -3,13 +3,62 @@
 """This module unit tests for the rester APIS in server.py
 author: supratim.ghosh1@gmail.com
 """
-from app.models import Sport, Event, Market, Selection
+from app.models import Sport, Event, Market, Selection, OddsHistory, OddsRollup
+from app.history import recordHistory
+from app.writebehind import OddsWriteBehind
+from app.push import Broker, DROPPED
+from app.writer import SerialWriter
+from app.metrics import RequestStats, setRequestStats
+from app.follower import ChangeFollower
+from app import changelog, messages, ProdConfig
 from app import db, getOrCreate
 from server import myapp
 
+from app.bulkload import loadEvents
+from app import bulkload
+from app.messages import applyStream
+from app.listing import encodeCursor, pageRows
+from app.cache import DocumentCache
+from app.serialize import encodeListing, encodeMatches, matchRows, SELECTION
+
+from sqlalchemy import event as sqlEvent
+from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError, OperationalError
+from contextlib import contextmanager
 from datetime import datetime
+import subprocess
+import pstats
+import threading
+import logging
+import tempfile
+import socket
+import sys
+import shutil
+import os
 import unittest
+import time
 import json
+import re
+
+try:
+    from httplib import HTTPConnection
+except ImportError:
+    from http.client import HTTPConnection
+
+
+@contextmanager
+def countQueries():
+    """Collects every SQL statement sent to the engine while the block runs"""
+    statements = []
+
+    def _collect(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    sqlEvent.listen(db.engine, 'before_cursor_execute', _collect)
+    try:
+        yield statements
+    finally:
+        sqlEvent.remove(db.engine, 'before_cursor_execute', _collect)
 
 
 class TestBetApp(unittest.TestCase):
@@ -23,6 +72,9 @@ class TestBetApp(unittest.TestCase):
     	self.client = self.app.test_client()
 
     	# The cleanup and schema creation
+        self.cache = self.app.extensions['documentCache']
+        self.cache.clear()
+        self.app.extensions['boards'].clear()
     	db.session.close()
     	db.drop_all()
     	db.create_all()
@@ -335,5 +387,1438 @@ class TestBetApp(unittest.TestCase):
         self.assertEqual(response.status_code, 404)
 
 
+    def testMatchByIdQueryCountIsFixed(self):
+        """Assert that loading a match costs the same number of queries no matter
+        how many markets and selections the event has
+        """
+        event = Event.query.get(2)
+        for marketName in ('First Goal', 'Half Time', 'Corners'):
+            market = Market(name=marketName, event=event)
+            for selName in ('Spain', 'Germany', 'Draw', 'None'):
+                db.session.add(Selection(name=selName, odds=2.5, market=market))
+        db.session.commit()
+        db.session.remove()
+
+        with countQueries() as small:
+            response = self.client.get('http://localhost:5000/api/match/1')
+        self.assertEqual(len(json.loads(response.data)['markets']), 1)
+        db.session.remove()
+
+        with countQueries() as large:
+            response = self.client.get('http://localhost:5000/api/match/2')
+        markets = json.loads(response.data)['markets']
+        self.assertEqual(len(markets), 4)
+        self.assertEqual(sum(len(m['selections']) for m in markets), 14)
+        # The version lookup for the ETag plus the single event tree query
+        self.assertEqual(len(small), 2)
+        self.assertEqual(len(large), len(small))
+
+
+    def _oddsMessage(self, eventId, selections):
+        return {
+            'message_type': 'UpdateOdds',
+            'event': {
+                'id': eventId,
+                'markets': [
+                    {'selections': [{'id': i, 'odds': o} for i, o in selections]}
+                ]
+            }
+        }
+
+
+    def testBatchMessagesPerMessageResults(self):
+        """Assert that a batch is applied in one go and that every message gets
+        its own result in the order it was sent
+        """
+        newEvent = {
+            'message_type': 'NewEvent',
+            'event': {
+                'name': 'Celta de Vigo vs Eibar',
+                'startTime': '2018-11-22 22:40:00',
+                'sport': {'id': 2, 'name': 'Football'},
+                'markets': [
+                    {
+                        'name': 'Winner',
+                        'selections': [
+                            {'name': 'Celta de Vigo', 'odds': 1.01},
+                            {'name': 'Eibar', 'odds': 1.01}
+                        ]
+                    }
+                ]
+            }
+        }
+        badSport = json.loads(json.dumps(newEvent))
+        badSport['event']['sport']['id'] = 420
+        payload = [
+            newEvent,
+            self._oddsMessage(1, [(1, 2.5), (2, 1.5)]),
+            self._oddsMessage(2, [(3, 3.5)]),
+            self._oddsMessage(123, [(1, 7.0)]),
+            # Selection 1 does not belong to event 3, it must be left untouched
+            self._oddsMessage(3, [(5, 4.5), (1, 8.0)]),
+            self._oddsMessage(1, [(1, 2.75)]),
+            badSport,
+            {'message_type': 'DeleteEvent', 'event': {'markets': [{}]}},
+            {'event': {}},
+        ]
+        with countQueries() as statements:
+            response = self.client.post(
+                'http://localhost:5000/api/match/',
+                data=json.dumps(payload),
+                content_type='application/json'
+            )
+        self.assertEqual(response.status_code, 200)
+        statuses = [r['status'] for r in json.loads(response.data)['results']]
+        self.assertEqual(statuses, [201, 204, 204, 404, 204, 204, 404, 400, 400])
+        updates = [s for s in statements if s.startswith('UPDATE selection')]
+        self.assertEqual(len(updates), 1)
+
+        db.session.remove()
+        odds = dict((s.id, s.odds) for s in Selection.query)
+        self.assertEqual(odds[1], 2.75)
+        self.assertEqual(odds[2], 1.5)
+        self.assertEqual(odds[3], 3.5)
+        self.assertEqual(odds[5], 4.5)
+        self.assertEqual(Event.query.filter_by(name='Celta de Vigo vs Eibar').count(), 1)
+
+
+    def testStreamIngestionMicroBatches(self):
+        """Assert that a ndjson stream is applied in micro batches and that the
+        summary accounts for every line
+        """
+        self.addCleanup(
+            self.app.config.update,
+            STREAM_BATCH_SIZE=self.app.config['STREAM_BATCH_SIZE']
+        )
+        self.app.config['STREAM_BATCH_SIZE'] = 2
+        lines = [
+            json.dumps(self._oddsMessage(1, [(1, 2.0)])),
+            json.dumps(self._oddsMessage(2, [(3, 3.0)])),
+            '',
+            'not json',
+            json.dumps(self._oddsMessage(404, [(1, 9.0)])),
+            json.dumps(self._oddsMessage(1, [(1, 4.0)])),
+            json.dumps(self._oddsMessage(3, [(5, 5.0)])),
+        ]
+        response = self.client.post(
+            'http://localhost:5000/api/match/stream',
+            data='\n'.join(lines) + '\n',
+            content_type='application/x-ndjson'
+        )
+        self.assertEqual(response.status_code, 200)
+        summary = json.loads(response.data)
+        self.assertEqual(summary['received'], 6)
+        self.assertEqual(summary['batches'], 3)
+        self.assertEqual(summary['updated'], 4)
+        self.assertEqual(summary['notFound'], 1)
+        self.assertEqual(summary['invalid'], 1)
+
+        db.session.remove()
+        odds = dict((s.id, s.odds) for s in Selection.query)
+        self.assertEqual((odds[1], odds[3], odds[5]), (4.0, 3.0, 5.0))
+
+
+    def testStreamFlushesIdleBatchesAndSkipsLongLines(self):
+        """Assert that a partial batch is committed once the interval elapsed while
+        the client is idle and that lines over the size limit are counted invalid
+        """
+        self.addCleanup(
+            self.app.config.update,
+            STREAM_MAX_LINE_SIZE=self.app.config['STREAM_MAX_LINE_SIZE']
+        )
+        self.app.config['STREAM_MAX_LINE_SIZE'] = 200
+        applyCommitted = messages.applyCommitted
+        self.addCleanup(setattr, messages, 'applyCommitted', applyCommitted)
+        applied = threading.Event()
+        def signalApplied(*args):
+            applyCommitted(*args)
+            applied.set()
+        messages.applyCommitted = signalApplied
+        committed = []
+
+        def lines():
+            # Read on the reader thread, which must stay off the database: the
+            # test database is a single connection shared by every thread
+            yield json.dumps(self._oddsMessage(1, [(1, 2.0)])) + '\n'
+            # Idle long past the batch interval, the first message is committed
+            # without waiting for the next line
+            committed.append(applied.wait(2.5))
+            yield json.dumps(self._oddsMessage(2, [(3, 3.0)])) + '\n'
+
+        summary = applyStream(lines(), 500, 0.1)
+        self.assertEqual(committed, [True])
+        self.assertEqual((summary['batches'], summary['updated']), (2, 2))
+        db.session.remove()
+        self.assertEqual(Selection.query.get(1).odds, 2.0)
+
+        body = '\n'.join([
+            json.dumps(self._oddsMessage(1, [(1, 4.0)])),
+            'x' * 1000,
+            json.dumps(self._oddsMessage(3, [(5, 5.0)])),
+        ])
+        response = self.client.post(
+            'http://localhost:5000/api/match/stream',
+            data=body,
+            content_type='application/x-ndjson'
+        )
+        summary = json.loads(response.data)
+        self.assertEqual((summary['received'], summary['updated'], summary['invalid']), (3, 2, 1))
+
+
+    def _enableWriteBehind(self, maxPending):
+        writeBehind = OddsWriteBehind(self.app, maxPending, interval=60)
+        self.app.extensions['writeBehind'] = writeBehind
+        self.addCleanup(self.app.extensions.pop, 'writeBehind')
+        return writeBehind
+
+
+    def _postMessage(self, payload):
+        return self.client.post(
+            'http://localhost:5000/api/match/',
+            data=json.dumps(payload),
+            content_type='application/json'
+        )
+
+
+    def testWriteBehindCoalescesOdds(self):
+        """Assert that queued odds are acknowledged with 202, coalesced per selection
+        and that the latest odds are the ones written on flush
+        """
+        writeBehind = self._enableWriteBehind(maxPending=3)
+        for odds in (2.0, 3.0, 4.0):
+            response = self._postMessage(self._oddsMessage(1, [(1, odds)]))
+            self.assertEqual(response.status_code, 202)
+        response = self._postMessage(self._oddsMessage(1, [(2, 5.0)]))
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(len(writeBehind), 2)
+
+        # Nothing is written until the queue is flushed
+        db.session.remove()
+        self.assertEqual(Selection.query.get(1).odds, 1.01)
+        self.assertEqual(writeBehind.flush(), 2)
+        self.assertEqual(len(writeBehind), 0)
+        db.session.remove()
+        self.assertEqual(Selection.query.get(1).odds, 4.0)
+        self.assertEqual(Selection.query.get(2).odds, 5.0)
+
+
+    def testWriteBehindBackpressure(self):
+        """Assert that the api answers 429 once the queue is full and that existing
+        selections can still be overwritten
+        """
+        writeBehind = self._enableWriteBehind(maxPending=2)
+        response = self._postMessage(self._oddsMessage(1, [(1, 2.0), (2, 3.0)]))
+        self.assertEqual(response.status_code, 202)
+        response = self._postMessage(self._oddsMessage(2, [(3, 4.0)]))
+        self.assertEqual(response.status_code, 429)
+        response = self._postMessage(self._oddsMessage(1, [(2, 6.0)]))
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(len(writeBehind), 2)
+
+
+    def testWriteBehindDrainsOnStop(self):
+        """Assert that stopping the background worker flushes the pending odds"""
+        writeBehind = self._enableWriteBehind(maxPending=10).start()
+        response = self._postMessage(self._oddsMessage(2, [(3, 7.5)]))
+        self.assertEqual(response.status_code, 202)
+        writeBehind.stop()
+        self.assertEqual(len(writeBehind), 0)
+        db.session.remove()
+        self.assertEqual(Selection.query.get(3).odds, 7.5)
+
+
+    def testWriteBehindLogsRejectedOdds(self):
+        """Assert that the odds the flush could not apply are logged"""
+        writeBehind = self._enableWriteBehind(maxPending=10)
+        self._postMessage(self._oddsMessage(404, [(99, 2.0)]))
+        self._postMessage(self._oddsMessage(1, [(1, 3.0)]))
+        warnings = []
+        handler = logging.Handler(logging.WARNING)
+        handler.emit = lambda record: warnings.append(record.getMessage())
+        self.app.logger.addHandler(handler)
+        self.addCleanup(self.app.logger.removeHandler, handler)
+
+        self.assertEqual(writeBehind.flush(), 2)
+        self.assertEqual(len(warnings), 1)
+        self.assertIn('event 404: 404 Event not found', warnings[0])
+        db.session.remove()
+        self.assertEqual(Selection.query.get(1).odds, 3.0)
+
+
+    def testWriteBehindRejectsMalformedBodies(self):
+        """Assert that bodies and selections that are not objects answer 400 in
+        write behind mode
+        """
+        writeBehind = self._enableWriteBehind(maxPending=10)
+        for payload in ('UpdateOdds', 42, None):
+            self.assertEqual(self._postMessage(payload).status_code, 400)
+        message = self._oddsMessage(1, [(1, 2.0)])
+        message['event']['markets'][0]['selections'].append('odds')
+        self.assertEqual(self._postMessage(message).status_code, 400)
+        self.assertEqual(len(writeBehind), 0)
+
+
+    def testDocumentCacheServesAndInvalidates(self):
+        """Assert that repeated reads are served from the cache without touching the
+        database and that writes only invalidate the documents they affect
+        """
+        matchUrl = 'http://localhost:5000/api/match/1'
+        sportUrl = 'http://localhost:5000/api/match/football'
+        self.assertEqual(self.client.get(matchUrl).headers['X-Cache'], 'MISS')
+        self.assertEqual(self.client.get(sportUrl).headers['X-Cache'], 'MISS')
+        with countQueries() as statements:
+            cached = self.client.get(matchUrl)
+            self.assertEqual(self.client.get(sportUrl).headers['X-Cache'], 'HIT')
+        self.assertEqual(cached.headers['X-Cache'], 'HIT')
+        self.assertEqual(statements, [])
+        self.assertEqual(self.cache.stats(), {'hits': 2, 'misses': 2, 'size': 2})
+
+        # Odds changes drop the match document but not the sport listing
+        self._postMessage(self._oddsMessage(1, [(1, 3.3)]))
+        response = self.client.get(matchUrl)
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        self.assertEqual(json.loads(response.data)['markets'][0]['selections'][0]['odds'], 3.3)
+        self.assertEqual(self.client.get(sportUrl).headers['X-Cache'], 'HIT')
+
+        # A new event drops the listings of its sport and name only
+        newEvent = {
+            'message_type': 'NewEvent',
+            'event': {
+                'name': 'Celta de Vigo vs Eibar',
+                'startTime': '2018-11-22 22:40:00',
+                'sport': {'id': 2, 'name': 'Football'},
+                'markets': [{'name': 'Winner', 'selections': []}]
+            }
+        }
+        self._postMessage(newEvent)
+        self.assertEqual(self.client.get(matchUrl).headers['X-Cache'], 'HIT')
+        response = self.client.get(sportUrl)
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        self.assertEqual(len(json.loads(response.data)['matches']), 3)
+
+
+    def testDocumentCacheBoundsTheVariants(self):
+        """Assert that parameters which do not change a document share its cached
+        body, that the variants of a document are capped and that every body
+        counts against the size of the cache
+        """
+        for nonce in range(50):
+            response = self.client.get('http://localhost:5000/api/match/1?nonce=%d' % nonce)
+            self.assertEqual(response.headers['X-Cache'], 'MISS' if nonce == 0 else 'HIT')
+        self.assertEqual(json.loads(response.data)['url'], 'http://localhost:5000/api/match/1')
+        self.assertEqual(len(self.cache), 1)
+
+        maxVariants = self.app.config['DOCUMENT_CACHE_VARIANTS']
+        for limit in range(1, maxVariants + 10):
+            self.client.get('http://localhost:5000/api/match/football?limit=%d' % limit)
+        self.assertEqual(len(self.cache), 1 + maxVariants)
+        # The most recent variants are the ones kept
+        response = self.client.get('http://localhost:5000/api/match/football?limit=%d' % limit)
+        self.assertEqual(response.headers['X-Cache'], 'HIT')
+
+        # Whole groups are evicted, the least recently used first
+        cache = DocumentCache(maxSize=7, maxVariants=3)
+        for ident in range(3):
+            for variant in range(4):
+                cache.set('match', ident, variant, 'body', cache.token('match', ident))
+        self.assertEqual(len(cache), 6)
+        self.assertEqual(cache.get('match', 0, 3), None)
+        self.assertEqual(cache.get('match', 2, 0), None)
+        self.assertEqual(cache.get('match', 2, 3), 'body')
+        cache.invalidate('match', 2)
+        self.assertEqual(len(cache), 3)
+
+
+    def testConditionalGetByEventVersion(self):
+        """Assert that polls sending back the ETag get a 304 without the event
+        tree being loaded, until the odds of the event change
+        """
+        matchUrl = 'http://localhost:5000/api/match/1'
+        response = self.client.get(matchUrl)
+        etag = response.headers['ETag']
+        self.assertEqual(etag, '"e1-0"')
+
+        # Even when the document is not cached only the version is looked up
+        self.cache.clear()
+        with countQueries() as statements:
+            response = self.client.get(matchUrl, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(response.data, b'')
+        response = self.client.get(matchUrl, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        # Unchanged odds do not bump the version, changed ones do
+        self._postMessage(self._oddsMessage(1, [(1, 1.01)]))
+        response = self.client.get(matchUrl, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self._postMessage(self._oddsMessage(1, [(1, 1.5)]))
+        response = self.client.get(matchUrl, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['ETag'], '"e1-1"')
+
+
+    def testConditionalGetBySportVersion(self):
+        """Assert that the sport listing is tagged with the sport aggregate version"""
+        sportUrl = 'http://localhost:5000/api/match/football'
+        etag = self.client.get(sportUrl).headers['ETag']
+        self.assertEqual(etag, '"s2-0"')
+        response = self.client.get(sportUrl, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        # The listing carries no odds, an odds change leaves its version as it is
+        self._postMessage(self._oddsMessage(2, [(3, 2.2)]))
+        response = self.client.get(sportUrl, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], '"s2-0"')
+
+        # A new event changes the listing, the cached one is not served any more
+        self._postMessage({
+            'message_type': 'NewEvent',
+            'event': {
+                'name': 'Wales Vs Chile',
+                'startTime': '2018-11-25 20:00:00',
+                'sport': {'id': 2},
+                'markets': [{'name': 'Winner', 'selections': []}]
+            }
+        })
+        response = self.client.get(sportUrl, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['ETag'], '"s2-1"')
+        self.assertIn('Wales Vs Chile', response.data)
+        response = self.client.get(sportUrl, headers={'If-None-Match': '"s2-1"'})
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get('http://localhost:5000/api/match/cricket')
+        self.assertEqual(response.headers['ETag'], '"s1-0"')
+
+
+    def testOddsChangesSinceSequence(self):
+        """Assert that every applied odds change is logged with a sequence number and
+        that the delta feed pages through them, optionally filtered by sport
+        """
+        self._postMessage([
+            self._oddsMessage(1, [(1, 2.0), (2, 2.1)]),
+            self._oddsMessage(2, [(3, 3.0)]),
+        ])
+        # Unchanged odds are not logged
+        self._postMessage(self._oddsMessage(3, [(5, 5.0), (6, 1.01)]))
+
+        url = 'http://localhost:5000/api/changes/'
+        page = json.loads(self.client.get(url, query_string={'limit': 3}).data)
+        self.assertEqual([c['seq'] for c in page['changes']], [1, 2, 3])
+        self.assertTrue(page['more'])
+        page = json.loads(self.client.get(url, query_string={'since': page['last']}).data)
+        self.assertEqual(
+            [(c['seq'], c['selectionId'], c['odds']) for c in page['changes']],
+            [(4, 5, 5.0)]
+        )
+        self.assertFalse(page['more'])
+
+        page = json.loads(self.client.get(url, query_string={'sport': 'cricket'}).data)
+        self.assertEqual(
+            sorted((c['selectionId'], c['odds']) for c in page['changes']),
+            [(1, 2.0), (2, 2.1)]
+        )
+        self.assertEqual(
+            self.client.get(url, query_string={'sport': 'cooking'}).status_code, 404
+        )
+
+
+    def testOddsChangesPruning(self):
+        """Assert that pruning keeps the latest changes and that clients behind the
+        pruned part of the log are told to resync
+        """
+        for odds in (2.0, 3.0, 4.0, 5.0):
+            self._postMessage(self._oddsMessage(1, [(1, odds)]))
+        with self.app.app_context():
+            self.assertEqual(changelog.prune(maxAge=3600, maxRows=2), 2)
+            self.assertEqual(changelog.prune(maxAge=0), 2)
+
+        # Pruned empty, only the clients that saw the last change are in sync
+        url = 'http://localhost:5000/api/changes/'
+        self.assertEqual(self.client.get(url, query_string={'since': 3}).status_code, 410)
+        page = json.loads(self.client.get(url, query_string={'since': 4}).data)
+        self.assertEqual(page['changes'], [])
+
+        self._postMessage(self._oddsMessage(1, [(1, 6.0)]))
+        self.assertEqual(self.client.get(url).status_code, 410)
+        page = json.loads(self.client.get(url, query_string={'since': 4}).data)
+        self.assertEqual([c['seq'] for c in page['changes']], [5])
+
+
+    def testFailedPruneDoesNotFailTheWrite(self):
+        """Assert that the odds are applied and the request succeeds when pruning
+        the log after the commit fails
+        """
+        self.addCleanup(
+            self.app.config.update,
+            CHANGE_LOG_PRUNE_EVERY=self.app.config['CHANGE_LOG_PRUNE_EVERY']
+        )
+        self.app.config['CHANGE_LOG_PRUNE_EVERY'] = 1
+        prune = changelog.prune
+        self.addCleanup(setattr, changelog, 'prune', prune)
+
+        def failingPrune(*args):
+            raise RuntimeError('disk I/O error')
+        changelog.prune = failingPrune
+
+        response = self._postMessage(self._oddsMessage(1, [(1, 2.5)]))
+        self.assertEqual(response.status_code, 204)
+        db.session.remove()
+        self.assertEqual(Selection.query.get(1).odds, 2.5)
+
+
+    def _newBroker(self, maxBuffer):
+        broker = Broker(maxBuffer)
+        self.addCleanup(
+            self.app.extensions.__setitem__, 'pushBroker', self.app.extensions['pushBroker']
+        )
+        self.app.extensions['pushBroker'] = broker
+        return broker
+
+
+    def _drain(self, subscriber):
+        payloads = []
+        payload = subscriber.get(timeout=0)
+        while payload is not None:
+            payloads.append(payload)
+            payload = subscriber.get(timeout=0)
+        return payloads
+
+
+    def testPushFanOutLoad(self):
+        """Load test: many concurrent subscribers of an event and a sport all get
+        every committed change exactly once
+        """
+        broker = self._newBroker(maxBuffer=10)
+        eventSubs = [broker.subscribe([('event', 1)]) for _ in range(1000)]
+        sportSubs = [broker.subscribe([('sport', 2)]) for _ in range(1000)]
+        both = broker.subscribe([('event', 1), ('sport', 1)])
+        received = dict((id(s), []) for s in eventSubs + sportSubs)
+
+        def consume(subscribers, expected):
+            for subscriber in subscribers:
+                while len(received[id(subscriber)]) < expected:
+                    payload = subscriber.get(timeout=5)
+                    if payload is None:
+                        return
+                    received[id(subscriber)].append(payload)
+
+        threads = [
+            threading.Thread(target=consume, args=(eventSubs[i::10], 1)) for i in range(10)
+        ] + [
+            threading.Thread(target=consume, args=(sportSubs[i::10], 2)) for i in range(10)
+        ]
+        for thread in threads:
+            thread.start()
+
+        newEvent = {
+            'message_type': 'NewEvent',
+            'event': {
+                'name': 'Celta de Vigo vs Eibar',
+                'startTime': '2018-11-22 22:40:00',
+                'sport': {'id': 2, 'name': 'Football'},
+                'markets': [{'name': 'Winner', 'selections': []}]
+            }
+        }
+        started = time.time()
+        self._postMessage([
+            self._oddsMessage(1, [(1, 2.0)]),
+            self._oddsMessage(2, [(3, 3.0)]),
+            newEvent,
+        ])
+        for thread in threads:
+            thread.join()
+        self.assertLess(time.time() - started, 10)
+
+        for subscriber in eventSubs:
+            payloads = received[id(subscriber)]
+            self.assertEqual(len(payloads), 1)
+            self.assertTrue(payloads[0].startswith('event: UpdateOdds\n'))
+            self.assertEqual(
+                json.loads(payloads[0].split('data: ')[1]),
+                {'eventId': 1, 'selections': [{'id': 1, 'odds': 2.0}]}
+            )
+        for subscriber in sportSubs:
+            payloads = received[id(subscriber)]
+            self.assertEqual(
+                [p.split('\n')[0] for p in payloads],
+                ['event: UpdateOdds', 'event: NewEvent']
+            )
+        # Subscribed to two topics of the same change, still notified once
+        self.assertEqual(len(self._drain(both)), 1)
+
+
+    def testPushDropsSlowConsumers(self):
+        """Assert that a subscriber that does not keep up is dropped and told so,
+        while the others keep receiving
+        """
+        broker = self._newBroker(maxBuffer=3)
+        slow = broker.subscribe([('event', 1)])
+        fast = broker.subscribe([('event', 1)])
+        for odds in (2.0, 3.0, 4.0, 5.0):
+            self._postMessage(self._oddsMessage(1, [(1, odds)]))
+            self.assertEqual(len(self._drain(fast)), 1)
+
+        payloads = self._drain(slow)
+        self.assertEqual(len(payloads), 4)
+        self.assertIs(payloads[-1], DROPPED)
+        self.assertTrue(slow.dropped)
+        self.assertEqual(len(broker), 1)
+
+
+    def testPushStreamEndpoint(self):
+        """Assert that the event stream endpoint delivers the odds changes of a match"""
+        broker = self._newBroker(maxBuffer=10)
+        response = self.client.get('http://localhost:5000/api/push/match/1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        chunks = iter(response.response)
+        self.assertEqual(next(chunks), b': subscribed\n\n')
+
+        self._postMessage(self._oddsMessage(1, [(2, 6.5)]))
+        chunk = next(chunks)
+        self.assertTrue(chunk.startswith(b'event: UpdateOdds\ndata: '))
+        self.assertEqual(json.loads(chunk.split(b'data: ')[1])['selections'][0]['odds'], 6.5)
+        response.close()
+        self.assertEqual(len(broker), 0)
+
+        response = self.client.get('http://localhost:5000/api/push/sport/cooking')
+        self.assertEqual(response.status_code, 404)
+
+
+    def _pages(self, url, **params):
+        pages = []
+        while True:
+            page = json.loads(self.client.get(url, query_string=params).data)
+            pages.append(page['matches'])
+            if 'next' not in page:
+                return pages
+            params['after'] = page['next']
+
+
+    def testMatchesBySportKeysetPagination(self):
+        """Assert that paging through a sport listing with a cursor returns every
+        event once in both orderings, ties on the sort column included
+        """
+        sport = Sport.query.get(2)
+        for day in (1, 1, 2, 3, 3):
+            db.session.add(Event(
+                name='Spain Vs Germany', startTime=datetime(2018, 12, day), sport=sport
+            ))
+        db.session.commit()
+        url = 'http://localhost:5000/api/match/football'
+
+        pages = self._pages(url, limit=2)
+        self.assertEqual([len(p) for p in pages], [2, 2, 2, 1])
+        ids = [m['id'] for p in pages for m in p]
+        self.assertEqual(ids, [3, 2, 4, 5, 6, 7, 8])
+
+        pages = self._pages(url, limit=3, ordering='startTime')
+        self.assertEqual([len(p) for p in pages], [3, 3, 1])
+        ids = [m['id'] for p in pages for m in p]
+        self.assertEqual(ids, [8, 7, 6, 5, 4, 2, 3])
+        self.assertEqual(pages[0][0]['url'], 'http://localhost:5000/api/match/8')
+
+        response = self.client.get(url, query_string={'after': 'garbage'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(url, query_string={'ordering': 'sportId'})
+        self.assertEqual(response.status_code, 404)
+
+
+    def testMatchesBySportPaginationOverNullSortValues(self):
+        """Assert that events without a start time or a name are paged through like
+        the others and that cursors with a sort value of the wrong type answer 400
+        """
+        sport = Sport.query.get(2)
+        db.session.add(Event(name=None, startTime=datetime(2018, 12, 1), sport=sport))
+        db.session.add(Event(name='Spain Vs Germany', startTime=None, sport=sport))
+        db.session.add(Event(name=None, startTime=None, sport=sport))
+        db.session.commit()
+        url = 'http://localhost:5000/api/match/football'
+
+        for limit in (1, 2, 4):
+            ids = [m['id'] for p in self._pages(url, limit=limit) for m in p]
+            self.assertEqual(ids, [4, 6, 3, 2, 5])
+            ids = [m['id'] for p in self._pages(url, limit=limit, ordering='startTime') for m in p]
+            self.assertEqual(ids, [4, 2, 3, 6, 5])
+
+        for value in (20181201, ['2018-12-01'], {'name': 'Spain'}):
+            for ordering in ('startTime', 'name'):
+                response = self.client.get(url, query_string={
+                    'ordering': ordering, 'after': encodeCursor(value, 2)
+                })
+                self.assertEqual(response.status_code, 400)
+
+
+    def testListingCursorPagesSeekTheSortIndex(self):
+        """Assert that a page after a cursor is an index range scan on the sort
+        column and that the events without a sort value are read by a query of
+        their own once the others run out
+        """
+        sport = Sport.query.get(2)
+        event = Event(name='Spain Vs Germany', startTime=None, sport=sport)
+        db.session.add(event)
+        db.session.commit()
+        statements = []
+
+        def collect(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement, parameters))
+
+        first, cursor = pageRows([Event.sportId == 2], 'startTime', ['id'], 1)
+        sqlEvent.listen(db.engine, 'before_cursor_execute', collect)
+        try:
+            rows, cursor = pageRows([Event.sportId == 2], 'startTime', ['id'], 10, cursor)
+        finally:
+            sqlEvent.remove(db.engine, 'before_cursor_execute', collect)
+        self.assertEqual([row[0] for row in first + rows], [2, 3, event.id])
+        self.assertIsNone(cursor)
+
+        plans = [
+            ' '.join(row[-1] for row in db.engine.execute('EXPLAIN QUERY PLAN ' + statement, parameters))
+            for statement, parameters in statements
+        ]
+        self.assertEqual(len(plans), 2)
+        self.assertIn('ix_event_sport_start (sportId=? AND startTime<?)', plans[0])
+        self.assertIn('ix_event_sport_start (sportId=? AND startTime=?)', plans[1])
+        for plan in plans:
+            self.assertNotIn('TEMP B-TREE', plan)
+
+
+    def testListingFieldProjection(self):
+        """Assert that only the requested fields are returned and selected"""
+        with countQueries() as statements:
+            response = self.client.get(
+                'http://localhost:5000/api/match/',
+                query_string={'name': 'Portugal Vs Italy', 'fields': 'name'}
+            )
+        self.assertEqual(json.loads(response.data), {
+            'matches': [
+                {'url': 'http://localhost:5000/api/match/3', 'name': 'Portugal Vs Italy'}
+            ]
+        })
+        listing = [s for s in statements if 'FROM event' in s and 'LIMIT' in s][0]
+        self.assertNotIn('sportId', listing)
+        response = self.client.get(
+            'http://localhost:5000/api/match/football',
+            query_string={'fields': 'name,odds'}
+        )
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(
+            'http://localhost:5000/api/match/football',
+            query_string={'fields': 'id,id'}
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+    def testSportLookupUsesNameKeyIndex(self):
+        """Assert that sports are looked up on their stored lower cased key and that
+        the plan of the lookup and of the listings go through an index
+        """
+        self.assertEqual(Sport.query.get(2).nameKey, 'football')
+        self.assertEqual(Sport.byName('FootBall').one().id, 2)
+        for statement in (
+            'SELECT id FROM sport WHERE "nameKey" = ?',
+            'SELECT id FROM event WHERE "sportId" = ? ORDER BY "startTime" DESC LIMIT 10',
+            'SELECT id FROM event WHERE "sportId" = ? ORDER BY name LIMIT 10',
+            'SELECT id FROM market WHERE "eventId" = ?',
+            'SELECT id FROM selection WHERE "marketId" = ?',
+        ):
+            plan = ' '.join(
+                row[-1] for row in db.engine.execute('EXPLAIN QUERY PLAN ' + statement, 1)
+            )
+            self.assertIn('USING', plan)
+            self.assertNotIn('TEMP B-TREE', plan)
+
+
+    def testProdProfileSqlitePragmas(self):
+        """Assert that the production profile turns echo off and that its pragmas
+        (WAL journal in particular) are applied to every new sqlite connection
+        """
+        self.assertFalse(ProdConfig.SQLALCHEMY_ECHO)
+        self.assertTrue(ProdConfig.SERIALIZED_WRITER)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.addCleanup(self.app.config.update, SQLITE_PRAGMAS=())
+        self.app.config['SQLITE_PRAGMAS'] = ProdConfig.SQLITE_PRAGMAS
+
+        engine = create_engine(
+            'sqlite:///%s' % os.path.join(directory, 'prod.db'),
+            **ProdConfig.SQLALCHEMY_ENGINE_OPTIONS
+        )
+        self.addCleanup(engine.dispose)
+        connection = engine.connect()
+        self.assertEqual(connection.execute('PRAGMA journal_mode').scalar(), 'wal')
+        self.assertEqual(connection.execute('PRAGMA synchronous').scalar(), 1)
+        self.assertEqual(connection.execute('PRAGMA cache_size').scalar(), -65536)
+        connection.close()
+
+
+    def testSerializedWriter(self):
+        """Assert that the writes of the message handler run on the writer thread,
+        one at a time, and that their errors reach the caller
+        """
+        writer = SerialWriter(self.app).start()
+        self.addCleanup(writer.stop)
+        self.app.extensions['serialWriter'] = writer
+        self.addCleanup(self.app.extensions.pop, 'serialWriter')
+
+        writers = set()
+        connections = set()
+        def _collect(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('UPDATE'):
+                writers.add(threading.current_thread().name)
+                connections.add(conn)
+        sqlEvent.listen(db.engine, 'before_cursor_execute', _collect)
+        self.addCleanup(sqlEvent.remove, db.engine, 'before_cursor_execute', _collect)
+
+        self.app.extensions['metrics'].clear()
+        response = self._postMessage(self._oddsMessage(1, [(1, 4.5)]))
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(writers, set(['serial-writer']))
+        # On the dedicated connection of the writer, not one checked out of the pool
+        self.assertEqual(connections, set([writer._connection]))
+        # The statements run on the writer count towards the posting request
+        metrics = self.app.extensions['metrics'].render()
+        statements = re.search(
+            r'betting_sql_statements_per_request_sum\{route="/api/match/"\} (\S+)', metrics
+        ).group(1)
+        self.assertGreater(float(statements), 0)
+        db.session.remove()
+        self.assertEqual(Selection.query.get(1).odds, 4.5)
+
+        state = {'running': 0, 'overlaps': 0, 'count': 0}
+        def write():
+            state['running'] += 1
+            state['overlaps'] += state['running'] > 1
+            time.sleep(0.001)
+            state['count'] += 1
+            state['running'] -= 1
+
+        threads = [
+            threading.Thread(target=lambda: [writer.submit(write) for _ in range(20)])
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((state['count'], state['overlaps']), (100, 0))
+
+        def fail():
+            raise ValueError('boom')
+        self.assertRaises(ValueError, writer.submit, fail)
+
+        # Once stopped the writer fails the submissions instead of leaving them waiting
+        writer.stop()
+        self.assertRaises(RuntimeError, writer.submit, write)
+        self.assertEqual(state['count'], 100)
+
+        # An exception that is not an Exception reaches the caller and stops the
+        # writer, the writes queued behind it fail instead of waiting forever
+        writer = SerialWriter(self.app).start()
+        self.addCleanup(writer.stop)
+        release = threading.Event()
+        def halt():
+            release.wait(5)
+            raise SystemExit('halt')
+        errors = {}
+        def submit(func):
+            try:
+                writer.submit(func)
+            except BaseException as error:
+                errors[func.__name__] = type(error)
+        threads = [threading.Thread(target=submit, args=(halt,))]
+        threads[0].start()
+        while writer._queue.qsize():
+            time.sleep(0.001)
+        threads.append(threading.Thread(target=submit, args=(write,)))
+        threads[1].start()
+        while not writer._queue.qsize():
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(errors, {'halt': SystemExit, 'write': RuntimeError})
+        self.assertRaises(RuntimeError, writer.submit, write)
+        self.assertEqual(state['count'], 100)
+
+
+    def testBulkLoadEventsCommand(self):
+        """Assert that the load-events command inserts the events of a csv and a
+        ndjson file in batches, resolving existing sports and creating new ones
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        csvPath = os.path.join(directory, 'events.csv')
+        with open(csvPath, 'w') as csvFile:
+            csvFile.write(
+                'sport,event,startTime,market,selection,odds\n'
+                'football,Chelsea Vs Arsenal,2018-12-01 15:00:00,Winner,Chelsea,2.1\n'
+                'football,Chelsea Vs Arsenal,2018-12-01 15:00:00,Winner,Arsenal,3.4\n'
+                'football,Chelsea Vs Arsenal,2018-12-01 15:00:00,Goals,Over,1.9\n'
+                'Tennis,Nadal Vs Federer,2018-12-02 12:00:00,Winner,Nadal,1.8\n'
+            )
+        ndjsonPath = os.path.join(directory, 'events.ndjson')
+        with open(ndjsonPath, 'w') as ndjsonFile:
+            for index in range(5):
+                ndjsonFile.write(json.dumps({
+                    'name': 'Event %d' % index,
+                    'startTime': '2018-12-03 12:00:00',
+                    'sport': {'id': 1},
+                    'markets': [{'name': 'Winner', 'selections': [
+                        {'name': 'Home', 'odds': 1.5}, {'name': 'Away', 'odds': 2.5}
+                    ]}],
+                }) + '\n')
+
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=['load-events', csvPath])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Loaded 1 sports, 2 events, 3 markets and 4 selections', result.output)
+        with countQueries() as statements:
+            result = runner.invoke(args=['load-events', ndjsonPath, '--batch-size', '4'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        inserts = [s for s in statements if s.startswith('INSERT INTO selection')]
+        self.assertEqual(len(inserts), 3)
+
+        db.session.remove()
+        chelsea = Event.query.filter_by(name='Chelsea Vs Arsenal').one()
+        self.assertEqual(chelsea.sport.name, 'Football')
+        self.assertEqual(
+            sorted((m.name, len(m.selections)) for m in chelsea.markets),
+            [('Goals', 1), ('Winner', 2)]
+        )
+        self.assertEqual(Sport.byName('tennis').one().events[0].name, 'Nadal Vs Federer')
+        self.assertEqual(Event.query.filter_by(sportId=1).count(), 6)
+        self.assertEqual(Selection.query.count(), 6 + 4 + 10)
+        response = self.client.get('http://localhost:5000/api/match/%d' % chelsea.id)
+        self.assertEqual(json.loads(response.data)['markets'][0]['selections'][0]['odds'], 2.1)
+
+
+    def testBulkLoadRefreshesCachedState(self):
+        """Assert that bulk loaded events reach the cached sport listings and the
+        loaded boards of the process, like the events of NewEvent messages
+        """
+        listingUrl = 'http://localhost:5000/api/match/football'
+        boardUrl = 'http://localhost:5000/api/board/football?from=2018-11-21 00:00:00&hours=48'
+        listing = self.client.get(listingUrl)
+        self.assertEqual(len(json.loads(listing.data)['matches']), 2)
+        self.assertEqual(len(json.loads(self.client.get(boardUrl).data)['matches']), 2)
+
+        connection = db.engine.connect()
+        try:
+            loadEvents(connection, [('Football', 'Chelsea Vs Arsenal', datetime(2018, 11, 21, 15), [
+                ('Winner', [('Chelsea', 2.1), ('Arsenal', 3.4)])
+            ])])
+        finally:
+            connection.close()
+
+        response = self.client.get(listingUrl)
+        self.assertNotEqual(response.headers['ETag'], listing.headers['ETag'])
+        self.assertIn('Chelsea Vs Arsenal', [m['name'] for m in json.loads(response.data)['matches']])
+        board = json.loads(self.client.get(boardUrl).data)
+        loaded = [m for m in board['matches'] if m['name'] == 'Chelsea Vs Arsenal']
+        self.assertEqual(len(board['matches']), 3)
+        self.assertEqual(
+            [(s['name'], s['odds']) for s in loaded[0]['markets'][0]['selections']],
+            [('Chelsea', 2.1), ('Arsenal', 3.4)]
+        )
+
+
+    def testBulkLoadRetriesCountOnlyTheCommittedBatch(self):
+        """Assert that a batch rolled back by a conflicting writer is written again
+        after a pause and that its rows are counted once
+        """
+        failures = [IntegrityError('INSERT INTO event', {}, Exception('UNIQUE constraint failed'))]
+        orig = bulkload.indexEvents
+        self.addCleanup(setattr, bulkload, 'indexEvents', orig)
+        def indexEvents(rows, connection):
+            orig(rows, connection)
+            if failures:
+                raise failures.pop()
+        bulkload.indexEvents = indexEvents
+
+        connection = db.engine.connect()
+        try:
+            started = time.time()
+            counts = loadEvents(connection, [('Football', 'Chelsea Vs Arsenal', datetime(2018, 11, 21, 15), [
+                ('Winner', [('Chelsea', 2.1), ('Arsenal', 3.4)])
+            ])])
+        finally:
+            connection.close()
+        self.assertGreaterEqual(time.time() - started, bulkload.RETRY_DELAY)
+        self.assertEqual(counts, dict(sports=0, events=1, markets=1, selections=2))
+        self.assertEqual(Event.query.filter_by(name='Chelsea Vs Arsenal').count(), 1)
+        self.assertEqual(Selection.query.count(), 6 + 2)
+
+
+    def testOddsHistorySeries(self):
+        """Assert that odds updates are appended to the history and that the
+        selection and market series are downsampled into last/min/max buckets
+        """
+        response = self._postMessage(self._oddsMessage(1, [(1, 3.5)]))
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(
+            [(h.selectionId, h.odds) for h in OddsHistory.query.all()], [(1, 3.5)]
+        )
+
+        db.session.query(OddsHistory).delete()
+        # A whole minute, buckets of a minute or more are read from the rollup
+        start = 1542999960000
+        ticks = [(1, 0, 2.0), (1, 10, 2.4), (1, 59, 2.2), (1, 61, 1.9), (2, 30, 5.0)]
+        for selId, second, odds in ticks:
+            recordHistory([(selId, odds)], start + second * 1000)
+        db.session.commit()
+
+        url = 'http://localhost:5000/api/history/selection/1?from=%d&to=%d&bucket=60'
+        actual = json.loads(self.client.get(url % (start, start + 120000)).data)
+        self.assertEqual(actual['bucket'], 60000)
+        self.assertEqual(actual['series'], [
+            {'t': start, 'last': 2.2, 'min': 2.0, 'max': 2.4, 'ticks': 3},
+            {'t': start + 60000, 'last': 1.9, 'min': 1.9, 'max': 1.9, 'ticks': 1},
+        ])
+
+        # Buckets under a minute are aggregated from the ticks
+        url = 'http://localhost:5000/api/history/selection/1?from=%d&to=%d&bucket=30'
+        actual = json.loads(self.client.get(url % (start + 5000, start + 65000)).data)
+        self.assertEqual(actual['series'], [
+            {'t': start + 5000, 'last': 2.4, 'min': 2.4, 'max': 2.4, 'ticks': 1},
+            {'t': start + 35000, 'last': 1.9, 'min': 1.9, 'max': 2.2, 'ticks': 2},
+        ])
+
+        # The bucket is widened to keep within the maximum number of points
+        self.app.config['HISTORY_MAX_POINTS'] = 1
+        self.addCleanup(self.app.config.update, HISTORY_MAX_POINTS=1000)
+        url = 'http://localhost:5000/api/history/market/1?from=%d&to=%d'
+        actual = json.loads(self.client.get(url % (start, start + 120000)).data)
+        self.assertEqual(actual['bucket'], 120000)
+        self.assertEqual(
+            [(s['name'], s['series']) for s in actual['selections']],
+            [
+                ('Australia', [{'t': start, 'last': 1.9, 'min': 1.9, 'max': 2.4, 'ticks': 4}]),
+                ('Ireland', [{'t': start, 'last': 5.0, 'min': 5.0, 'max': 5.0, 'ticks': 1}]),
+            ]
+        )
+
+        response = self.client.get('http://localhost:5000/api/history/selection/1?from=x')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('http://localhost:5000/api/history/market/404')
+        self.assertEqual(response.status_code, 404)
+
+
+    def testOddsRollupKeepsOnlyTheSurvivingTicks(self):
+        """Assert that a price replacing one of the same millisecond, in another
+        call or in the same one, replaces it in the rollup as well
+        """
+        db.session.query(OddsHistory).delete()
+        start = 1542999960000
+        recordHistory([(1, 2.0), (2, 5.0)], start)
+        recordHistory([(1, 9.0)], start)
+        recordHistory([(1, 3.0), (1, 4.0)], start + 1000)
+        db.session.commit()
+
+        self.assertEqual(
+            [(h.selectionId, h.ts, h.odds) for h in OddsHistory.query.order_by('selectionId', 'ts')],
+            [(1, start, 9.0), (1, start + 1000, 4.0), (2, start, 5.0)]
+        )
+        self.assertEqual(
+            [(r.selectionId, r.last, r.low, r.high, r.ticks) for r in OddsRollup.query.order_by('selectionId')],
+            [(1, 4.0, 4.0, 9.0, 2), (2, 5.0, 5.0, 5.0, 1)]
+        )
+
+
+    def testSearchMatchesByPrefixAndTokens(self):
+        """Assert that the search index covers the fixtures and new events, that
+        the last word matches as a prefix, that every word has to match and that
+        event name matches rank before selection name matches
+        """
+        payload = {
+            'message_type': 'NewEvent',
+            'event': {
+                'name': 'Leinster vs Munster',
+                'startTime': '2018-11-24 18:00:00',
+                'sport': {'id': 1},
+                'markets': [{'name': 'Winner', 'selections': [
+                    {'name': 'Leinster', 'odds': 1.5}, {'name': 'Ireland A', 'odds': 2.5}
+                ]}],
+            }
+        }
+        self.assertEqual(self._postMessage(payload).status_code, 201)
+
+        def search(**params):
+            response = self.client.get('http://localhost:5000/api/search/', query_string=params)
+            return [match['id'] for match in json.loads(response.data)['matches']]
+
+        self.assertEqual(search(q='ger'), [2])
+        self.assertEqual(search(q='portugal it'), [3])
+        self.assertEqual(search(q='portugal ger'), [])
+        self.assertEqual(search(q='munst'), [4])
+        self.assertEqual(search(q='ireland'), [1, 4])
+        self.assertEqual(search(q='ireland', limit=1), [1])
+        self.assertEqual(search(q='vs', sport='football'), [2, 3])
+        self.assertEqual(search(q='"OR *'), [])
+        response = self.client.get('http://localhost:5000/api/search/?q=spain')
+        self.assertEqual(json.loads(response.data)['matches'], [{
+            'id': 2,
+            'name': 'Spain Vs Germany',
+            'startTime': '2018-11-22 10:10:10',
+            'url': 'http://localhost:5000/api/match/2',
+        }])
+
+
+    def testUpcomingBoardIsMaintainedIncrementally(self):
+        """Assert that the board of a sport holds the events of the window with
+        their odds, is loaded once and then follows odds updates and new events
+        """
+        url = 'http://localhost:5000/api/board/football?from=2018-11-21 00:00:00&hours=%d'
+        with countQueries() as statements:
+            board = json.loads(self.client.get(url % 48).data)
+        self.assertEqual(len(statements), 2)
+        self.assertEqual(board['sport'], {'id': 2, 'name': 'Football'})
+        self.assertEqual(board['end'], '2018-11-23 00:00:00')
+        self.assertEqual([m['id'] for m in board['matches']], [3, 2])
+        self.assertEqual(board['matches'][1], {
+            'id': 2,
+            'name': 'Spain Vs Germany',
+            'startTime': '2018-11-22 10:10:10',
+            'markets': [{'id': 2, 'name': 'Winner', 'selections': [
+                {'id': 3, 'name': 'Spain', 'odds': 1.01},
+                {'id': 4, 'name': 'Germany', 'odds': 1.01},
+            ]}],
+        })
+
+        self._postMessage(self._oddsMessage(2, [(4, 2.75)]))
+        self._postMessage({
+            'message_type': 'NewEvent',
+            'event': {
+                'name': 'France Vs Wales',
+                'startTime': '2018-11-21 20:00:00',
+                'sport': {'id': 2},
+                'markets': [{'name': 'Winner', 'selections': [
+                    {'name': 'France', 'odds': 1.4}, {'name': 'Wales', 'odds': 3.1}
+                ]}],
+            }
+        })
+        # Only the sport lookup, the board itself is not read again
+        with countQueries() as statements:
+            board = json.loads(self.client.get(url % 24).data)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual([m['id'] for m in board['matches']], [3, 4])
+        self.assertEqual(board['matches'][1]['markets'][0]['selections'][1]['odds'], 3.1)
+        board = json.loads(self.client.get(url % 48).data)
+        self.assertEqual(board['matches'][2]['markets'][0]['selections'][1]['odds'], 2.75)
+
+        self.assertEqual(self.client.get(url % 49).status_code, 400)
+        self.assertEqual(self.client.get('http://localhost:5000/api/board/chess').status_code, 404)
+
+        # The board loaded for the longest window from now still covers the next one
+        nowUrl = 'http://localhost:5000/api/board/football?hours=48'
+        self.assertEqual(self.client.get(nowUrl).status_code, 200)
+        with countQueries() as statements:
+            self.assertEqual(self.client.get(nowUrl).status_code, 200)
+        self.assertEqual(len(statements), 1)
+
+
+    def _workersEnvironment(self):
+        """Creates a database file with one football event and returns the
+        environment of the worker processes serving it
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        databaseUri = 'sqlite:///%s' % os.path.join(directory, 'workers.db')
+        engine = create_engine(databaseUri)
+        db.metadata.create_all(engine)
+        connection = engine.connect()
+        loadEvents(connection, [
+            ('Football', 'Spain Vs Germany', datetime(2018, 11, 22, 10, 10, 10),
+                [('Winner', [('Spain', 1.01), ('Germany', 1.01)])]),
+        ])
+        connection.close()
+        engine.dispose()
+        return dict(os.environ, BETTING_CONFIG='prod', BETTING_DATABASE_URI=databaseUri)
+
+
+    def _freePort(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+
+    def _request(self, port, method, url, body=None, retryFor=30):
+        """Sends a request to a worker, retrying while it is not accepting yet
+
+        @return tuple: status, X-Cache header and body of the response
+        """
+        deadline = time.time() + retryFor
+        while True:
+            try:
+                connection = HTTPConnection('127.0.0.1', port, timeout=5)
+                connection.request(
+                    method, url, body, {'Content-Type': 'application/json'}
+                )
+                response = connection.getresponse()
+                return response.status, response.getheader('X-Cache'), response.read()
+            except (socket.error, IOError):
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.1)
+
+
+    def testWorkersSeeOtherWorkersWrites(self):
+        """Start three worker processes on one database file and assert that the
+        cached reads of every worker see an odds update and a new event written
+        through another worker within a bounded delay
+        """
+        env = self._workersEnvironment()
+        ports = [self._freePort() for _ in range(3)]
+        with open(os.devnull, 'w') as devnull:
+            for port in ports:
+                worker = subprocess.Popen(
+                    [sys.executable, 'serve.py', '--mode', 'threaded', '--port', str(port)],
+                    env=env, stdout=devnull, stderr=devnull,
+                )
+                self.addCleanup(worker.wait)
+                self.addCleanup(worker.terminate)
+        request = self._request
+
+        # Warm the caches of every worker
+        for port in ports:
+            request(port, 'GET', '/api/match/1')
+            request(port, 'GET', '/api/match/football')
+            self.assertEqual(request(port, 'GET', '/api/match/1')[1], 'HIT')
+
+        def waitFor(check):
+            """Returns the seconds it took every worker to pass the check"""
+            started = time.time()
+            pending = list(ports)
+            while pending and time.time() - started < 5:
+                pending = [port for port in pending if not check(port)]
+                time.sleep(0.02)
+            self.assertEqual(pending, [])
+            return time.time() - started
+
+        odds = lambda port: json.loads(
+            request(port, 'GET', '/api/match/1')[2]
+        )['markets'][0]['selections'][1]['odds']
+        message = self._oddsMessage(1, [(2, 3.25)])
+        self.assertEqual(request(ports[0], 'POST', '/api/match/', json.dumps(message))[0], 204)
+        self.assertLess(waitFor(lambda port: odds(port) == 3.25), 2)
+
+        message = {
+            'message_type': 'NewEvent',
+            'event': {
+                'name': 'France Vs Wales',
+                'startTime': '2018-11-21 20:00:00',
+                'sport': {'id': 1},
+                'markets': [{'name': 'Winner', 'selections': [
+                    {'name': 'France', 'odds': 1.4}, {'name': 'Wales', 'odds': 3.1}
+                ]}],
+            }
+        }
+        self.assertEqual(request(ports[1], 'POST', '/api/match/', json.dumps(message))[0], 201)
+        matches = lambda port: len(json.loads(
+            request(port, 'GET', '/api/match/football')[2]
+        )['matches'])
+        self.assertLess(waitFor(lambda port: matches(port) == 2), 2)
+
+
+    def testForkedWorkersShareTheListeningSocket(self):
+        """Start serve.py --workers 2 and assert that the forked workers answer on
+        the shared port, that every read sees an odds update whichever worker
+        serves it and that stopping the parent stops the workers
+        """
+        env = self._workersEnvironment()
+        port = self._freePort()
+        with open(os.devnull, 'w') as devnull:
+            parent = subprocess.Popen(
+                [sys.executable, 'serve.py', '--mode', 'threaded', '--port', str(port),
+                    '--workers', '2'],
+                env=env, stdout=devnull, stderr=devnull,
+            )
+        self.addCleanup(lambda: parent.poll() is None and parent.kill())
+
+        odds = lambda: json.loads(
+            self._request(port, 'GET', '/api/match/1')[2]
+        )['markets'][0]['selections'][1]['odds']
+        for _ in range(10):
+            self.assertEqual(odds(), 1.01)
+        message = self._oddsMessage(1, [(2, 3.25)])
+        self.assertEqual(self._request(port, 'POST', '/api/match/', json.dumps(message))[0], 204)
+        # Both workers serve the reads, each one has to catch up with the update
+        started = time.time()
+        while [odds() for _ in range(10)] != [3.25] * 10 and time.time() - started < 5:
+            time.sleep(0.02)
+        self.assertEqual([odds() for _ in range(10)], [3.25] * 10)
+
+        parent.terminate()
+        self.assertEqual(parent.wait(), 0)
+        self.assertRaises(
+            (socket.error, IOError), self._request, port, 'GET', '/api/match/1', retryFor=0
+        )
+
+
+    def testFollowerForgetsRolledBackWritesAndRetriesFailedPasses(self):
+        """Assert that the writes a rolled back batch marked as local are no longer
+        skipped by the change follower, and that the follower only moves past the
+        changes once they are applied
+        """
+        follower = ChangeFollower(self.app, 0.1, 500)
+        self.app.extensions['changeFollower'] = follower
+        self.addCleanup(self.app.extensions.pop, 'changeFollower', None)
+        connection = db.engine.connect()
+        self.addCleanup(connection.close)
+        follower._position(connection)
+
+        recordHistory = messages.recordHistory
+        self.addCleanup(setattr, messages, 'recordHistory', recordHistory)
+        def failingHistory(*args):
+            raise RuntimeError('disk I/O error')
+        messages.recordHistory = failingHistory
+        self.assertRaises(
+            RuntimeError, messages.applyMessages, [self._oddsMessage(1, [(1, 2.5)])]
+        )
+        messages.recordHistory = recordHistory
+
+        # The same sequence number, written by another process
+        self.app.extensions.pop('changeFollower')
+        self.assertEqual(self._postMessage(self._oddsMessage(1, [(2, 3.25)])).status_code, 204)
+
+        applyCommitted = messages.applyCommitted
+        self.addCleanup(setattr, messages, 'applyCommitted', applyCommitted)
+        def failingApply(*args):
+            raise RuntimeError('boom')
+        messages.applyCommitted = failingApply
+        self.assertRaises(RuntimeError, follower.poll, connection)
+        self.assertEqual(follower.lastSeq, 0)
+
+        applied = []
+        messages.applyCommitted = lambda *args: applied.append(args)
+        follower.poll(connection)
+        self.assertEqual(applied[0][0], {2: 3.25})
+        self.assertEqual(follower.lastSeq, 1)
+
+
+    def testFollowerSurvivesAFailedConnect(self):
+        """Assert that the change follower thread tries connecting again after a
+        failure instead of dying, e.g. on a database locked by another worker
+        """
+        failures = [OperationalError('PRAGMA journal_mode = WAL', {}, Exception('database is locked'))]
+        connect = db.engine.connect
+        self.addCleanup(setattr, db.engine, 'connect', connect)
+        def failingConnect():
+            if failures:
+                raise failures.pop()
+            return connect()
+        db.engine.connect = failingConnect
+
+        follower = ChangeFollower(self.app, 0.01, 500).start()
+        self.addCleanup(follower.stop)
+        deadline = time.time() + 5
+        while follower.lastSeq is None and time.time() < deadline:
+            time.sleep(0.01)
+        follower.stop()
+        self.assertEqual(failures, [])
+        self.assertEqual(follower.lastSeq, 0)
+
+
+    def testFastSerializationMatchesAsDict(self):
+        """Assert that the documents encoded straight from the Core rows decode to
+        the same data as the asDict path, escaping included
+        """
+        sport = getOrCreate(db.session, Sport, name='Football')
+        event = Event(name=u'"Atl\u00e9tico" \\ M\u00e1laga %s', startTime=datetime(2018, 11, 24), sport=sport)
+        market = Market(name='Winner', event=event)
+        db.session.add(Selection(name=u'Atl\u00e9tico\n', odds=2.125, market=market))
+        db.session.add(Selection(name='Draw', odds=None, market=market))
+        db.session.add(Event(name='No markets', startTime=datetime(2018, 11, 25), sport=sport))
+        db.session.commit()
+
+        url = lambda eventId: 'http://localhost/api/match/%d' % eventId
+        documents = encodeMatches(db.session.execute(matchRows([])), url)
+        events = Event.query.order_by(Event.id).all()
+        self.assertEqual(len(documents), len(events))
+        for document, event in zip(documents, events):
+            expected = event.asDict(skipRelations=False)
+            expected['url'] = url(event.id)
+            self.assertEqual(json.loads(document), expected)
+
+        rows = [(e.id, None, e.name, e.startTime) for e in events]
+        listing = json.loads(encodeListing(['name', 'startTime'], rows, url, 'abc'))
+        self.assertEqual(listing['next'], 'abc')
+        self.assertEqual(listing['matches'], [
+            dict(name=e.name, startTime=str(e.startTime), url=url(e.id)) for e in events
+        ])
+        self.assertEqual(
+            json.loads(encodeListing(['id'], [(1, None, 1)], url)), {'matches': [{'id': 1, 'url': url(1)}]}
+        )
+        self.assertEqual(
+            json.loads(encodeListing([], [(1, None)], url)), {'matches': [{'url': url(1)}]}
+        )
+
+        # Non finite odds have no json literal, they are encoded as null
+        for odds in (float('nan'), float('inf'), float('-inf')):
+            self.assertEqual(
+                json.loads(SELECTION.encode((1, 'Draw', odds))),
+                {'id': 1, 'name': 'Draw', 'odds': None}
+            )
+
+
+    def testFailedStatementsAreTimedToo(self):
+        """Assert that the start time the metrics keep for a statement is cleared
+        and the statement counted when it fails as well as when it succeeds
+        """
+        connection = db.engine.connect()
+        self.addCleanup(connection.close)
+        stats = RequestStats()
+        setRequestStats(stats)
+        self.addCleanup(setRequestStats, None)
+        self.assertRaises(OperationalError, connection.execute, 'SELECT * FROM missing')
+        self.assertNotIn('metricsStarted', connection.info)
+        connection.execute('SELECT 1').scalar()
+        self.assertNotIn('metricsStarted', connection.info)
+        self.assertEqual(stats.statements, 2)
+
+
+    def testMetricsEndpointAndSampledProfiles(self):
+        """Assert that the requests served show up per route in the prometheus
+        metrics with their sql statements and cache hits, and that a sampled
+        request over the profiling threshold leaves a profile dump behind
+        """
+        metrics = self.app.extensions['metrics']
+        metrics.clear()
+        for _ in range(3):
+            self.assertEqual(self.client.get('http://localhost:5000/api/match/1').status_code, 200)
+        self.assertEqual(self.client.get('http://localhost:5000/api/match/99').status_code, 404)
+
+        lines = self.client.get('http://localhost:5000/metrics').data.decode('utf-8').splitlines()
+        values = dict(line.rsplit(' ', 1) for line in lines if not line.startswith('#'))
+        route = 'route="/api/match/<int:matchId>"'
+        self.assertEqual(values['betting_http_requests_total{%s,method="GET",status="200"}' % route], '3')
+        self.assertEqual(values['betting_http_requests_total{%s,method="GET",status="404"}' % route], '1')
+        self.assertEqual(values['betting_http_request_duration_seconds_count{%s}' % route], '4')
+        # The hits run no sql, the 404 the version lookup and the miss the lookup
+        # and the tree query
+        self.assertEqual(values['betting_sql_statements_per_request_bucket{%s,le="0"}' % route], '2')
+        self.assertEqual(values['betting_sql_statements_per_request_bucket{%s,le="1"}' % route], '3')
+        self.assertEqual(values['betting_sql_statements_per_request_bucket{%s,le="2"}' % route], '4')
+        self.assertEqual(values['betting_http_response_size_bytes_count{%s}' % route], '4')
+        self.assertEqual(values['betting_document_cache_hits_total'], '2')
+        self.assertEqual(values['betting_document_cache_misses_total'], '2')
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.app.config.update(PROFILE_SAMPLE_RATE=1, PROFILE_THRESHOLD=0, PROFILE_DIR=directory)
+        try:
+            self.client.get('http://localhost:5000/api/match/football')
+        finally:
+            self.app.config.update(PROFILE_SAMPLE_RATE=0, PROFILE_THRESHOLD=0.5)
+        dumps = os.listdir(directory)
+        self.assertEqual(len(dumps), 1)
+        self.assertTrue(dumps[0].startswith('getMatchesBySport-'))
+        self.assertTrue(pstats.Stats(os.path.join(directory, dumps[0])).total_calls > 0)
+
+
 if __name__ == '__main__':
     unittest.main()
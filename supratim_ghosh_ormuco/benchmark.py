@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""Benchmarks LRUCache under a stream of distinct keys, reporting per chunk of
+calls the average latency of a call and the memory held by the cache, for an
+unbounded cache, one bounded in entries and one bounded by a memory budget.
+
+Usage: python benchmark.py --keys 2000000 --maxsize 10000 --budget 8
+"""
+import argparse
+import time
+import tracemalloc
+
+import lru_cache
+
+
+def identity(x):
+	return x
+
+
+def run(maxsize, budget, keys, chunk, traced):
+	"""Calls a freshly decorated function with keys distinct keys
+
+	@param int maxsize: bound of the cache, None for unbounded
+	@param int budget: memory budget in MiB, None for unbounded
+	@param int keys: number of distinct keys
+	@param int chunk: number of calls per reported row
+	@param bool traced: measure the memory (slower) instead of the latency
+	@return list: nanoseconds per call or MiB held, one per chunk
+	"""
+	func = lambda x: identity(x)
+	cached = lru_cache.LRUCache(ttl=3600, maxsize=maxsize)(func)
+	lru_cache.LRUCache.setMemoryBudget(budget and budget * 1048576)
+	if traced:
+		tracemalloc.start()
+	rows = []
+	try:
+		for start in range(0, keys, chunk):
+			started = time.perf_counter()
+			for key in range(start, min(start + chunk, keys)):
+				cached(key)
+			elapsed = time.perf_counter() - started
+			if traced:
+				rows.append(tracemalloc.get_traced_memory()[0] / 1048576.0)
+			else:
+				rows.append(elapsed * 1e9 / chunk)
+	finally:
+		if traced:
+			tracemalloc.stop()
+		lru_cache.LRUCache.setMemoryBudget(None)
+	return rows
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+	parser.add_argument('--keys', type=int, default=2000000)
+	parser.add_argument('--chunk', type=int, default=200000)
+	parser.add_argument('--maxsize', type=int, default=10000)
+	parser.add_argument('--budget', type=int, default=8, help='MiB')
+	args = parser.parse_args()
+
+	configs = [
+		('unbounded', None, None),
+		('maxsize=%d' % args.maxsize, args.maxsize, None),
+		('budget=%dMiB' % args.budget, None, args.budget),
+	]
+	results = [
+		(run(maxsize, budget, args.keys, args.chunk, False), run(maxsize, budget, args.keys, args.chunk, True))
+		for _, maxsize, budget in configs
+	]
+
+	print('%12s' % 'calls' + ''.join('%17s %14s' % (name + ' ns', 'MiB') for name, _, _ in configs))
+	for index in range(len(results[0][0])):
+		row = '%12d' % min((index + 1) * args.chunk, args.keys)
+		for latencies, memory in results:
+			row += '%17.0f %14.1f' % (latencies[index], memory[index])
+		print(row)
+
+
+if __name__ == '__main__':
+	main()
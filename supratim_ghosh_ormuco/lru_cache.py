@@ -1,38 +1,464 @@
+import functools
+import itertools
+import threading
+import weakref
+import types
+import heapq
 import time
+import sys
+from collections import OrderedDict, namedtuple
+
+# Number of locks the in flight computations of a function are spread over
+STRIPES = 64
+# Most expired entries removed by each new result cached, expiry keeps up with the
+# insertions without any call paying for a long backlog
+EXPIRE_BATCH = 8
+# Stale deadlines tolerated, on top of half the results cached, before the heap
+# of a function is rebuilt from its results
+COMPACT_SLACK = 1024
+# Bytes held by the cache for an entry on top of its key and result: the tuple
+# of the entry and its times, the ordered dict node and the deadline on the heap
+ENTRY_OVERHEAD = 320
+# Least recently used results of each function weighed against each other when
+# the memory budget is exceeded
+BUDGET_SAMPLE = 5
+# Share of the memory budget freed whenever it is exceeded, the evictions come in
+# batches instead of one for every new result
+BUDGET_HEADROOM = 0.01
+
+CacheInfo = namedtuple('CacheInfo', [
+	'hits', 'misses', 'evictions', 'expirations', 'size', 'estimatedBytes', 'averageComputeTime'
+])
+
+
+class _Flight:
+	"""Computation of a missing key, shared by the callers of the key that miss
+	while it runs
+	"""
+	def __init__(self):
+		self.done = threading.Event()
+		self.value = None
+		self.error = None
+
+
+class _Expiry:
+	"""Min-heap of the deadlines of the cached results of a function. Entries
+	are not removed when a result is refreshed or evicted, they are skipped
+	when they come due instead.
+	"""
+	def __init__(self):
+		self.heap = []
+		self._order = itertools.count()
+
+	def __len__(self):
+		return len(self.heap)
+
+	def push(self, deadline, key):
+		# The counter keeps keys, which may not be comparable, out of the ordering
+		heapq.heappush(self.heap, (deadline, next(self._order), key))
+
+	def rebuild(self, deadlines):
+		"""Replaces the entries by the (deadline, key) ones of deadlines"""
+		self.heap = [(deadline, next(self._order), key) for deadline, key in deadlines]
+		heapq.heapify(self.heap)
+
+	def popDue(self, now, limit=None):
+		"""Yields the (deadline, key) entries due by now, at most limit of them"""
+		while self.heap and self.heap[0][0] < now and limit != 0:
+			deadline, _, key = heapq.heappop(self.heap)
+			if limit is not None:
+				limit -= 1
+			yield deadline, key
+
+
+class _Budget:
+	"""Bytes estimated for the results cached by every decorated function and
+	the most they may hold, None for no limit. Past it the results with the
+	largest bytes times time since their last use are evicted first, out of the
+	least recently used ones of each function, so a large result idle for a
+	while goes before a small one idle a little longer.
+	The lock of total is never held while taking another one, the evictions take
+	the lock of one function at a time, outside of any of them.
+	"""
+	def __init__(self):
+		self.maxBytes = None
+		self._total = 0
+		self._released = []
+		self._lock = threading.Lock()
+		self._evicting = threading.Lock()
+
+	@property
+	def total(self):
+		if self._released:
+			self.add(0)
+		return self._total
+
+	def add(self, delta):
+		with self._lock:
+			self._total += delta
+			while self._released:
+				self._total -= self._released.pop()
+
+	def release(self, size):
+		"""Takes the bytes of a collected function off the total. Called from
+		__del__, possibly by the garbage collector in the middle of add, so the
+		bytes are queued for add instead of taking the lock
+		"""
+		self._released.append(size)
+
+	def exceeded(self):
+		maxBytes = self.maxBytes
+		return maxBytes is not None and self.total > maxBytes
+
+	def enforce(self, caches):
+		"""Evicts results of caches until the total is BUDGET_HEADROOM within the
+		budget
+		"""
+		with self._evicting:
+			maxBytes = self.maxBytes
+			# Lifted, or already enforced by another thread meanwhile
+			if maxBytes is None or self.total <= maxBytes:
+				return
+			target = maxBytes * (1 - BUDGET_HEADROOM)
+			while self.total > target:
+				now = time.time()
+				candidates = []
+				for cache in caches:
+					candidates.extend(cache.candidates(BUDGET_SAMPLE, now))
+				if not candidates:
+					return
+				candidates.sort(key=lambda candidate: candidate[:2], reverse=True)
+				for _, _, cache, key, value in candidates:
+					if self.total <= target:
+						return
+					cache.evict(key, value)
+
+
+_budget = _Budget()
+
+
+class _FunctionCache:
+	"""Storage and counters of one decorated function. Entries are
+	(result, time, estimated bytes, time of last use) tuples, ordered from the
+	least to the most recently used so moving one to the end and popping the first
+	one are O(1).
+	Every method but lookup and store takes the lock, those two are called with it
+	held. The budget evicts from any thread, thread safe function or not.
+	"""
+	def __init__(self, func, ttl, maxsize, weigher, budget):
+		self.func = func
+		self.ttl = ttl
+		self.maxsize = maxsize
+		self.lock = threading.Lock()
+		self.weigher = weigher
+		# Held on to, the module may be torn down before __del__ runs
+		self.budget = budget
+		self._reset()
+
+	def __del__(self):
+		self.budget.release(self.estimatedBytes)
+
+	def _reset(self):
+		self.entries = OrderedDict()
+		self.expiry = _Expiry()
+		self.estimatedBytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.expirations = 0
+		self.computations = 0
+		self.computeTime = 0.0
+
+	def lookup(self, key):
+		"""Returns the entry cached for key and marks it as the most recently
+		used, None when it is missing or expired
+		"""
+		value = self.entries.get(key)
+		now = time.time()
+		if value is None or (now - value[1]) > self.ttl:
+			return None
+		value = self.entries[key] = (value[0], value[1], value[2], now)
+		self.entries.move_to_end(key)
+		self.hits += 1
+		return value
+
+	def store(self, key, result, computeTime):
+		"""Caches a result computed in computeTime seconds as the most recently
+		used, a replaced expired value included, evicts the least recently used
+		ones beyond maxsize and removes a batch of the expired ones
+		"""
+		now = time.time()
+		self.computations += 1
+		self.computeTime += computeTime
+		replaced = self.entries.get(key)
+		if replaced is not None:
+			self._drop(replaced)
+			if now - replaced[1] > self.ttl:
+				self.expirations += 1
+		weight = _sizeOf(result) if self.weigher is None else self.weigher(result)
+		value = self.entries[key] = (result, now, _sizeOf(key) + weight + ENTRY_OVERHEAD, now)
+		self.entries.move_to_end(key)
+		self.estimatedBytes += value[2]
+		self.budget.add(value[2])
+		self.expiry.push(now + self.ttl, key)
+		if len(self.expiry) > len(self.entries) + len(self.entries) // 2 + COMPACT_SLACK:
+			# Mostly the deadlines of results evicted or refreshed long before they
+			# come due, the heap would otherwise outgrow a bounded cache
+			self.expiry.rebuild((value[1] + self.ttl, key) for key, value in self.entries.items())
+		while self.maxsize is not None and len(self.entries) > self.maxsize:
+			self._drop(self.entries.popitem(last=False)[1])
+			self.evictions += 1
+		self._expire(now, EXPIRE_BATCH)
+		return value
+
+	def expire(self, now):
+		"""Removes every expired result, visiting only those"""
+		with self.lock:
+			self._expire(now)
+
+	def clear(self):
+		"""Drops every result and resets the counters"""
+		with self.lock:
+			self.budget.add(-self.estimatedBytes)
+			self._reset()
+
+	def candidates(self, count, now):
+		"""Returns the (bytes times idle seconds, bytes, self, key, entry) of the
+		count least recently used results
+		"""
+		with self.lock:
+			return [
+				(value[2] * (now - value[3]), value[2], self, key, value)
+				for key, value in itertools.islice(self.entries.items(), count)
+			]
+
+	def evict(self, key, value):
+		"""Evicts the entry of key unless it changed since it was chosen"""
+		with self.lock:
+			if self.entries.get(key) is value:
+				del self.entries[key]
+				self._drop(value)
+				self.evictions += 1
+
+	def info(self):
+		"""Returns the CacheInfo of the function"""
+		with self.lock:
+			return CacheInfo(
+				self.hits, self.misses, self.evictions, self.expirations, len(self.entries),
+				self.estimatedBytes, self.computeTime / self.computations if self.computations else 0.0
+			)
+
+	def _drop(self, value):
+		self.estimatedBytes -= value[2]
+		self.budget.add(-value[2])
+
+	def _expire(self, now, limit=None):
+		# The deadline of a result refreshed or evicted since no longer matches
+		# and is skipped
+		for deadline, key in self.expiry.popDue(now, limit):
+			value = self.entries.get(key)
+			if value is not None and value[1] + self.ttl == deadline:
+				del self.entries[key]
+				self._drop(value)
+				self.expirations += 1
 
 
 class LRUCache:
-	"""Caching class implementing a basic memoization with timeout
+	"""Caching class implementing a basic memoization with timeout, bounded to
+	maxsize results per function by evicting the least recently used one.
+	Expired results are removed as they come due, a few for every new result
+	cached and all of them on _clear, from a heap of their deadlines so only the
+	expired ones are visited.
+	With threadSafe the decorated function can be called from several threads,
+	concurrent misses on a key wait for a single computation of it.
+	Every decorated function has its own storage, so an instance can decorate
+	several functions, and gets cache_info and cache_clear attributes.
+	LRUCache.cache_info reports on all of them.
+	LRUCache.setMemoryBudget bounds the bytes held by all of them together, the
+	results being weighed by their estimated size or by weigher. The estimate
+	follows the builtin containers (dicts, lists, tuples and sets) of a result,
+	not the attributes of other objects which are often shared with the rest of
+	the program: give a weigher for results that are objects. Without
+	threadSafe a function has to be called from a single thread, the budget may
+	still evict its results from any thread, under the lock of its storage.
 	"""
-	_masterTTLDict = {}
-	_masterCacheDict = {}
-	
-	def __init__(self, ttl=3):
- 		# Default time to live is set to 3 seconds
+	# Storage of every decorated function, for as long as the function lives
+	_functionCaches = weakref.WeakSet()
+	_registryLock = threading.Lock()
+
+	def __init__(self, ttl=3, maxsize=None, threadSafe=False, weigher=None):
+ 		# Default time to live is set to 3 seconds, no bound on the entries by default
 		self.ttl = ttl
-	
+		self.maxsize = maxsize
+		self.threadSafe = threadSafe
+		# Bytes of a result, estimated from sys.getsizeof by default, see _sizeOf
+		self.weigher = weigher
+
 	def __call__(self, func):
+		# The lock of the storage is only held for the O(1) dict operations, the
+		# stripes of the thread safe mode guard the in flight computations
+		cache = _FunctionCache(func, self.ttl, self.maxsize, self.weigher, _budget)
+		with self._registryLock:
+			self._functionCaches.add(cache)
+
 		# Wrapper to perform basic time base dict lookup
-		self._masterTTLDict[func]  = self.ttl
-		self._thisCache = self._masterCacheDict[func] = {}
-		
+		@functools.wraps(func)
 		def wrapper(*args, **kwargs):
 			key = (args, tuple(sorted(kwargs.items(), key=lambda x: x[0])))
-			try:
-				value = self._thisCache[key]
-				if (time.time() - value[1]) > self.ttl:
-					raise KeyError
-			except KeyError:
+			# Taken even from a single thread, the budget evicts from other threads
+			with cache.lock:
+				value = cache.lookup(key)
+				if value is None:
+					cache.misses += 1
+			if value is None:
+				started = time.perf_counter()
+				result = func(*args, **kwargs)
 				# Cache the function identifier with the current time
-				value = self._thisCache[key] = (func(*args, **kwargs), time.time())
-
-			return value[0]	
+				computeTime = time.perf_counter() - started
+				with cache.lock:
+					value = cache.store(key, result, computeTime)
+				if _budget.exceeded():
+					_budget.enforce(LRUCache._caches())
+			return value[0]
 
+		if self.threadSafe:
+			wrapper = self._lockedWrapper(func, cache)
+		wrapper.cache_info = cache.info
+		wrapper.cache_clear = cache.clear
+		wrapper._cache = cache
 		return wrapper
 
-	def _clear(self):
-		for func, funcCaches in self._masterCacheDict.items():
-			for funcCacheKey, cacheVal in funcCaches.items():
-				if (time.time() - cacheVal[1]) > self._masterTTLDict[func]:
-					self._masterCacheDict[func][funcCacheKey] = {}
-			
+	@staticmethod
+	def _lockedWrapper(func, cache):
+		stripes = [(threading.Lock(), {}) for _ in range(STRIPES)]
+
+		@functools.wraps(func)
+		def lockedWrapper(*args, **kwargs):
+			key = (args, tuple(sorted(kwargs.items(), key=lambda x: x[0])))
+			with cache.lock:
+				value = cache.lookup(key)
+			if value is not None:
+				return value[0]
+
+			stripe, flights = stripes[hash(key) % STRIPES]
+			with stripe:
+				flight = flights.get(key)
+				if flight is None:
+					# Looked up again, a flight may have landed since the first look
+					with cache.lock:
+						value = cache.lookup(key)
+						if value is None:
+							cache.misses += 1
+					if value is not None:
+						return value[0]
+					leader = flight = flights[key] = _Flight()
+				else:
+					leader = None
+
+			if leader is None:
+				with cache.lock:
+					cache.misses += 1
+				flight.done.wait()
+				if flight.error is not None:
+					raise flight.error
+				return flight.value
+
+			try:
+				started = time.perf_counter()
+				flight.value = func(*args, **kwargs)
+				computeTime = time.perf_counter() - started
+				with cache.lock:
+					cache.store(key, flight.value, computeTime)
+			except BaseException as error:
+				# Interrupts and exits too, the waiters would return None otherwise
+				flight.error = error
+				raise
+			finally:
+				with stripe:
+					del flights[key]
+				flight.done.set()
+			# Outside of the lock of the function, the evictions take those of others
+			if _budget.exceeded():
+				_budget.enforce(LRUCache._caches())
+			return flight.value
+
+		return lockedWrapper
+
+	@classmethod
+	def _caches(cls):
+		with cls._registryLock:
+			return list(cls._functionCaches)
+
+	@classmethod
+	def cache_info(cls, perFunction=False):
+		"""Returns the CacheInfo totals of every decorated function, the average
+		compute time weighted by their computations, or with perFunction a dict
+		of the decorated functions to their own CacheInfo
+		"""
+		if perFunction:
+			return dict((cache.func, cache.info()) for cache in cls._caches())
+		totals = [0] * len(CacheInfo._fields)
+		computations, computeTime = 0, 0.0
+		for cache in cls._caches():
+			info = cache.info()
+			for index, value in enumerate(info):
+				totals[index] += value
+			computations += cache.computations
+			computeTime += cache.computeTime
+		totals[-1] = computeTime / computations if computations else 0.0
+		return CacheInfo(*totals)
+
+	@classmethod
+	def setMemoryBudget(cls, maxBytes):
+		"""Bounds the bytes estimated for the results of every decorated function
+		together to maxBytes, None to lift the bound, evicting right away what is
+		over it
+		"""
+		_budget.maxBytes = maxBytes
+		if _budget.exceeded():
+			_budget.enforce(cls._caches())
+
+	@classmethod
+	def _clear(cls):
+		# Removes every expired result, visiting only those
+		now = time.time()
+		for cache in cls._caches():
+			cache.expire(now)
+
+
+# Sized on their own: scalars, or shared by the whole program
+_OPAQUE = (str, bytes, bytearray, int, float, bool, type(None), type, types.ModuleType, types.FunctionType)
+_OPAQUE_TYPES = frozenset(_OPAQUE)
+
+
+def _sizeOf(obj):
+	"""Returns an estimate of the bytes held by obj: its own size plus that of the
+	items of the builtin containers it is made of, each container counted once.
+	Other objects count for their own size only, their attributes may well point
+	into a graph shared by every result and would be counted for each of them.
+	"""
+	getsizeof = sys.getsizeof
+	if type(obj) in _OPAQUE_TYPES:
+		return getsizeof(obj)
+	size = 0
+	seen = set()
+	pending = [obj]
+	while pending:
+		obj = pending.pop()
+		if id(obj) in seen:
+			continue
+		seen.add(id(obj))
+		size += getsizeof(obj)
+		if isinstance(obj, dict):
+			items = itertools.chain(obj.keys(), obj.values())
+		elif isinstance(obj, (tuple, list, set, frozenset)):
+			items = obj
+		else:
+			continue
+		for item in items:
+			# Scalars are sized straight away, without tracking them
+			if type(item) in _OPAQUE_TYPES:
+				size += getsizeof(item)
+			else:
+				pending.append(item)
+	return size
@@ -1,3 +1,7 @@
+import collections
+import gc
+import sys
+import threading
 import unittest
 import time
 import lines
@@ -66,19 +70,431 @@ class LRUCacheTest(unittest.TestCase):
 		return var1 + var2 
 
 	def testCacheClearOnTimeout(self):
-		masterCache = lambda : list(map(lambda v: (v[0].__name__, v[1]), lru_cache.LRUCache()._masterCacheDict.items()))
+		sizes = lambda : [(f.__name__, f.cache_info().size) for f in (LRUCacheTest.dieIn3Seconds, LRUCacheTest.dieIn10Seconds)]
 		# Confirm that cache is empty in the begining
-		self.assertListEqual(masterCache(), [('dieIn3Seconds', {}), ('dieIn10Seconds', {})])
+		self.assertListEqual(sizes(), [('dieIn3Seconds', 0), ('dieIn10Seconds', 0)])
 
 		# Register first item in cache
 		LRUCacheTest.dieIn3Seconds(1, 2)
-		dieIn3Entry1 = dict(masterCache())['dieIn3Seconds']
 		# Confirm that we set cache
-		self.assertNotEqual(dieIn3Entry1, {})
+		self.assertListEqual(sizes(), [('dieIn3Seconds', 1), ('dieIn10Seconds', 0)])
 		# Let it timeout
 		time.sleep(4)
 		lru_cache.LRUCache()._clear()
-		self.assertListEqual(masterCache(), [('dieIn3Seconds', {((1, 2), ()): {}}), ('dieIn10Seconds', {})])
+		# The expired result is removed altogether
+		self.assertListEqual(sizes(), [('dieIn3Seconds', 0), ('dieIn10Seconds', 0)])
+		self.assertEqual(LRUCacheTest.dieIn3Seconds.cache_info().expirations, 1)
+
+
+class LRUCacheEvictionTest(unittest.TestCase):
+	def testMaxsizeEvictsLeastRecentlyUsed(self):
+		calls = []
+		def square(x):
+			calls.append(x)
+			return x * x
+		cachedSquare = lru_cache.LRUCache(ttl=60, maxsize=2)(square)
+		cache = cachedSquare._cache.entries
+
+		self.assertEqual([cachedSquare(1), cachedSquare(2), cachedSquare(1)], [1, 4, 1])
+		# 2 is now the least recently used, 3 takes its place
+		cachedSquare(3)
+		self.assertEqual(list(cache), [((1,), ()), ((3,), ())])
+		self.assertEqual([cachedSquare(1), cachedSquare(3), cachedSquare(2)], [1, 9, 4])
+		self.assertEqual(calls, [1, 2, 3, 2])
+		self.assertEqual(len(cache), 2)
+
+	def testMaxsizeWithExpiry(self):
+		calls = []
+		def double(x):
+			calls.append(x)
+			return 2 * x
+		cachedDouble = lru_cache.LRUCache(ttl=0.1, maxsize=100)(double)
+		for x in range(1000):
+			cachedDouble(x % 150)
+		self.assertEqual(len(cachedDouble._cache.entries), 100)
+		cachedDouble(149)
+		time.sleep(0.2)
+		# Expired, computed again
+		self.assertEqual(cachedDouble(149), 298)
+		self.assertEqual(calls.count(149), 8)
+
+
+class LRUCacheExpiryTest(unittest.TestCase):
+	"""Contains the tests of the removal of the expired results
+	"""
+	def testClearRemovesOnlyExpiredResults(self):
+		cachedShort = lru_cache.LRUCache(ttl=0.05)(lambda x: x)
+		cachedLong = lru_cache.LRUCache(ttl=60)(lambda x: -x)
+		short = cachedShort._cache.entries
+		longLived = cachedLong._cache.entries
+		for x in range(100):
+			cachedShort(x)
+			cachedLong(x)
+		# Refreshed after expiring, its first deadline is stale
+		time.sleep(0.1)
+		cachedShort(5)
+		lru_cache.LRUCache()._clear()
+		self.assertEqual(list(short), [((5,), ())])
+		self.assertEqual(len(longLived), 100)
+		# Only the entries of the refreshed result and the long lived ones remain due
+		self.assertEqual(len(cachedShort._cache.expiry), 1)
+		self.assertEqual(len(cachedLong._cache.expiry), 100)
+
+	def testExpiryOnAccessReclaimsMemory(self):
+		cached = lru_cache.LRUCache(ttl=0.05)(lambda x: x)
+		cache = cached._cache.entries
+		expiry = cached._cache.expiry
+		for x in range(500):
+			cached(x)
+		time.sleep(0.1)
+		# Each new result removes a batch of the expired ones, without any _clear
+		for x in range(500, 1000):
+			cached(x)
+		self.assertEqual(sorted(cache), [((x,), ()) for x in range(500, 1000)])
+		self.assertEqual(len(expiry), 500)
+
+	def testEvictedResultsLeaveNoExpiredEntryBehind(self):
+		cached = lru_cache.LRUCache(ttl=0.05, maxsize=10)(lambda x: x)
+		cache = cached._cache.entries
+		for x in range(100):
+			cached(x)
+		time.sleep(0.1)
+		cached(0)
+		lru_cache.LRUCache()._clear()
+		self.assertEqual(list(cache), [((0,), ())])
+		self.assertEqual(len(cached._cache.expiry), 1)
+
+	def testHeapStaysBoundedUnderEviction(self):
+		cached = lru_cache.LRUCache(ttl=60, maxsize=10)(lambda x: x)
+		expiry = cached._cache.expiry
+		# The deadlines of the evicted results are long from due, only the
+		# compaction of the heap drops them
+		largest = 0
+		for x in range(20000):
+			cached(x)
+			largest = max(largest, len(expiry))
+		self.assertLessEqual(largest, 10 + 10 // 2 + lru_cache.COMPACT_SLACK + 1)
+		self.assertEqual(len(cached._cache.entries), 10)
+
+
+class LRUCacheInfoTest(unittest.TestCase):
+	"""Contains the tests of the storage of each function and of its statistics
+	"""
+	def testInstanceDecoratesSeveralFunctions(self):
+		cache = lru_cache.LRUCache(ttl=60)
+		square = cache(lambda x: x * x)
+		negate = cache(lambda x: -x)
+		self.assertEqual([square(3), negate(3), square(3), negate(3)], [9, -3, 9, -3])
+		self.assertEqual(square.cache_info()[:5], (1, 1, 0, 0, 1))
+		self.assertEqual(negate.cache_info()[:5], (1, 1, 0, 0, 1))
+
+	def testCacheInfoCounts(self):
+		def slow(x):
+			time.sleep(0.01)
+			return 'x' * x
+		cached = lru_cache.LRUCache(ttl=0.05, maxsize=2)(slow)
+		for x in (1, 2, 1, 3, 1):
+			cached(x)
+		info = cached.cache_info()
+		self.assertEqual(info[:5], (2, 3, 1, 0, 2))
+		self.assertGreaterEqual(info.averageComputeTime, 0.01)
+		self.assertLess(info.averageComputeTime, 0.05)
+		bytesBefore = info.estimatedBytes
+		time.sleep(0.1)
+		# 3 is evicted and the expired 1 removed for 1000, 1 is then computed again
+		cached(1000)
+		cached(1)
+		info = cached.cache_info()
+		self.assertEqual((info.misses, info.expirations, info.size), (5, 1, 2))
+		self.assertEqual(info.estimatedBytes - bytesBefore, 997)
+		cached.cache_clear()
+		self.assertEqual(cached.cache_info(), (0, 0, 0, 0, 0, 0, 0.0))
+
+	def testThreadSafeCountsEveryCall(self):
+		def slow(x):
+			time.sleep(0.01)
+			return x
+		cached = lru_cache.LRUCache(ttl=60, threadSafe=True)(slow)
+		def run():
+			for x in range(50):
+				cached(x % 10)
+		workers = [threading.Thread(target=run) for _ in range(8)]
+		for worker in workers:
+			worker.start()
+		for worker in workers:
+			worker.join()
+		info = cached.cache_info()
+		self.assertEqual(info.hits + info.misses, 400)
+		self.assertEqual(info.size, 10)
+		self.assertEqual(cached._cache.computations, 10)
+
+	def testGlobalCacheInfo(self):
+		first = lru_cache.LRUCache(ttl=60)(lambda x: x)
+		second = lru_cache.LRUCache(ttl=60)(lambda x: x)
+		first(1)
+		first(1)
+		second(2)
+		perFunction = lru_cache.LRUCache.cache_info(perFunction=True)
+		self.assertEqual(perFunction[first.__wrapped__][:5], (1, 1, 0, 0, 1))
+		self.assertEqual(perFunction[second.__wrapped__][:5], (0, 1, 0, 0, 1))
+		totals = lru_cache.LRUCache.cache_info()
+		for index in range(6):
+			self.assertEqual(totals[index], sum(info[index] for info in perFunction.values()))
+		# A function no longer referenced leaves the registry along with its results
+		dropped = second.__wrapped__
+		del perFunction, second
+		gc.collect()
+		self.assertNotIn(dropped, lru_cache.LRUCache.cache_info(perFunction=True))
+
+
+class LRUCacheBudgetTest(unittest.TestCase):
+	"""Contains the tests of the memory budget shared by the decorated functions
+	"""
+	def setUp(self):
+		# The budget counts the results of every function alive
+		gc.collect()
+		for cache in lru_cache.LRUCache._caches():
+			cache.clear()
+		self.addCleanup(lru_cache.LRUCache.setMemoryBudget, None)
+
+	def _total(self):
+		return lru_cache.LRUCache.cache_info().estimatedBytes
+
+	def testBudgetSharedByFunctions(self):
+		lru_cache.LRUCache.setMemoryBudget(50000)
+		first = lru_cache.LRUCache(ttl=60)(lambda x: 'a' * 1000 + str(x))
+		second = lru_cache.LRUCache(ttl=60, maxsize=1000)(lambda x: 'b' * 1000 + str(x))
+		for x in range(100):
+			self.assertEqual(first(x), 'a' * 1000 + str(x))
+			self.assertEqual(second(x), 'b' * 1000 + str(x))
+			self.assertLessEqual(self._total(), 50000)
+		self.assertEqual(self._total(), lru_cache._budget.total)
+		# The most recent results of both fill the budget
+		self.assertGreater(self._total(), 45000)
+		self.assertLessEqual(abs(first.cache_info().size - second.cache_info().size), 1)
+		self.assertEqual(first.cache_info().evictions + first.cache_info().size, 100)
+
+	def testLargeIdleResultGoesBeforeOlderSmallOnes(self):
+		cached = lru_cache.LRUCache(ttl=60)(lambda x: 'x' * x)
+		cached(10)
+		time.sleep(0.05)
+		cached(100000)
+		time.sleep(0.05)
+		lru_cache.LRUCache.setMemoryBudget(self._total() + 100)
+		cached(20)
+		# 10, the least recently used, is kept as it holds far less
+		self.assertEqual(sorted(cached._cache.entries), [((10,), ()), ((20,), ())])
+		self.assertEqual(cached.cache_info().evictions, 1)
+
+	def testWeigherAndSetMemoryBudgetEvictsRightAway(self):
+		cached = lru_cache.LRUCache(ttl=60, weigher=lambda rows: 1000 * len(rows))(lambda x: [x] * x)
+		for x in range(1, 11):
+			cached(x)
+		# 55 rows, plus the keys and the entries
+		self.assertGreater(self._total(), 55000)
+		self.assertLess(self._total(), 55000 + 10 * 500)
+		lru_cache.LRUCache.setMemoryBudget(20000)
+		self.assertLessEqual(self._total(), 20000)
+		self.assertEqual(cached.cache_info().evictions, 10 - cached.cache_info().size)
+
+	def testSharedObjectGraphIsNotCountedPerResult(self):
+		shared = ['x' * 1000 for _ in range(1000)]
+		class Row:
+			def __init__(self, x):
+				self.x = x
+				self.shared = shared
+		cached = lru_cache.LRUCache(ttl=60)(Row)
+		for x in range(100):
+			cached(x)
+		# Some hundred bytes per result, not the megabyte they all point to
+		self.assertLess(self._total(), 100 * 1000)
+
+	def testResultOverBudgetIsReturnedNotCached(self):
+		lru_cache.LRUCache.setMemoryBudget(10000)
+		cached = lru_cache.LRUCache(ttl=60)(lambda x: 'x' * x)
+		cached(10)
+		self.assertEqual(cached(100000), 'x' * 100000)
+		self.assertEqual(sorted(cached._cache.entries), [((10,), ())])
+		self.assertLessEqual(self._total(), 10000)
+
+	def testCollectedFunctionsLeaveTheBudget(self):
+		cached = lru_cache.LRUCache(ttl=60)(lambda x: 'x' * x)
+		cached(100000)
+		self.assertGreater(lru_cache._budget.total, 100000)
+		del cached
+		gc.collect()
+		self.assertEqual(lru_cache._budget.total, 0)
+
+	def testThreadSafeFunctionsUnderBudget(self):
+		lru_cache.LRUCache.setMemoryBudget(100000)
+		functions = [
+			lru_cache.LRUCache(ttl=60, threadSafe=True)(lambda x, size=size: 'x' * (size * x))
+			for size in (10, 100, 1000)
+		]
+		errors = []
+		def run(index):
+			try:
+				for x in range(200):
+					function = functions[(x + index) % 3]
+					self.assertEqual(len(function(x % 50)), len(function.__wrapped__(x % 50)))
+			except Exception as error:
+				errors.append(error)
+		workers = [threading.Thread(target=run, args=(i,)) for i in range(8)]
+		for worker in workers:
+			worker.start()
+		for worker in workers:
+			worker.join()
+		self.assertEqual(errors, [])
+		self.assertLessEqual(self._total(), 100000)
+		self.assertEqual(self._total(), lru_cache._budget.total)
+
+	def testThreadSafeMissesEvictFromASingleThreadedFunction(self):
+		lru_cache.LRUCache.setMemoryBudget(200000)
+		# Called from one thread only, while the others evict its results
+		single = lru_cache.LRUCache(ttl=60)(lambda x: 'y' * (100 * (x % 20)))
+		# Mostly hits, refreshed while the other threads pick them for eviction
+		shared = lru_cache.LRUCache(ttl=60, threadSafe=True)(lambda x: 'x' * (1000 * (x % 20)))
+		errors = []
+		stop = threading.Event()
+		def run(function, stride):
+			try:
+				x = 0
+				while not stop.is_set():
+					function(x % 40)
+					x += stride
+			except Exception as error:
+				errors.append(error)
+		switchInterval = sys.getswitchinterval()
+		self.addCleanup(sys.setswitchinterval, switchInterval)
+		sys.setswitchinterval(1e-6)
+		workers = [threading.Thread(target=run, args=(single, 1))] + [
+			threading.Thread(target=run, args=(shared, 1 + index)) for index in range(4)
+		]
+		for worker in workers:
+			worker.start()
+		time.sleep(1)
+		stop.set()
+		for worker in workers:
+			worker.join()
+		self.assertEqual(errors, [])
+		self.assertEqual(
+			single.cache_info().estimatedBytes,
+			sum(value[2] for value in single._cache.entries.values())
+		)
+		self.assertEqual(self._total(), lru_cache._budget.total)
+
+
+class LRUCacheThreadSafeTest(unittest.TestCase):
+	"""Contains the multi-threaded stress tests of the thread safe mode
+	"""
+	def _hammer(self, cached, keys, threads=16, rounds=50):
+		# Every thread calls every key, in its own order, starting all at once
+		errors = []
+		start = threading.Event()
+		def run(index):
+			start.wait()
+			try:
+				for _ in range(rounds):
+					for key in keys[index % len(keys):] + keys[:index % len(keys)]:
+						self.assertEqual(cached(key), key * 10)
+			except Exception as error:
+				errors.append(error)
+		workers = [threading.Thread(target=run, args=(i,)) for i in range(threads)]
+		for worker in workers:
+			worker.start()
+		start.set()
+		for worker in workers:
+			worker.join()
+		self.assertEqual(errors, [])
+
+	def testConcurrentMissesComputeOnce(self):
+		calls = collections.Counter()
+		lock = threading.Lock()
+		def slow(x):
+			with lock:
+				calls[x] += 1
+			time.sleep(0.05)
+			return x * 10
+		cachedSlow = lru_cache.LRUCache(ttl=60, maxsize=1000, threadSafe=True)(slow)
+		self._hammer(cachedSlow, list(range(20)))
+		self.assertEqual(calls, collections.Counter(range(20)))
+
+	def testExpiredHotKeyComputesOncePerExpiry(self):
+		calls = collections.Counter()
+		lock = threading.Lock()
+		def slow(x):
+			with lock:
+				calls[x] += 1
+			time.sleep(0.02)
+			return x * 10
+		cachedSlow = lru_cache.LRUCache(ttl=0.05, threadSafe=True)(slow)
+		started = time.time()
+		self._hammer(cachedSlow, [7], threads=32, rounds=200)
+		elapsed = time.time() - started
+		# At most one computation per expiry, far from one per caller
+		self.assertLessEqual(calls[7], elapsed / 0.05 + 1)
+		self.assertLess(calls[7], 32 * 200 / 10)
+
+	def testUnrelatedKeysDoNotSerialize(self):
+		def slow(x):
+			time.sleep(0.2)
+			return x * 10
+		cachedSlow = lru_cache.LRUCache(ttl=60, threadSafe=True)(slow)
+		started = time.time()
+		self._hammer(cachedSlow, list(range(8)), threads=8, rounds=1)
+		# The 8 computations overlap instead of taking 8 * 0.2 seconds
+		self.assertLess(time.time() - started, 0.8)
+
+	def testErrorsReachEveryWaiterAndAreNotCached(self):
+		calls = []
+		def failing(x):
+			calls.append(x)
+			time.sleep(0.1)
+			if len(calls) == 1:
+				raise ValueError('boom')
+			return x
+		cachedFailing = lru_cache.LRUCache(ttl=60, threadSafe=True)(failing)
+		results = []
+		def call():
+			try:
+				results.append(cachedFailing(1))
+			except ValueError as error:
+				results.append(error)
+		workers = [threading.Thread(target=call) for _ in range(8)]
+		for worker in workers:
+			worker.start()
+		for worker in workers:
+			worker.join()
+		self.assertEqual(len(calls), 1)
+		self.assertTrue(all(isinstance(result, ValueError) for result in results))
+		self.assertEqual(cachedFailing(1), 1)
+		self.assertEqual(len(calls), 2)
+
+	def testBaseExceptionsReachEveryWaiter(self):
+		class Interrupted(BaseException):
+			pass
+		started = threading.Event()
+		def interrupted(x):
+			started.set()
+			time.sleep(0.1)
+			raise Interrupted()
+		cachedInterrupted = lru_cache.LRUCache(ttl=60, threadSafe=True)(interrupted)
+		results = []
+		def call():
+			try:
+				results.append(cachedInterrupted(1))
+			except Interrupted as error:
+				results.append(error)
+		leader = threading.Thread(target=call)
+		leader.start()
+		started.wait()
+		waiters = [threading.Thread(target=call) for _ in range(4)]
+		for waiter in waiters:
+			waiter.start()
+		for worker in [leader] + waiters:
+			worker.join()
+		self.assertEqual(len(results), 5)
+		self.assertTrue(all(isinstance(result, Interrupted) for result in results))
 
 	
 if __name__=='__main__':